@@ -1,64 +1,228 @@
 #!/usr/bin/env python3
 
 import argparse
+import copy
 import logging
 import os
-import re
 import shutil
-import subprocess as sp
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 
 import distro
 
-from config import OUTPUT_BASE_DIR, SRC_DIR, ARCH, OS, COMMAND, GCLIENT_CONFIG
-from config import create_logger, shell_expand_abs_path, parse_gn_flags, filter_list_file, git_maybe_checkout, \
-    git_is_shallow
-from config import Config
+from config import tracing as sp
+from config import OUTPUT_BASE_DIR, SRC_DIR, ARCH, OS, COMMAND, GCLIENT_CONFIG, GN_ARGS_STAMP_FILE, \
+    SOURCE_URL, TRASH_DIR, CCACHE_DIR, UPGRADE_VERIFY_DIR, THINLTO_CACHE_DIR, PGO_DIR, PGO_WORKLOAD_DIR, \
+    PGO_REPORT_FILE, DIST_DIR
+from config import create_logger, shell_expand_abs_path, parse_gn_flags, normalize_gn_args, filter_list_file, \
+    git_maybe_checkout, git_forget_state, git_is_shallow, git_head, parse_series, series_touched_files, \
+    read_list_file, write_list_file, apply_patches, apply_patch_series, git_is_valid_repo
+from config import Config, GitCache, SourceSnapshot, StampManifest, Pipeline, fingerprint, hash_files, \
+    apply_domain_substitution, enable_tracing, write_trace, analyze_ninja_log, download_source, PruneIndex, \
+    prune_binaries, merge_domain_substitution_cache
+from config import PreparedInputs, gclient_revinfo, changed_deps, git_deps, git_ensure_rev, git_changed_files, \
+    git_tree, git_restore_files, git_move_head, git_export_files, git_dirty_files, file_steps, affected_files, \
+    patch_files, split_by_repo, same_file
+from config import ResourceProfile, plan_jobs, plan_concurrent_links, run_ninja_adaptive, available_cpus, \
+    parse_matrix, parse_size, move_to_trash, empty_trash, empty_trash_in_background, CompilerCache, \
+    BuildProgress, progress_sink, run_with_progress, list_gitlinks, sync_submodules, ThinLTOCache
+from config import load_workload, find_llvm_profdata, run_workload, merge_profiles, compare_workloads, \
+    write_pgo_report, package_output, default_compression, COMPRESSORS
 from config import chromium_version, ungoogled_chromium_version, ungoogled_chromium_android_version, \
     ungoogled_chromium_origin
 
 # Logging
 logger = create_logger(level=logging.DEBUG)
 
+PRUNING_EXCLUDES = ['buildtools/linux64/gn']
+
+
+def version_inputs():
+    """
+    Fingerprint of pinned versions in config/versions.py.
+    """
+    return fingerprint([chromium_version, ungoogled_chromium_version, ungoogled_chromium_android_version,
+                        ungoogled_chromium_origin])
+
+
+def prepare_inputs(config):
+    """
+    Fingerprint everything prepare() depends on. Returns None if a checkout is missing.
+    A source tree from --direct-download has no HEAD, it is identified by the tarball URL, whose
+    content init verified against its sha256.
+    """
+    uc_dir = 'ungoogled-chromium'
+    uca_dir = 'ungoogled-chromium-android'
+    repos = [SRC_DIR, uc_dir]
+    if config.target_os == 'android':
+        repos.append(uca_dir)
+    heads = {repo: git_head(repo) for repo in repos}
+    if config.direct_download and os.path.isdir(SRC_DIR):
+        heads[SRC_DIR] = config.source_url.format(version=chromium_version)
+    if None in heads.values():
+        return None
+
+    try:
+        lists = [filter_list_file(uc_dir, 'pruning.list', excludes=PRUNING_EXCLUDES,
+                                 exclude_files=config.exclude_files),
+                 filter_list_file(uc_dir, 'domain_substitution.list', exclude_files=config.exclude_files),
+                 os.path.join(uc_dir, 'domain_regex.list')]
+        patches = [os.path.join(uc_dir, 'patches', 'series')] + parse_series(os.path.join(uc_dir, 'patches'))
+        if config.target_os == 'android':
+            lists += [filter_list_file(uca_dir, 'pruning_2.list', exclude_files=config.exclude_files),
+                      filter_list_file(uca_dir, 'domain_sub_2.list', exclude_files=config.exclude_files)]
+            patches += [os.path.join(uca_dir, 'patches', 'series')] + parse_series(os.path.join(uca_dir, 'patches'))
+    except FileNotFoundError:
+        return None
+
+    return {
+        'versions': version_inputs(),
+        'heads': fingerprint(heads),
+        'lists': hash_files(lists),
+        'patches': hash_files(patches),
+        'config': fingerprint({'target_os': config.target_os}),
+    }
+
 
 def clean(config):
     """
-    Clean output directory.
+    Clean output directory. It is moved to the trash at once and deleted in the background,
+    or before returning with --wait. With --stale, only output folders of configurations not
+    selected by this invocation are removed, and ninja removes outputs the build graphs of the
+    selected ones no longer produce. Symlinks are removed, never followed.
     """
-    if os.path.exists(config.output_base_dir):
+    output_dir = os.path.join(SRC_DIR, config.output_base_dir)
+    # Also finish what earlier cleans left behind
+    trash_dirs = {TRASH_DIR}
+    if os.path.lexists(output_dir):
         if shell_expand_abs_path(config.output_base_dir) != shell_expand_abs_path(
                 OUTPUT_BASE_DIR):
             reply = input(
                 "WARNING: you are about to remove an output directory which is different from the default location. "
                 "Are you sure you want ot remove {}? [y/n]: ".format(
-                    os.path.abspath(config.output_base_dir)))
+                    os.path.abspath(output_dir)))
             if reply != 'y':
                 return
 
-        sp.check_call(['rm', '-rf', config.output_base_dir])
+        manifest = StampManifest()
+        if config.stale and os.path.isdir(output_dir) and not os.path.islink(output_dir):
+            keep = set(get_output_subfolder(c) for c in matrix_configs(config))
+            for name in sorted(os.listdir(output_dir)):
+                path = os.path.join(output_dir, name)
+                if name not in keep:
+                    trash_dirs.add(move_to_trash(path))
+                    manifest.invalidate('build:' + name)
+                elif os.path.exists(os.path.join(path, 'build.ninja')):
+                    sp.check_call(['ninja', '-C', path, '-t', 'cleandead'], env=depot_tools_env())
+        else:
+            trash_dirs.add(move_to_trash(output_dir))
+            manifest.invalidate('build:')
+
+    for trash_dir in sorted(trash_dirs):
+        if config.wait:
+            empty_trash(trash_dir, progress=True)
+        elif os.path.isdir(trash_dir):
+            empty_trash_in_background(trash_dir)
+
+
+def get_git_cache(config):
+    """
+    Shared git mirror store, or None if not configured.
+    """
+    return GitCache(config.git_cache_dir) if config.git_cache_dir else None
+
+
+def mark_pristine():
+    """
+    Record that the source tree is a clean checkout, so the next prepare may snapshot it.
+    prepare drops the mark before it changes the tree.
+    """
+    StampManifest().complete('pristine', {'head': git_head(SRC_DIR)})
+
+
+def source_changed(*stages):
+    """
+    Drop the stamps of stages (all if none is given), the snapshot and the prune index after
+    init or sync changed the source tree.
+    """
+    StampManifest().invalidate(*stages)
+    SourceSnapshot(SRC_DIR).delete()
+    PruneIndex(None).clear()
 
 
 def init(config):
+    """
+    Check out depot_tools and the chromium source. Skipped if both are there and were checked
+    out for the same chromium version and source options. Stamps, snapshot and prune index are
+    only dropped if the source tree was replaced or its HEAD moved.
+    """
+    manifest = StampManifest()
+    inputs = {
+        'chromium_version': chromium_version,
+        'source': fingerprint({'direct_download': config.direct_download, 'shallow': config.shallow,
+                               'source_url': config.source_url if config.direct_download else None}),
+    }
+    if config.force:
+        reason = 'forced'
+    elif not os.path.isdir('depot_tools') or not os.path.isdir(SRC_DIR):
+        reason = 'no checkout'
+    else:
+        fresh, reason = manifest.check('init', inputs)
+        if fresh:
+            manifest.skip('init', reason)
+            return
+    manifest.begin('init', reason)
+    before = git_head(SRC_DIR)
+    cache = get_git_cache(config)
+
     # Setup depot tools
     cwd = 'depot_tools'
     print("Cloning depot_tools...")
     git_maybe_checkout(
         'https://chromium.googlesource.com/chromium/tools/depot_tools.git',
-        cwd)
+        cwd, cache=cache)
 
     # Clone chromium src
     print("Checking out chromium src...")
-    if config.shallow:
+    src_url = 'https://chromium.googlesource.com/chromium/src.git'
+    if config.direct_download:
+        download_source(config.source_url.format(version=chromium_version), SRC_DIR, jobs=config.num_jobs)
+        replaced = True
+    elif config.shallow:
         if os.path.exists(SRC_DIR):
             logging.warning("Init: src folder already exists! Removing %s.", os.path.abspath(SRC_DIR))
             shutil.rmtree(SRC_DIR)
-        sp.check_call(['git', 'clone', '--depth', '1', '--no-tags',
-            'https://chromium.googlesource.com/chromium/src.git',
-            '-b', chromium_version])
+        clone_cmd = ['git', 'clone', '--depth', '1', '--no-tags']
+        # Do not create a full mirror for a shallow clone, but use one if it exists
+        reference = cache.reference(src_url, update=False) if cache is not None else None
+        if reference is not None:
+            clone_cmd += ['--reference-if-able', reference]
+        sp.check_call(clone_cmd + [src_url, '-b', chromium_version])
+        git_forget_state(SRC_DIR)
+        replaced = True
     else:
-        git_maybe_checkout(
-            'https://chromium.googlesource.com/chromium/src.git',
-            cwd)
+        # An existing checkout may have been prepared
+        replaced = not git_is_valid_repo(SRC_DIR)
+        # src sits detached at the release tag, pulling would merge the default branch into it
+        git_maybe_checkout(src_url, SRC_DIR, branch=chromium_version, cache=cache)
+
+    if replaced or git_head(SRC_DIR) != before:
+        source_changed()
+    if replaced:
+        mark_pristine()
+    manifest.complete('init', inputs)
+
+
+def cache(config):
+    """
+    Report size of the git mirror store and remove mirrors that have not been used recently.
+    """
+    git_cache = get_git_cache(config)
+    if git_cache is None:
+        raise RuntimeError("No git cache configured, use --git-cache or set GIT_CACHE_PATH.")
+    git_cache.report()
+    git_cache.gc(config.cache_max_age)
+    git_cache.report()
 
 
 def set_revision(config):
@@ -100,61 +264,73 @@ def set_revision(config):
 
 def list_submodules():
     """
-    List submodule names in current repo
+    List submodule paths in current repo
     """
-    submodule_names = []
-    stages = sp.check_output(['git', 'ls-files', '--stage'], encoding='utf8').strip()
-    submodules_list = re.findall(r"^160000", stages, flags=re.MULTILINE)
-    logging.debug("Found submodules: " + '\n'.join(submodules_list))
-    for submodule in submodules_list:
-        # this assumes no spaces in submodule paths
-        submodule_names.append(re.split(r"[ ]+", submodule.strip())[-1])
-    return submodule_names
+    submodules = list(list_gitlinks())
+    logging.debug("Found submodules: " + '\n'.join(submodules))
+    return submodules
 
 
-def update_submodules(hard_reset=False):
+def update_submodules(hard_reset=False, jobs=None):
     """
-    Update submodules.
+    Update this build repository and its submodules. Not part of the build flow, the
+    ungoogled-chromium checkouts get their submodules synced in checkout_ungoogled().
     """
     # update HEAD
     sp.check_call(['git', 'pull'])
 
-    submodules = list_submodules()
+    # update submodules that are not at their recorded commit
+    sync_submodules(jobs=jobs, hard_reset=hard_reset)
 
-    # probe .git exists in submodules
-    for submodule in submodules:
-        logging.info(submodule + ' is at commit ',
-                     sp.check_call(['git', 'rev-parse', 'HEAD'],
-                                   cwd=submodule))
 
-    # update all submodules
-    print('Update submodules..')
-    if hard_reset:
-        for submodule in submodules:
-            sp.check_call(['git', 'reset', '--hard'],
-                          cwd=submodule)
-    sp.check_call(['git', 'submodule', 'update', '--init', '--recursive'])
+def sync_inputs(config):
+    return {
+        'chromium_version': chromium_version,
+        'head': git_head(SRC_DIR),
+        'config': fingerprint({'target_os': config.target_os, 'shallow': config.shallow}),
+    }
 
 
 def sync(config):
     """
-    Sync chromium source and run hooks.
+    Sync chromium source and run hooks. Skipped if the checkout was synced at its current
+    HEAD for the same chromium version, unless --reset or --force is given. Prepare and
+    build stamps are only dropped if HEAD moved, the dependencies were synced at another HEAD
+    before, or the tree was reset.
     """
+    if config.direct_download:
+        # The release tarball already contains all dependencies
+        logging.info("Source is from a release tarball, nothing to sync.")
+        return
+
+    manifest = StampManifest()
+    if config.force or config.reset:
+        reason = 'forced' if config.force else 'reset'
+    else:
+        fresh, reason = manifest.check('sync', sync_inputs(config))
+        if fresh:
+            manifest.skip('sync', reason)
+            return
+    synced_head = manifest.stages.get('sync', {}).get('inputs', {}).get('head')
+    manifest.begin('sync', reason)
+    before = git_head(SRC_DIR)
+
     # Fetch & Sync Chromium
     # Copy PATH from current process and add depot_tools to it
-    depot_tools_path = os.path.join(os.getcwd(), 'depot_tools')
-    if not os.path.exists(depot_tools_path) or not os.path.isdir(depot_tools_path):
-        raise FileNotFoundError("Cannot find depot_tools!")
-    _env = os.environ.copy()
-    _env["PATH"] = depot_tools_path + ":" + _env["PATH"]
+    _env = depot_tools_env()
 
     # Get chromium ref
     # Set src HEAD to version
     chromium_ref = set_revision(config)
 
     # Create .gclient file
+    git_cache = get_git_cache(config)
+    if git_cache is not None:
+        # DEPS checkouts borrow objects from the mirrors gclient creates
+        git_cache.register_workspace()
     with open('.gclient', 'w', encoding='utf-8') as f:
-        f.write(GCLIENT_CONFIG.replace("@@TARGET_OS@@", "'{}'".format(config.target_os)))
+        f.write(GCLIENT_CONFIG.replace("@@TARGET_OS@@", "'{}'".format(config.target_os))
+                .replace("@@CACHE_DIR@@", repr(git_cache.cache_dir) if git_cache is not None else 'None'))
 
     # Run gclient sync without hooks
     extra_args = []
@@ -172,6 +348,17 @@ def sync(config):
     # Run hooks
     sp.check_call(['gclient', 'runhooks'], env=_env)
 
+    after = git_head(SRC_DIR)
+    if after != before or after != synced_head:
+        source_changed('prepare', 'build:')
+    elif config.reset:
+        # Same revision, the snapshot is still good, but the prepared changes are gone
+        StampManifest().invalidate('prepare', 'build:')
+        PruneIndex(None).clear()
+    # Without --reset, changes of an earlier prepare stay in the tree
+    if config.reset:
+        mark_pristine()
+
     # If Debian/Ubuntu and install_deps, then run the script.
     # Note: requires sudo
     if config.install_build_deps:
@@ -187,14 +374,12 @@ def sync(config):
         else:
             warnings.warn("Installing dependencies only works on Debian based systems, skipping.",
                           RuntimeWarning)
+    StampManifest().complete('sync', sync_inputs(config))
 
 
-def prepare(config):
+def checkout_ungoogled(config):
     """
-    Pull ungoogled-chromium repositories, run scripts and apply patches.
-    Note: for Android, this will use bundled SDK and NDK, not the rebuilds
-    TODO: re-apply patches
-    TODO: add a patch list filter
+    Clone or update ungoogled-chromium repositories and their submodules.
     """
     # Checkout ungoogled-chromium
     uc_git_origin = 'https://github.com/Eloston/ungoogled-chromium.git'\
@@ -202,35 +387,78 @@ def prepare(config):
     git_maybe_checkout(
         uc_git_origin,
         'ungoogled-chromium',
-        branch=ungoogled_chromium_version, reset=True)
+        branch=ungoogled_chromium_version, reset=True, cache=get_git_cache(config))
+    sync_submodules('ungoogled-chromium', jobs=config.num_jobs, hard_reset=True)
     if config.target_os == 'android':
         git_maybe_checkout(
             'https://github.com/ungoogled-software/ungoogled-chromium-android.git',
             'ungoogled-chromium-android',
-            branch=ungoogled_chromium_android_version, reset=True)
-        sp.check_call(['patch', '-p1', '--ignore-whitespace', '-i',
-                       os.path.join('ungoogled-chromium-android', 'patches', 'Other', 'ungoogled-main-repo-fix.patch'),
-                       '--no-backup-if-mismatch'])
+            branch=ungoogled_chromium_android_version, reset=True, cache=get_git_cache(config))
+        sync_submodules('ungoogled-chromium-android', jobs=config.num_jobs, hard_reset=True)
+        apply_patches([os.path.join('ungoogled-chromium-android', 'patches', 'Other',
+                                    'ungoogled-main-repo-fix.patch')], '.')
+
+
+def prepare(config, checkout=True):
+    """
+    Pull ungoogled-chromium repositories, run scripts and apply patches.
+    Note: for Android, this will use bundled SDK and NDK, not the rebuilds
+    The synced tree is snapshotted before it is changed the first time, and later runs
+    restore the snapshot before pruning and patching again.
+    TODO: add a patch list filter
+    """
+    manifest = StampManifest()
+    # Only a tree init or sync --reset checked out, and nothing changed since, is pristine
+    pristine = manifest.stages.get('pristine', {}).get('complete', False)
+    if config.force:
+        reason = 'forced'
+    else:
+        fresh, reason = manifest.check('prepare', prepare_inputs(config))
+        if fresh:
+            manifest.skip('prepare', reason)
+            return
+    manifest.begin('prepare', reason)
+
+    if checkout:
+        checkout_ungoogled(config)
+
+    snapshot = SourceSnapshot(SRC_DIR, excludes=[config.output_base_dir])
+    head = git_head(SRC_DIR)
+    prune_index = PruneIndex(head)
+    manifest.invalidate('pristine')
+    if snapshot.exists() and snapshot.head == head:
+        snapshot.restore(jobs=config.num_jobs)
+        # Pruned files are back
+        prune_index.clear()
+    elif pristine:
+        snapshot.take(head, jobs=config.num_jobs)
+        prune_index.clear()
+    else:
+        snapshot.delete()
+        logging.warning("No snapshot of the pristine source tree, run sync --reset to get one. "
+                        "Preparing on top of the current tree.")
 
     domain_substitution_cache_file = "domsubcache.tar.gz"
     if os.path.exists(domain_substitution_cache_file):
         os.remove(domain_substitution_cache_file)
 
+    if config.target_os == 'android' and config.fused_prepare:
+        prepare_android_fused(config, domain_substitution_cache_file, prune_index)
+        collect_prepared_inputs(config).save()
+        manifest.complete('prepare', prepare_inputs(config))
+        return
+
     # ungoogled-chromium scripts
-    # Do not check here because prune script return non-zero for non-existing files
-    cwd = SRC_DIR
     uc_dir = 'ungoogled-chromium'
-    utils_dir = os.path.join(uc_dir, 'utils')
-    sp.run([os.path.join(utils_dir, 'prune_binaries.py'),
-        SRC_DIR, filter_list_file(
-            uc_dir, 'pruning.list',
-            excludes=['buildtools/linux64/gn'])])
-    sp.check_call([os.path.join(utils_dir, 'patches.py'),
-        'apply', 'src', os.path.join(uc_dir, 'patches')])
-    sp.check_call([os.path.join(utils_dir, 'domain_substitution.py'),
-        'apply', '-r', os.path.join(uc_dir, 'domain_regex.list'),
-        '-f', filter_list_file(uc_dir, 'domain_substitution.list'),
-        '-c', domain_substitution_cache_file, 'src'])
+    prune_binaries(SRC_DIR, read_list_file(filter_list_file(
+        uc_dir, 'pruning.list',
+        excludes=PRUNING_EXCLUDES, exclude_files=config.exclude_files)),
+        jobs=config.num_jobs, index=prune_index).log('pruning.list')
+    apply_patch_series(os.path.join(uc_dir, 'patches'), SRC_DIR, jobs=config.num_jobs)
+    apply_domain_substitution(
+        os.path.join(uc_dir, 'domain_regex.list'),
+        filter_list_file(uc_dir, 'domain_substitution.list', exclude_files=config.exclude_files),
+        SRC_DIR, domain_substitution_cache_file, jobs=config.num_jobs)
 
     # ungoogled-chromium-android scripts
     if config.target_os == 'android':
@@ -238,31 +466,286 @@ def prepare(config):
             os.remove(domain_substitution_cache_file)
 
         uca_dir = 'ungoogled-chromium-android'
-        sp.run([os.path.join(utils_dir, 'prune_binaries.py'),
-            'src', filter_list_file(uca_dir, 'pruning_2.list')])
-        sp.check_call([os.path.join(utils_dir, 'patches.py'),
-            'apply', 'src', os.path.join(uca_dir, 'patches')])
-        sp.check_call([os.path.join(utils_dir, 'domain_substitution.py'),
-            'apply', '-r', os.path.join(uc_dir, 'domain_regex.list'),
-            '-f', filter_list_file(uca_dir, 'domain_sub_2.list'),
-            '-c', domain_substitution_cache_file, 'src'])
+        prune_binaries(SRC_DIR, read_list_file(
+            filter_list_file(uca_dir, 'pruning_2.list', exclude_files=config.exclude_files)),
+            jobs=config.num_jobs, index=prune_index).log('pruning_2.list')
+        apply_patch_series(os.path.join(uca_dir, 'patches'), SRC_DIR, jobs=config.num_jobs)
+        apply_domain_substitution(
+            os.path.join(uc_dir, 'domain_regex.list'),
+            filter_list_file(uca_dir, 'domain_sub_2.list', exclude_files=config.exclude_files),
+            SRC_DIR, domain_substitution_cache_file, jobs=config.num_jobs)
 
+    collect_prepared_inputs(config).save()
+    manifest.complete('prepare', prepare_inputs(config))
 
-def build(config):
+
+def prepare_android_fused(config, domain_substitution_cache_file, prune_index=None):
     """
-    Run build for given targets.
+    Prune, patch and substitute for Android in one pass over the tree instead of two.
+    The result is the same as running the ungoogled-chromium and ungoogled-chromium-android
+    passes one after another. Only work whose order matters is done in between:
+    pruning_2.list entries touched by the first patch series are pruned after it, and
+    domain_substitution.list entries touched by the second series are substituted before it.
+    Like the sequential flow, the cache is only written by the domain_sub_2.list pass, so
+    revert works the same after both.
+    """
+    uc_dir = 'ungoogled-chromium'
+    uca_dir = 'ungoogled-chromium-android'
+    regex_list = os.path.join(uc_dir, 'domain_regex.list')
+
+    pruning = read_list_file(filter_list_file(uc_dir, 'pruning.list', excludes=PRUNING_EXCLUDES,
+                                              exclude_files=config.exclude_files))
+    pruning_2 = read_list_file(filter_list_file(uca_dir, 'pruning_2.list', exclude_files=config.exclude_files))
+    domsub_list = filter_list_file(uc_dir, 'domain_substitution.list', exclude_files=config.exclude_files)
+    domsub_list_2 = filter_list_file(uca_dir, 'domain_sub_2.list', exclude_files=config.exclude_files)
+    domsub = read_list_file(domsub_list)
+    touched = series_touched_files(os.path.join(uc_dir, 'patches'))
+    touched_2 = series_touched_files(os.path.join(uca_dir, 'patches'))
+
+    # Prune everything that does not depend on the first patch series
+    deferred = [p for p in pruning_2 if p in touched]
+    pruning_fused = list(dict.fromkeys(pruning + [p for p in pruning_2 if p not in touched]))
+    prune_binaries(SRC_DIR, pruning_fused, jobs=config.num_jobs, index=prune_index).log('pruning')
+
+    apply_patch_series(os.path.join(uc_dir, 'patches'), SRC_DIR, jobs=config.num_jobs)
+    if deferred:
+        prune_binaries(SRC_DIR, deferred, jobs=config.num_jobs, index=prune_index).log('deferred pruning')
+
+    # Files the second series modifies must be substituted before it is applied
+    early = [p for p in domsub if p in touched_2]
+    if early:
+        apply_domain_substitution(
+            regex_list, write_list_file(os.path.join(uca_dir, 'domain_sub_early.list.filtered'), early),
+            SRC_DIR, jobs=config.num_jobs)
+    apply_patch_series(os.path.join(uca_dir, 'patches'), SRC_DIR, jobs=config.num_jobs)
+
+    # The rest of the first list, then the second list with the cache, which keeps the content
+    # of files in both lists after the first substitution as the sequential flow does
+    late = [p for p in domsub if p not in touched_2]
+    if late:
+        apply_domain_substitution(
+            regex_list, write_list_file(os.path.join(uca_dir, 'domain_sub_late.list.filtered'), late),
+            SRC_DIR, jobs=config.num_jobs)
+    apply_domain_substitution(regex_list, domsub_list_2, SRC_DIR, domain_substitution_cache_file,
+                              jobs=config.num_jobs)
+
+
+def prepare_lists(config):
+    """
+    Filtered list files prepare uses, by the names PreparedInputs records them under.
+    """
+    uc_dir = 'ungoogled-chromium'
+    uca_dir = 'ungoogled-chromium-android'
+    lists = {
+        'pruning': filter_list_file(uc_dir, 'pruning.list', excludes=PRUNING_EXCLUDES,
+                                    exclude_files=config.exclude_files),
+        'domsub': filter_list_file(uc_dir, 'domain_substitution.list', exclude_files=config.exclude_files),
+    }
+    if config.target_os == 'android':
+        lists['pruning_2'] = filter_list_file(uca_dir, 'pruning_2.list', exclude_files=config.exclude_files)
+        lists['domsub_2'] = filter_list_file(uca_dir, 'domain_sub_2.list', exclude_files=config.exclude_files)
+    return lists
+
+
+def prepare_patch_dirs(config):
+    """
+    Patch folders prepare applies, by the names PreparedInputs records their series under.
+    """
+    patch_dirs = {'patches': os.path.join('ungoogled-chromium', 'patches')}
+    if config.target_os == 'android':
+        patch_dirs['patches_2'] = os.path.join('ungoogled-chromium-android', 'patches')
+    return patch_dirs
+
+
+def collect_prepared_inputs(config):
+    return PreparedInputs.collect(chromium_version, config.target_os,
+                                  os.path.join('ungoogled-chromium', 'domain_regex.list'),
+                                  prepare_lists(config), prepare_patch_dirs(config))
+
+
+def prepare_files(config, source_tree, only=None, cache_file=None):
+    """
+    Run the prepare passes (pruning, patches, domain substitution, then the same for Android)
+    on source_tree, in the sequential order of prepare(). If only is given, lists and patches
+    are restricted to those paths and the patches touching them. The cache covers the last
+    substitution pass.
+    """
+    lists = prepare_lists(config)
+    patch_dirs = prepare_patch_dirs(config)
+    regex_list = os.path.join('ungoogled-chromium', 'domain_regex.list')
+    for suffix in ('', '_2'):
+        if 'pruning' + suffix not in lists:
+            continue
+        if cache_file is not None and os.path.exists(cache_file):
+            os.remove(cache_file)
+        pruning = read_list_file(lists['pruning' + suffix])
+        patches = parse_series(patch_dirs['patches' + suffix])
+        domsub_list = lists['domsub' + suffix]
+        if only is not None:
+            pruning = [p for p in pruning if p in only]
+            patches = [p for p in patches if not patch_files(p).isdisjoint(only)]
+            domsub_list = write_list_file(domsub_list + '.partial',
+                                          [p for p in read_list_file(domsub_list) if p in only])
+        prune_binaries(source_tree, pruning, jobs=config.num_jobs).log('pruning' + suffix)
+        apply_patches(patches, source_tree, jobs=config.num_jobs)
+        logging.info("Applied %d patches from %s.", len(patches), patch_dirs['patches' + suffix])
+        apply_domain_substitution(regex_list, domsub_list, source_tree, cache_file, jobs=config.num_jobs)
+
+
+def upgrade(config):
+    """
+    Move a prepared git checkout to the chromium version in config/versions.py (and the pinned
+    ungoogled-chromium revisions) without preparing the whole tree again. Only files that
+    changed between the two chromium releases (src and git dependencies in DEPS), files the old
+    and new lists and patches treat differently and files sharing a patch with those are
+    restored from the new release and prepared again. With --verify, the result is compared
+    with a from-scratch prepare of every listed or patched file.
+    """
+    old = PreparedInputs.load()
+    manifest = StampManifest()
+    if old is None or not manifest.stages.get('prepare', {}).get('complete'):
+        raise RuntimeError("The source tree has no recorded prepare, run sync and prepare instead.")
+    if old.target_os != config.target_os:
+        raise RuntimeError("The source tree was prepared for {}, not {}.".format(old.target_os, config.target_os))
+    if config.direct_download or not git_is_valid_repo(SRC_DIR):
+        raise RuntimeError("Upgrading needs a git checkout of the chromium source.")
+    env = depot_tools_env()
+    manifest.begin('prepare', 'upgrade from {}'.format(old.chromium_version))
+
+    # Upstream changes
+    old_deps = gclient_revinfo(env)
+    old_src = git_head(SRC_DIR)
+    new_src = git_ensure_rev(SRC_DIR, chromium_version, tag=True, shallow=git_is_shallow(SRC_DIR))
+    changed = git_changed_files(SRC_DIR, old_src, new_src)
+    sp.check_call(['git', 'checkout', new_src, '--', 'DEPS'], cwd=SRC_DIR)
+    new_deps = gclient_revinfo(env)
+    revisions = {'': (old_src, new_src)}
+    for dep in git_deps(new_deps, SRC_DIR):
+        head = git_head(os.path.join(SRC_DIR, dep))
+        revisions[dep] = (head, head)
+    for dep, (old_rev, new_rev) in changed_deps(old_deps, new_deps, SRC_DIR).items():
+        path = os.path.join(SRC_DIR, dep)
+        revisions[dep] = (git_ensure_rev(path, old_rev), git_ensure_rev(path, new_rev, shallow=git_is_shallow(path)))
+        changed |= set(dep + '/' + p for p in git_changed_files(path, *revisions[dep]))
+    logging.info("%d files changed from %s to %s.", len(changed), old.chromium_version, chromium_version)
+
+    # Files whose prepared content can differ
+    checkout_ungoogled(config)
+    new = collect_prepared_inputs(config)
+    touched = old.touched_files()
+    touched.update(new.touched_files())
+    old_steps = file_steps(old.lists, old.series, touched)
+    affected = affected_files(changed, old_steps, file_steps(new.lists, new.series, touched),
+                              old.domsub_files() | new.domsub_files(), old.regex != new.regex, touched)
+    logging.info("%d files to prepare again.", len(affected))
+
+    # Files git does not know cannot be restored, unless only patches create them
+    created = set(p for files in touched.values() for p in files)
+    groups = split_by_repo(affected, revisions)
+    trees = {}
+    unknown = []
+    for repo, (old_rev, new_rev) in revisions.items():
+        if repo not in groups and old_rev == new_rev:
+            continue
+        path = os.path.join(SRC_DIR, repo)
+        trees[repo] = git_tree(path, new_rev)
+        old_tree = git_tree(path, old_rev) if old_rev != new_rev else trees[repo]
+        for rel in groups.get(repo, ()):
+            full = os.path.join(repo, rel) if repo else rel
+            if rel not in trees[repo] and rel not in old_tree and full not in created and full in old_steps:
+                unknown.append(full)
+    if unknown:
+        raise RuntimeError("{} prepared files are not in git (e.g. {}) and cannot be restored, "
+                           "run sync and prepare instead.".format(len(unknown), sorted(unknown)[0]))
+
+    # Restore the affected files from the new release and move the checkouts to it
+    for repo in trees:
+        path = os.path.join(SRC_DIR, repo)
+        new_rev = revisions[repo][1]
+        git_restore_files(path, new_rev, groups.get(repo, set()), trees[repo])
+        git_move_head(path, new_rev)
+        git_forget_state(path)
+
+    domain_substitution_cache_file = "domsubcache.tar.gz"
+    partial_cache_file = domain_substitution_cache_file + '.partial'
+    if os.path.exists(partial_cache_file):
+        os.remove(partial_cache_file)
+    prepare_files(config, SRC_DIR, only=affected, cache_file=partial_cache_file)
+    merge_domain_substitution_cache(domain_substitution_cache_file, partial_cache_file, affected,
+                                    domain_substitution_cache_file)
+    os.remove(partial_cache_file)
+
+    sp.check_call(['gclient', 'runhooks'], env=env)
+
+    # The snapshot and prune index are of the old release
+    SourceSnapshot(SRC_DIR).delete()
+    PruneIndex(new_src).clear()
+    manifest.invalidate('build:')
+    new.save()
+    manifest.complete('prepare', prepare_inputs(config))
+
+    if config.verify:
+        verify_upgrade(config, new, revisions, trees)
+
+
+def verify_upgrade(config, inputs, revisions, trees):
+    """
+    Prepare every file named by a list or patch from scratch in UPGRADE_VERIFY_DIR and compare
+    it with the source tree, then check that no other file of the checkouts upgrade wrote to
+    differs from the new release. Raises RuntimeError on a mismatch.
+    """
+    listed = set(p for entries in inputs.lists.values() for p in entries)
+    listed |= set(p for files in inputs.touched_files().values() for p in files)
+    groups = split_by_repo(listed, revisions)
+    shutil.rmtree(UPGRADE_VERIFY_DIR, ignore_errors=True)
+    exported = set()
+    for repo, paths in groups.items():
+        if repo not in trees:
+            trees[repo] = git_tree(os.path.join(SRC_DIR, repo), revisions[repo][1])
+        dest = os.path.join(UPGRADE_VERIFY_DIR, repo)
+        exported |= set(os.path.join(repo, p) if repo else p
+                        for p in git_export_files(os.path.join(SRC_DIR, repo), paths, dest, trees[repo]))
+    prepare_files(config, UPGRADE_VERIFY_DIR)
+
+    # Files only patches create were not exported, but are compared too
+    compared = exported | set(p for p in listed if os.path.lexists(os.path.join(UPGRADE_VERIFY_DIR, p)))
+    mismatched = sorted(p for p in compared
+                        if not same_file(os.path.join(UPGRADE_VERIFY_DIR, p), os.path.join(SRC_DIR, p)))
+    # Upgrade only wrote to checkouts with listed files or a new revision
+    unexpected = []
+    for repo in trees:
+        for rel in git_dirty_files(os.path.join(SRC_DIR, repo)):
+            full = os.path.join(repo, rel) if repo else rel
+            if not rel.endswith('/') and full not in listed:
+                unexpected.append(full)
+    shutil.rmtree(UPGRADE_VERIFY_DIR)
+
+    logging.info("Verified %d prepared files, %d not in git were skipped.", len(compared),
+                 len(listed) - len(compared))
+    for path in mismatched[:10]:
+        logging.error("  differs from a full prepare: %s", path)
+    for path in sorted(unexpected)[:10]:
+        logging.error("  differs from %s: %s", chromium_version, path)
+    if mismatched or unexpected:
+        raise RuntimeError("Upgrade verification failed: {} files differ from a full prepare, {} other files "
+                           "differ from the release.".format(len(mismatched), len(unexpected)))
+
+
+def get_output_subfolder(config):
+    """
+    Name of the output folder of a configuration, e.g. Release_android_arm64.
     """
-    # Create output folder if not exist
     release_channel = 'Release' if not config.debug else 'Debug'
-    output_subfolder = release_channel + '_' + config.target_os + '_' + config.target_cpu
-    output_path = os.path.join(config.output_base_dir, output_subfolder)
-    output_src_path = os.path.join(SRC_DIR, config.output_base_dir, output_subfolder)
-    if os.path.exists(output_src_path):
-        if not os.path.isdir(output_src_path):
-            os.remove(output_src_path)
-    os.makedirs(output_src_path, exist_ok=True)
+    subfolder = release_channel + '_' + config.target_os + '_' + config.target_cpu
+    if config.pgo_phase == 1:
+        subfolder += '_pgo1'
+    return subfolder
+
 
-    # Build GN args
+def get_gn_args(config):
+    """
+    Assemble GN args from ungoogled-chromium flags.gn, built-in overrides and the command line.
+    """
     # ungoogled-chromium
     with open(os.path.join('ungoogled-chromium', 'flags.gn'), 'r') as f:
         flags = f.readlines()
@@ -300,48 +783,399 @@ def build(config):
             'blink_symbol_level': '0',
         })
 
+    # Profile guided optimization, see pgo()
+    if config.pgo_phase == 1:
+        gn_args['chrome_pgo_phase'] = '1'
+    elif config.pgo_profile:
+        gn_args.update({
+            'chrome_pgo_phase': '2',
+            'pgo_data_path': '"' + os.path.abspath(config.pgo_profile) + '"',
+        })
+
     # CC Wrapper
     if config.cc_wrapper is not None:
         gn_args.update({
             'cc_wrapper': '"' + config.cc_wrapper + '"',
         })
 
+    # Limit parallel links to what fits in memory, shared between all configurations built at once
+    if config.auto_jobs or config.matrix:
+        profile = ResourceProfile(get_output_subfolder(config), config.debug)
+        links = plan_concurrent_links(profile) // max(1, len(config.matrix))
+        gn_args['concurrent_links'] = str(max(1, links))
+
     # Command line override
     gn_args.update(config.gn_args)
 
+    return gn_args
+
+
+def write_gn_args(config):
+    """
+    Create the output folder and write args.gn. Returns the assembled GN args string.
+    """
+    # Create output folder if not exist
+    output_src_path = os.path.join(SRC_DIR, config.output_base_dir, get_output_subfolder(config))
+    if os.path.exists(output_src_path):
+        if not os.path.isdir(output_src_path):
+            os.remove(output_src_path)
+    os.makedirs(output_src_path, exist_ok=True)
+
     # Assemble args
     gn_args_str = ""
     delimiter = ' ' if config.direct_download else '\n'
-    for k, v in gn_args.items():
+    for k, v in get_gn_args(config).items():
         gn_args_str += '='.join([k, v]) + delimiter
 
-    # Add depot_tools to env
+    if not config.direct_download:
+        # Do not use --args. It requires all double quotes be escaped.
+        # Leave an identical args.gn alone, a newer mtime makes ninja regenerate the whole build graph.
+        args_file = os.path.join(output_src_path, 'args.gn')
+        if os.path.exists(args_file):
+            with open(args_file, 'r', encoding='utf-8') as f:
+                if f.read() == gn_args_str:
+                    return gn_args_str
+        with open(args_file, 'w', encoding='utf-8') as f:
+            f.write(gn_args_str)
+    return gn_args_str
+
+
+def gn_gen_needed(output_src_path, gn_args):
+    """
+    Check whether gn gen has to run. It can be skipped if it already succeeded with the same
+    effective args and build.ninja is newer than args.gn. Changes to BUILD.gn files are
+    picked up by ninja itself, which re-runs gn when they change.
+    """
+    build_ninja = os.path.join(output_src_path, 'build.ninja')
+    args_file = os.path.join(output_src_path, 'args.gn')
+    stamp_file = os.path.join(output_src_path, GN_ARGS_STAMP_FILE)
+    if not os.path.exists(build_ninja) or not os.path.exists(stamp_file) or not os.path.exists(args_file):
+        return True
+    if os.path.getmtime(build_ninja) < os.path.getmtime(args_file):
+        return True
+    with open(args_file, 'r', encoding='utf-8') as f:
+        current = normalize_gn_args(parse_gn_flags(f.readlines()))
+    with open(stamp_file, 'r', encoding='utf-8') as f:
+        stamp = f.read().strip()
+    expected = fingerprint(normalize_gn_args(gn_args))
+    return current != normalize_gn_args(gn_args) or stamp != expected
+
+
+def depot_tools_env():
+    """
+    Copy environment of current process and add depot_tools to PATH.
+    """
     depot_tools_path = os.path.join(os.getcwd(), 'depot_tools')
     if not os.path.exists(depot_tools_path) or not os.path.isdir(depot_tools_path):
         raise FileNotFoundError("Cannot find depot_tools!")
     _env = os.environ.copy()
     _env["PATH"] = depot_tools_path + ":" + _env["PATH"]
+    return _env
+
+
+def get_targets(target_os):
+    """
+    Ninja targets built for a target OS.
+    """
+    if target_os == 'linux':
+        return ['chrome', 'chrome_sandbox', 'chromedriver']
+    elif target_os == 'android':
+        return ['chrome_modern_public_bundle']
+    else:
+        raise AttributeError("Target OS not supported")
+
+
+def gn_gen(config):
+    """
+    Write args.gn and run GN for a configuration.
+    Returns the stamp inputs of the build, or None if the build is up to date.
+    """
+    output_subfolder = get_output_subfolder(config)
+    output_path = os.path.join(config.output_base_dir, output_subfolder)
+    output_src_path = os.path.join(SRC_DIR, config.output_base_dir, output_subfolder)
+    gn_args_str = write_gn_args(config)
+
+    # Skip the build if nothing it depends on changed since the last successful one
+    manifest = StampManifest()
+    stage = 'build:' + output_subfolder
+    gn_args = get_gn_args(config)
+    inputs = {
+        'versions': version_inputs(),
+        'tree': fingerprint(manifest.stages.get('prepare', {}).get('inputs')),
+        'gn_args': fingerprint(gn_args),
+        'config': fingerprint({'direct_download': config.direct_download,
+                               'output_base_dir': config.output_base_dir}),
+    }
+    if config.force:
+        reason = 'forced'
+    elif not os.path.exists(os.path.join(output_src_path, 'build.ninja')):
+        reason = 'no build.ninja in output directory'
+    else:
+        fresh, reason = manifest.check(stage, inputs)
+        if fresh:
+            manifest.skip(stage, reason)
+            return None
+    manifest.begin(stage, reason)
+
+    _env = depot_tools_env()
 
     # Run GN
     if config.direct_download:
         sp.check_call([
             os.path.join(SRC_DIR, 'tools', 'gn', 'bootstrap', 'bootstrap.py'),
             "--gn-gen-args='" + gn_args_str + "'"])
-    else:
-        # Do not use --args. It requires all double quotes be escaped.
-        with open(os.path.join(output_src_path, 'args.gn'), 'w', encoding='utf-8') as f:
-            f.write(gn_args_str)
+    elif gn_gen_needed(output_src_path, gn_args):
         sp.check_call(['gn', 'gen', output_path, '--fail-on-unused-args'], cwd=SRC_DIR, env=_env)
+        with open(os.path.join(output_src_path, GN_ARGS_STAMP_FILE), 'w', encoding='utf-8') as f:
+            f.write(fingerprint(normalize_gn_args(gn_args)))
+    else:
+        logging.info("GN args unchanged, skipping gn gen.")
+    return inputs
+
+
+def get_compiler_cache(config):
+    """
+    Managed ccache for the build, or None unless cc_wrapper is ccache.
+    """
+    if config.cc_wrapper is None or os.path.basename(config.cc_wrapper) != 'ccache':
+        return None
+    return CompilerCache(chromium_version, SRC_DIR, config.ccache_dir, config.ccache_size)
+
+
+def get_thinlto_cache(config):
+    """
+    Managed ThinLTO cache of the configuration, or None for debug builds, builds without
+    ThinLTO and if disabled with --thinlto-cache-size 0.
+    """
+    if config.debug or not config.thinlto_cache_size or config.gn_args.get('use_thin_lto') == 'false':
+        return None
+    return ThinLTOCache(chromium_version, get_output_subfolder(config), config.thinlto_cache_dir,
+                        config.thinlto_cache_size, config.thinlto_cache_max_age)
+
+
+def run_ninja(config, inputs, load_limit=None, share=1.0):
+    """
+    Run ninja for a configuration prepared by gn_gen and record the result.
+    load_limit is passed to ninja -l, so that several ninja processes can share the machine.
+    With --jobs auto, share is the fraction of the available memory planned for this build.
+    """
+    output_subfolder = get_output_subfolder(config)
+    output_path = os.path.join(config.output_base_dir, output_subfolder)
+    output_src_path = os.path.join(SRC_DIR, config.output_base_dir, output_subfolder)
+    _env = depot_tools_env()
+    cache = get_compiler_cache(config)
+    if cache is not None:
+        cache.prepare()
+        _env.update(cache.env())
+        cache_stats = cache.stats()
+    thinlto = get_thinlto_cache(config)
+    if thinlto is not None:
+        thinlto.link(output_src_path)
+        thinlto_before = thinlto.begin()
+
+    progress = None
+    if config.progress:
+        progress = BuildProgress(output_subfolder, output_src_path, progress_sink(config.progress))
+        _env.update(progress.env())
 
     # Run ninja
-    if config.target_os == 'linux':
-        targets = ['chrome', 'chrome_sandbox', 'chromedriver']
-    elif config.target_os == 'android':
-        targets = ['chrome_modern_public_bundle']
+    targets = get_targets(config.target_os)
+    extra_args = ['-l', str(load_limit)] if load_limit else []
+    if config.auto_jobs:
+        profile = ResourceProfile(output_subfolder, config.debug)
+        run_ninja_adaptive(lambda jobs: ['autoninja', '-j', str(jobs), *extra_args, '-C', output_path, *targets],
+                           plan_jobs(profile, share), profile, progress, cwd=SRC_DIR, env=_env)
+    elif progress is not None:
+        run_with_progress(['autoninja', '-j', str(config.num_jobs), *extra_args, '-C', output_path, *targets],
+                          progress, cwd=SRC_DIR, env=_env)
     else:
-        raise AttributeError("Target OS not supported")
-    sp.check_call(['autoninja', '-j', str(config.num_jobs), '-C', output_path,
-        *targets], cwd=SRC_DIR, env=_env)
+        sp.check_call(['autoninja', '-j', str(config.num_jobs), *extra_args, '-C', output_path,
+            *targets], cwd=SRC_DIR, env=_env)
+
+    StampManifest().complete('build:' + output_subfolder, inputs)
+
+    # Post-build analysis of .ninja_log
+    # The args the build ran with, get_gn_args() now sees the updated scheduler profile
+    analyze_ninja_log(output_src_path, chromium_version, inputs['gn_args'])
+    if cache is not None:
+        cache.report(cache_stats, output_src_path)
+    if thinlto is not None:
+        thinlto.report(thinlto_before)
+        thinlto.prune()
+
+
+def build(config):
+    """
+    Run build for given targets.
+    """
+    if config.matrix:
+        build_matrix(config)
+        return
+    inputs = gn_gen(config)
+    if inputs is not None:
+        run_ninja(config, inputs)
+
+
+def get_chrome_binary(config):
+    return os.path.join(SRC_DIR, config.output_base_dir, get_output_subfolder(config), 'chrome')
+
+
+def pgo(config):
+    """
+    Generate a PGO profile from our own sources and build with it. An instrumented build goes
+    to a separate output folder, runs the workload pages in headless mode and its raw profiles
+    are merged with llvm-profdata. The configuration is then built with the profile as
+    pgo_data_path, and the workload times are compared with the binary it replaces.
+    Only for linux release builds, the workload runs on this machine.
+    """
+    if config.target_os != 'linux' or config.debug or config.matrix:
+        raise RuntimeError("PGO profiles can only be generated for a single linux release build.")
+    pages = load_workload(config.pgo_workload)
+    llvm_profdata = find_llvm_profdata(SRC_DIR)
+
+    # Phase 1: instrumented build and workload run
+    instrumented = copy.copy(config)
+    instrumented.pgo_phase = 1
+    instrumented.pgo_profile = None
+    build(instrumented)
+    profraw_dir = os.path.abspath(os.path.join(PGO_DIR, 'profraw'))
+    shutil.rmtree(profraw_dir, ignore_errors=True)
+    os.makedirs(profraw_dir)
+    logging.info("PGO: running %d workload pages under the instrumented build.", len(pages))
+    env = dict(os.environ, LLVM_PROFILE_FILE=os.path.join(profraw_dir, 'chrome-%p-%m.profraw'))
+    run_workload(get_chrome_binary(instrumented), pages, time_budget=config.pgo_page_time, env=env)
+    profile = merge_profiles(llvm_profdata, profraw_dir, PGO_DIR)
+    shutil.rmtree(profraw_dir)
+
+    # Time the binary about to be replaced, then phase 2
+    baseline = None
+    chrome = get_chrome_binary(config)
+    if os.path.exists(chrome):
+        logging.info("PGO: timing the current build.")
+        baseline = run_workload(chrome, pages, runs=config.pgo_runs, time_budget=config.pgo_page_time)
+    optimized_config = copy.copy(config)
+    optimized_config.pgo_profile = profile
+    build(optimized_config)
+    logging.info("PGO: timing the optimized build.")
+    optimized = run_workload(chrome, pages, runs=config.pgo_runs, time_budget=config.pgo_page_time)
+
+    report = compare_workloads(baseline, optimized)
+    report.update({'chromium_version': chromium_version, 'profile': profile, 'runs': config.pgo_runs})
+    write_pgo_report(PGO_REPORT_FILE, report)
+    logging.info("PGO: pass --pgo-profile %s to use the profile in later builds.", profile)
+
+
+def package_build(config):
+    """
+    Package the build of a configuration into DIST_DIR, unless it is already packaged.
+    """
+    output_subfolder = get_output_subfolder(config)
+    manifest = StampManifest()
+    stage = 'package:' + output_subfolder
+    build_stamp = manifest.stages.get('build:' + output_subfolder, {})
+    if not build_stamp.get('complete'):
+        raise RuntimeError("No complete build of {}, run build first.".format(output_subfolder))
+    name = 'ungoogled-chromium_{}_{}'.format(chromium_version, output_subfolder)
+    compression = config.compression or default_compression()
+    inputs = {
+        'build': fingerprint(build_stamp.get('inputs')),
+        'config': fingerprint({'compression': compression}),
+    }
+    if config.force:
+        reason = 'forced'
+    elif not os.path.exists(os.path.join(DIST_DIR, name + '.manifest.json')):
+        reason = 'no package in ' + DIST_DIR
+    else:
+        fresh, reason = manifest.check(stage, inputs)
+        if fresh:
+            manifest.skip(stage, reason)
+            return
+    manifest.begin(stage, reason)
+
+    metadata = {'chromium_version': chromium_version, 'target_os': config.target_os,
+                'target_cpu': config.target_cpu}
+    package_output(os.path.join(SRC_DIR, config.output_base_dir, output_subfolder), DIST_DIR, name,
+                   get_targets(config.target_os), SRC_DIR, compression, config.num_jobs, metadata,
+                   suffix='_' + output_subfolder)
+    manifest.complete(stage, inputs)
+
+
+def package(config):
+    """
+    Package the builds of the selected configurations: binaries are stripped with their debug
+    info split off in parallel, then compressed with multi-threaded zstd or xz. Each package
+    comes with a manifest of per-file sha256 hashes.
+    """
+    for entry in matrix_configs(config):
+        package_build(entry)
+
+
+def matrix_configs(config):
+    """
+    Configurations selected by --matrix, or config itself without it.
+    """
+    if not config.matrix:
+        return [config]
+    configs = []
+    for target_os, target_cpu, debug in config.matrix:
+        entry = copy.copy(config)
+        entry.target_os = target_os
+        entry.target_cpu = target_cpu
+        entry.debug = debug
+        configs.append(entry)
+    return configs
+
+
+def build_matrix(config):
+    """
+    Build every (target_os, target_cpu, debug) entry of config.matrix in one invocation.
+    GN runs for all entries in parallel, then all ninja processes run at once. ninja -l keeps
+    their combined load near the CPU count, and concurrent_links is split between them. With
+    --jobs auto, the memory jobs are planned for is split too, and only one ninja at a time
+    backs off when memory runs low.
+    """
+    configs = matrix_configs(config)
+    with ThreadPoolExecutor(max_workers=len(configs)) as executor:
+        inputs = list(executor.map(gn_gen, configs))
+
+    pending = [(c, i) for c, i in zip(configs, inputs) if i is not None]
+    if not pending:
+        return
+    load_limit = available_cpus()
+    with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+        futures = [executor.submit(run_ninja, c, i, load_limit, 1 / len(pending)) for c, i in pending]
+        errors = []
+        for c, future in zip(pending, futures):
+            try:
+                future.result()
+            except Exception as e:
+                logging.error("Build of %s failed: %s", get_output_subfolder(c[0]), e)
+                errors.append(e)
+    if errors:
+        raise errors[0]
+
+
+def run_all(config):
+    """
+    Run init, sync, prepare, build and package as a pipeline. Independent steps overlap, and
+    a failed run resumes from the first step that did not complete.
+    """
+    key = fingerprint([version_inputs(), config.target_os, config.target_cpu, config.debug,
+                       config.shallow, config.direct_download, config.output_base_dir, config.gn_args])
+    pipeline = Pipeline(key)
+    if config.force:
+        pipeline.reset()
+
+    pipeline.add('init', lambda: init(config))
+    pipeline.add('sync', lambda: sync(config), deps=['init'])
+    pipeline.add('checkout', lambda: checkout_ungoogled(config))
+    # sync --reset runs git clean on src, which would remove the output folder
+    pipeline.add('gn_args', lambda: write_gn_args(config),
+                 deps=['sync' if config.reset else 'init', 'checkout'])
+    pipeline.add('prepare', lambda: prepare(config, checkout=False), deps=['sync', 'checkout'])
+    pipeline.add('build', lambda: build(config), deps=['prepare', 'gn_args'])
+    pipeline.add('package', lambda: package(config), deps=['build'])
+    pipeline.run()
 
 
 if __name__ == "__main__":
@@ -356,6 +1190,9 @@ if __name__ == "__main__":
 
     parser.add_argument('-a', '--arch', type=str, default=ARCH[3], choices=ARCH,
                         help='arch can be one of ' + '|'.join(ARCH))
+    parser.add_argument('-j', '--jobs', type=str,
+                        help="Number of parallel jobs, defaults to the number of CPUs. 'auto' derives jobs and "
+                             "concurrent_links from cgroup limits, available memory and previous builds")
     parser.add_argument('-g', '--gn-args', type=str,
                         help='GN build arguments override in the format of key1=value1;key2=value2;')
     parser.add_argument('-o', '--output-dir', type=str, default=OUTPUT_BASE_DIR,
@@ -364,9 +1201,26 @@ if __name__ == "__main__":
     parser.add_argument('-s', '--os', type=str, default=OS[0], choices=OS,
                         help='OS can be one of: ' + '|'.join(OS))
     parser.add_argument('--cc_wrapper', type=str,
-                        help='Set cc_wrapper for build.')
+                        help='Set cc_wrapper for build. ccache is managed: one cache per chromium milestone, '
+                             'shared between workspaces')
+    parser.add_argument('--ccache-dir', type=str, default=os.environ.get('CCACHE_ROOT', CCACHE_DIR),
+                        help='Folder of the managed ccache caches. Defaults to $CCACHE_ROOT or ' + CCACHE_DIR)
+    parser.add_argument('--ccache-size', type=parse_size, default='50G',
+                        help='Size limit of all managed ccache caches together')
+    parser.add_argument('--thinlto-cache-dir', type=str,
+                        default=os.environ.get('THINLTO_CACHE_ROOT', THINLTO_CACHE_DIR),
+                        help='Folder of the managed ThinLTO caches of release builds. Defaults to $THINLTO_CACHE_ROOT '
+                             'or ' + THINLTO_CACHE_DIR)
+    parser.add_argument('--thinlto-cache-size', type=parse_size, default='40G',
+                        help='Size limit of all managed ThinLTO caches together, 0 disables the cache. The cache in use '
+                             'is pruned by the policy chromium passes to lld')
+    parser.add_argument('--thinlto-cache-max-age', type=int, default=14,
+                        help='Days after which an unused entry of a ThinLTO cache not in use is removed')
     parser.add_argument('--debug', action='store_true',
                         help='Build debug builds')
+    parser.add_argument('--matrix', type=parse_matrix,
+                        help='Build several configurations at once, as a comma separated list of os:arch[:debug], '
+                             'e.g. android:arm64,android:x86,linux:x64:debug')
     parser.add_argument('--install-build-deps', action='store_true',
                         help="Run chromium's install-build-deps(-android).sh during sync")
 
@@ -375,9 +1229,46 @@ if __name__ == "__main__":
                        help='Use source from https://commondatastorage.googleapis.com/chromium-browser-official')
     group.add_argument('--shallow', action='store_true',
                        help='Do not clone git history for chromium source')
+    parser.add_argument('--source-url', type=str, default=SOURCE_URL,
+                        help='Source tarball for --direct-download, {version} is replaced by the chromium version')
 
     parser.add_argument('--reset', action='store_true',
                        help='Reset chromium source for sync')
+    parser.add_argument('--git-cache', type=str, default=os.environ.get('GIT_CACHE_PATH'),
+                        help='Shared folder of git mirrors used by clones and as gclient cache_dir. '
+                             'Defaults to $GIT_CACHE_PATH')
+    parser.add_argument('--cache-max-age', type=int, default=30,
+                        help="Days after which the 'cache' command removes an unused git mirror")
+    parser.add_argument('--exclude-list', type=str, action='append', default=[], metavar='FILE',
+                        help='File of paths (exact, folder/ or glob) to keep out of pruning and domain '
+                             'substitution. Can be given several times')
+    parser.add_argument('--fused-prepare', action='store_true',
+                        help='For Android, prune, patch and substitute in a single pass over the source tree')
+    parser.add_argument('--pgo-workload', type=str, default=PGO_WORKLOAD_DIR,
+                        help='For pgo, folder of local HTML pages and benchmarks, or a file listing them')
+    parser.add_argument('--pgo-runs', type=int, default=3,
+                        help='For pgo, number of times each page is timed for the report')
+    parser.add_argument('--pgo-page-time', type=int, default=5000,
+                        help='For pgo, virtual time in ms each page gets to run its scripts')
+    parser.add_argument('--pgo-profile', type=str, metavar='FILE',
+                        help='Build with this PGO profile (chrome_pgo_phase=2), e.g. one made by the pgo command')
+    parser.add_argument('--compression', type=str, choices=sorted(COMPRESSORS),
+                        help='For package, compressor of the artifacts. Defaults to zstd if installed, else xz')
+    parser.add_argument('--progress', type=str, metavar='FILE',
+                        help='Write build progress with a predicted finish time as JSON lines to FILE, '
+                             'or to a unix socket given as unix:PATH')
+    parser.add_argument('--trace', type=str, metavar='FILE',
+                        help='Write timing of every step and subprocess to FILE in Chrome trace-event format')
+    parser.add_argument('--stale', action='store_true',
+                        help='For clean, only remove output folders of configurations other than the selected ones '
+                             'and outputs the selected builds no longer produce')
+    parser.add_argument('--wait', action='store_true',
+                        help='For clean, delete files before returning instead of in the background')
+    parser.add_argument('--force', action='store_true',
+                        help='Run prepare and build even if their inputs are unchanged since the last run')
+    parser.add_argument('--verify', action='store_true',
+                        help='For upgrade, compare the result with a from-scratch prepare of all listed and '
+                             'patched files')
 
     args = parser.parse_args()
     logger.debug('args: %s', args)
@@ -385,13 +1276,29 @@ if __name__ == "__main__":
     config = Config(args)
     logger.debug('config: %s', config)
 
-    if args.command == 'init':
-        init(config)
-    elif args.command == 'sync':
-        sync(config)
-    elif args.command == 'prepare':
-        prepare(config)
-    elif args.command == 'build':
-        build(config)
-    elif args.command == 'clean':
-        clean(config)
+    if args.trace:
+        enable_tracing(args.trace)
+
+    try:
+        if args.command == 'init':
+            init(config)
+        elif args.command == 'sync':
+            sync(config)
+        elif args.command == 'prepare':
+            prepare(config)
+        elif args.command == 'build':
+            build(config)
+        elif args.command == 'clean':
+            clean(config)
+        elif args.command == 'all':
+            run_all(config)
+        elif args.command == 'cache':
+            cache(config)
+        elif args.command == 'upgrade':
+            upgrade(config)
+        elif args.command == 'pgo':
+            pgo(config)
+        elif args.command == 'package':
+            package(config)
+    finally:
+        write_trace()
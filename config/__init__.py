@@ -1,3 +1,22 @@
 from .constants import *
 from .versions import *
 from .utils import *
+from .stamps import *
+from .patches import *
+from .domsub import *
+from .pipeline import *
+from .tracing import *
+from .ninja_log import *
+from .progress import *
+from .scheduler import *
+from .git_cache import *
+from .download import *
+from .snapshot import *
+from .trash import *
+from .ccache import *
+from .prune import *
+from .upgrade import *
+from .submodules import *
+from .thinlto import *
+from .pgo import *
+from .package import *
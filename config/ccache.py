@@ -0,0 +1,147 @@
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+from config import tracing as sp
+from config.constants import CCACHE_DIR
+from config.ninja_log import latest_compile_durations
+
+_USAGE_FILE = 'usage.json'
+# A family never gets less than this, even if older families fill the limit
+_MIN_FAMILY_SIZE = 1 << 30
+_HIT_COUNTERS = ('direct_cache_hit', 'preprocessed_cache_hit')
+_MISS_COUNTERS = ('cache_miss',)
+_lock = threading.Lock()
+
+
+def version_family(version):
+    """
+    Cache family of a chromium version. Point releases of a milestone share most objects.
+    """
+    return version.split('.')[0]
+
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_blocks * 512
+            except OSError:
+                pass
+    return total
+
+
+class CompilerCache:
+    """
+    ccache directories under root, one per chromium version family. Paths are made relative
+    to the source tree, so workspaces at different locations share hits. The total size is
+    kept under max_size by removing the least recently used families, and the current family
+    is limited to what is left.
+    """
+
+    def __init__(self, version, source_dir, root=CCACHE_DIR, max_size=50 << 30):
+        self.root = os.path.abspath(os.path.expanduser(root))
+        self.family = version_family(version)
+        self.path = os.path.join(self.root, self.family)
+        self.source_dir = os.path.abspath(source_dir)
+        self.max_size = max_size
+        self.family_size = max_size
+        self.available = shutil.which('ccache') is not None
+
+    def env(self):
+        """
+        Environment variables that make compiles use this cache.
+        """
+        return {
+            'CCACHE_DIR': self.path,
+            'CCACHE_BASEDIR': self.source_dir,
+            # The working directory is the output folder, which differs between workspaces
+            'CCACHE_NOHASHDIR': '1',
+            # Toolchain binaries are downloaded by gclient, their mtime says nothing
+            'CCACHE_COMPILERCHECK': 'content',
+            'CCACHE_SLOPPINESS': 'time_macros,include_file_mtime,include_file_ctime',
+            'CCACHE_MAXSIZE': '{}k'.format(self.family_size >> 10),
+        }
+
+    def _usage(self):
+        path = os.path.join(self.root, _USAGE_FILE)
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except (OSError, ValueError):
+                pass
+        return {}
+
+    def prepare(self):
+        """
+        Create the cache of the current family, evict old families and set the size limit.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        with _lock:
+            usage = self._usage()
+            usage[self.family] = time.time()
+            families = sorted((d for d in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, d))),
+                              key=lambda d: usage.get(d, 0))
+            sizes = {d: _dir_size(os.path.join(self.root, d)) for d in families if d != self.family}
+            others = sum(sizes.values())
+            for name in families:
+                if name == self.family or others + _MIN_FAMILY_SIZE <= self.max_size:
+                    continue
+                logging.info("ccache: removing family %s (%.1f GiB) to stay under %.1f GiB.",
+                             name, sizes[name] / (1 << 30), self.max_size / (1 << 30))
+                shutil.rmtree(os.path.join(self.root, name))
+                others -= sizes[name]
+                usage.pop(name, None)
+            self.family_size = max(_MIN_FAMILY_SIZE, self.max_size - others)
+            path = os.path.join(self.root, _USAGE_FILE)
+            with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(usage, f, indent=2, sort_keys=True)
+            os.replace(path + '.tmp', path)
+
+    def stats(self):
+        """
+        Counters of the cache as a dict, or None if ccache cannot print them (ccache < 4).
+        """
+        if not self.available:
+            return None
+        result = sp.run(['ccache', '--print-stats'], env=dict(os.environ, **self.env()),
+                        encoding='utf8', capture_output=True)
+        if result.returncode != 0:
+            return None
+        stats = {}
+        for line in result.stdout.splitlines():
+            name, _, value = line.partition('\t')
+            if value.strip().isdigit():
+                stats[name] = int(value)
+        return stats
+
+    def report(self, before, output_dir):
+        """
+        Log hits and misses since the before stats and estimate the compile time saved, using the
+        compile durations ninja recorded: the slowest compiles are taken as the misses.
+        Returns the report as a dict, or None if there are no stats.
+        """
+        after = self.stats()
+        if before is None or after is None:
+            logging.info("ccache: statistics need ccache 4 or newer.")
+            return None
+        hits = sum(after.get(c, 0) - before.get(c, 0) for c in _HIT_COUNTERS)
+        misses = sum(after.get(c, 0) - before.get(c, 0) for c in _MISS_COUNTERS)
+        report = {'family': self.family, 'hits': hits, 'misses': misses, 'saved_ms': 0,
+                  'hit_rate': hits / (hits + misses) if hits + misses else 0.0}
+
+        durations = sorted(latest_compile_durations(output_dir))
+        if hits and misses and len(durations) >= hits + misses:
+            miss_durations = durations[-misses:]
+            hit_durations = durations[:hits]
+            mean_miss = sum(miss_durations) / len(miss_durations)
+            report['saved_ms'] = int(max(0, hits * mean_miss - sum(hit_durations)))
+
+        logging.info("ccache: %d hits, %d misses (%.0f%% hit rate), about %.0f min of compile time saved.",
+                     hits, misses, 100 * report['hit_rate'], report['saved_ms'] / 60000)
+        return report
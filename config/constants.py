@@ -1,11 +1,30 @@
 import os
 
 ARCH = ('arm', 'arm64', 'x86', 'x64')
-COMMAND = ('init', 'sync', 'prepare', 'build', 'clean')
+COMMAND = ('init', 'sync', 'prepare', 'build', 'clean', 'all', 'cache', 'upgrade', 'pgo', 'package')
 OS = ('linux', 'android')
 
 SRC_DIR = "src"
 OUTPUT_BASE_DIR = "out"
+STAMP_FILE = ".stamps.json"
+PIPELINE_STATE_FILE = ".pipeline_state.json"
+NINJA_HISTORY_FILE = ".ninja_history.sqlite"
+SCHEDULER_PROFILE_FILE = ".scheduler_profile.json"
+GN_ARGS_STAMP_FILE = ".gn_args.stamp"
+SNAPSHOT_DIR = "src.pristine"
+PRUNE_INDEX_FILE = ".prune_index.json"
+PATCH_SCRATCH_DIR = ".patch_scratch"
+PATCH_REPORT_FILE = "patch_report.json"
+PREPARED_DIR = ".prepared"
+UPGRADE_VERIFY_DIR = ".upgrade_verify"
+PGO_DIR = "pgo"
+PGO_WORKLOAD_DIR = os.path.join(PGO_DIR, "workload")
+PGO_REPORT_FILE = os.path.join(PGO_DIR, "pgo_report.json")
+DIST_DIR = "dist"
+TRASH_DIR = ".trash"
+CCACHE_DIR = os.path.join("~", ".cache", "ungoogled-chromium-build", "ccache")
+THINLTO_CACHE_DIR = os.path.join("~", ".cache", "ungoogled-chromium-build", "thinlto")
+SOURCE_URL = "https://commondatastorage.googleapis.com/chromium-browser-official/chromium-{version}.tar.xz"
 
 GCLIENT_CONFIG = """solutions = [
   {
@@ -22,9 +41,11 @@ GCLIENT_CONFIG = """solutions = [
       "src/chrome/tools/test/reference_build/chrome_win": None
     },
     "custom_vars": {
-      "checkout_pgo_profiles": False
+      "checkout_pgo_profiles": False,
+      "checkout_clang_coverage_tools": True
     }
   },
 ]
 target_os = [ @@TARGET_OS@@ ]
+cache_dir = @@CACHE_DIR@@
 """
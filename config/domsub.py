@@ -0,0 +1,263 @@
+import io
+import logging
+import mmap
+import multiprocessing as mp
+import os
+import re
+import tarfile
+import zlib
+
+from config.tracing import trace_span
+
+# Kept compatible with ungoogled-chromium's utils/domain_substitution.py so that
+# its revert command accepts caches produced here.
+TREE_ENCODINGS = ('UTF-8', 'ISO-8859-1')
+_INDEX_LIST = 'cache_index.list'
+_INDEX_HASH_DELIMITER = '|'
+_ORIG_DIR = 'orig'
+_PATTERN_REPLACE_DELIM = '#!'
+# Delta applied to timestamps of substituted files, in nanoseconds
+_TIMESTAMP_DELTA = 1 * 10 ** 9
+
+_REGEX_META = '.^$*+?{}[]\\|()'
+
+# Per worker process state, set by _init_worker
+_rules = None
+
+
+class DomainRules:
+    """
+    Compiled domain_regex.list rules.
+    """
+
+    def __init__(self, pairs):
+        self.pairs = [(re.compile(p), r) for p, r in pairs]
+        # All rules in one pattern. A file that does not match it cannot be changed by any rule.
+        try:
+            self.combined = re.compile('|'.join('(?:{})'.format(p) for p, _ in pairs))
+        except re.error:
+            self.combined = None
+        # Literal prefixes every match must start with, used to reject files before decoding
+        literals = [_literal_prefix(p) for p, _ in pairs]
+        if literals and all(literals):
+            literals = sorted(set(literals), key=len)
+            self.literals = [l for i, l in enumerate(literals) if not any(s in l for s in literals[:i])]
+        else:
+            self.literals = None
+
+    def may_match(self, buf):
+        if self.literals is None:
+            return True
+        return any(buf.find(l) != -1 for l in self.literals)
+
+    def substitute(self, content):
+        if self.combined is not None and self.combined.search(content) is None:
+            return content, 0
+        total = 0
+        for pattern, replacement in self.pairs:
+            content, count = pattern.subn(replacement, content)
+            total += count
+        return content, total
+
+
+def load_domain_regex(regex_path):
+    """
+    Load domain_regex.list into a list of (pattern, replacement) tuples.
+    """
+    with open(regex_path, 'r', encoding='utf-8') as f:
+        lines = [l for l in f.read().splitlines() if l]
+    pairs = []
+    for line in lines:
+        pattern, replacement = line.split(_PATTERN_REPLACE_DELIM)
+        pairs.append((pattern, replacement))
+    return pairs
+
+
+def _literal_prefix(pattern):
+    """
+    Return the ASCII bytes every match of pattern starts with, or b'' if it cannot be determined.
+    """
+    if '|' in pattern:
+        return b''
+    literal = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        step = 1
+        if c == '\\':
+            if i + 1 >= len(pattern) or pattern[i + 1].isalnum():
+                break
+            c = pattern[i + 1]
+            step = 2
+        elif c in _REGEX_META:
+            break
+        quantifier = pattern[i + step:i + step + 1]
+        if quantifier and quantifier in '*?{':
+            break
+        literal.append(c)
+        if quantifier == '+':
+            break
+        i += step
+    try:
+        return ''.join(literal).encode('ascii')
+    except UnicodeEncodeError:
+        return b''
+
+
+def _init_worker(pairs):
+    global _rules
+    _rules = DomainRules(pairs)
+
+
+def _substitute_file(item):
+    """
+    Substitute a single file in place.
+    Returns (relative_path, status, crc32 of new content, original content).
+    """
+    source_tree, relative_path = item
+    path = os.path.join(source_tree, relative_path)
+    if os.path.islink(path):
+        return relative_path, 'symlink', None, None
+    if not os.path.exists(path):
+        return relative_path, 'missing', None, None
+
+    with open(path, 'r+b') as f:
+        stats = os.fstat(f.fileno())
+        if stats.st_size == 0:
+            return relative_path, 'unchanged', None, None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if not _rules.may_match(mm):
+                return relative_path, 'unchanged', None, None
+            original = mm[:]
+
+        content = None
+        for encoding in TREE_ENCODINGS:
+            try:
+                content = original.decode(encoding)
+                break
+            except UnicodeDecodeError:
+                continue
+        if content is None:
+            raise ValueError('Unable to decode with any encoding: %s' % path)
+
+        content, count = _rules.substitute(content)
+        if count == 0:
+            return relative_path, 'unchanged', None, None
+
+        substituted = content.encode(encoding)
+        if stats.st_nlink > 1:
+            # Shared with a source snapshot, write a new file instead of changing both
+            tmp_path = path + '.domsub.tmp'
+            with open(tmp_path, 'wb') as tmp:
+                tmp.write(substituted)
+            os.chmod(tmp_path, stats.st_mode & 0o7777)
+            os.replace(tmp_path, path)
+        else:
+            f.seek(0)
+            f.write(substituted)
+            f.truncate()
+
+    os.utime(path, ns=(stats.st_atime_ns + _TIMESTAMP_DELTA, stats.st_mtime_ns + _TIMESTAMP_DELTA))
+    return relative_path, 'substituted', zlib.crc32(substituted), original
+
+
+def _read_lists(files_paths):
+    paths = []
+    seen = set()
+    for files_path in files_paths:
+        with open(files_path, 'r', encoding='utf-8') as f:
+            for l in f.read().splitlines():
+                if l and l not in seen:
+                    seen.add(l)
+                    paths.append(l)
+    for p in paths:
+        if _INDEX_HASH_DELIMITER in p:
+            raise ValueError('Path "{}" contains the file index hash delimiter "{}"'.format(
+                p, _INDEX_HASH_DELIMITER))
+    return paths
+
+
+def _add_bytes(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def apply_domain_substitution(regex_path, files_path, source_tree, cache_path=None, jobs=None):
+    """
+    Apply domain substitution to the files listed in files_path using a process pool.
+    files_path can be a single list file or a sequence of list files, which are merged in order.
+    If cache_path is given, write a cache in the format of ungoogled-chromium's
+    domain_substitution.py so that its revert command can undo the substitution.
+    Returns a dict of counts per file status.
+    """
+    if cache_path is not None and os.path.exists(cache_path):
+        raise FileExistsError(cache_path)
+    pairs = load_domain_regex(regex_path)
+    if isinstance(files_path, str):
+        files_path = [files_path]
+    relative_paths = _read_lists(files_path)
+    source_tree = os.path.abspath(source_tree)
+    jobs = jobs or mp.cpu_count()
+    chunksize = max(1, min(256, len(relative_paths) // (jobs * 8) or 1))
+
+    counts = {'substituted': 0, 'unchanged': 0, 'missing': 0, 'symlink': 0}
+    index = io.BytesIO()
+    tar = tarfile.open(cache_path, 'w:gz', compresslevel=1) if cache_path is not None else None
+    try:
+        with trace_span('domain_substitution', files=len(relative_paths)), mp.Pool(jobs, initializer=_init_worker, initargs=(pairs,)) as pool:
+            items = [(source_tree, p) for p in relative_paths]
+            for relative_path, status, crc32, original in pool.imap(_substitute_file, items, chunksize):
+                counts[status] += 1
+                if status == 'missing':
+                    logging.warning('Skipping non-existent path: %s', relative_path)
+                elif status == 'symlink':
+                    logging.warning('Skipping path that has become a symlink: %s', relative_path)
+                elif status == 'substituted' and tar is not None:
+                    index.write('{}{}{:08x}\n'.format(relative_path, _INDEX_HASH_DELIMITER, crc32).encode('utf-8'))
+                    _add_bytes(tar, _ORIG_DIR + '/' + relative_path, original)
+        if tar is not None:
+            _add_bytes(tar, _INDEX_LIST, index.getvalue())
+    except BaseException:
+        if tar is not None:
+            tar.close()
+            os.remove(cache_path)
+        raise
+    if tar is not None:
+        tar.close()
+
+    logging.info('Domain substitution: %d substituted, %d unchanged, %d missing, %d symlinks.',
+                 counts['substituted'], counts['unchanged'], counts['missing'], counts['symlink'])
+    return counts
+
+
+def _read_cache_index(cache):
+    with tarfile.open(cache, 'r:gz') as tar:
+        data = tar.extractfile(_INDEX_LIST).read().decode('utf-8')
+    return dict(line.rpartition(_INDEX_HASH_DELIMITER)[::2] for line in data.splitlines())
+
+
+def merge_domain_substitution_cache(old_cache, new_cache, replaced, output):
+    """
+    Combine two domain substitution caches: entries of old_cache for paths not in replaced
+    or new_cache, then all entries of new_cache. Either cache may be missing. Writes output,
+    which may be one of the inputs.
+    """
+    new_index = _read_cache_index(new_cache) if new_cache and os.path.exists(new_cache) else {}
+    skip = set(replaced) | set(new_index)
+    index = {}
+    tmp_path = output + '.tmp'
+    with tarfile.open(tmp_path, 'w:gz', compresslevel=1) as out:
+        for cache, cache_skip in ((old_cache, skip), (new_cache, ())):
+            if not cache or not os.path.exists(cache):
+                continue
+            with tarfile.open(cache, 'r:gz') as tar:
+                for member in tar:
+                    if member.name == _INDEX_LIST:
+                        index.update((p, c) for p, c in _read_cache_index(cache).items() if p not in cache_skip)
+                    elif member.name.startswith(_ORIG_DIR + '/') \
+                            and member.name[len(_ORIG_DIR) + 1:] not in cache_skip:
+                        out.addfile(member, tar.extractfile(member))
+        _add_bytes(out, _INDEX_LIST, ''.join(
+            '{}{}{}\n'.format(p, _INDEX_HASH_DELIMITER, c) for p, c in index.items()).encode('utf-8'))
+    os.replace(tmp_path, output)
@@ -0,0 +1,356 @@
+import hashlib
+import io
+import json
+import logging
+import lzma
+import os
+import shutil
+import tarfile
+import threading
+import time
+
+import requests
+
+from config import tracing as sp
+from config.tracing import trace_span
+
+_CHUNK_SIZE = 16 << 20
+_READ_SIZE = 1 << 20
+_RETRIES = 5
+_TIMEOUT = 60
+_STATE_FILE = '.download_state.json'
+
+
+def parse_hashes(text, file_name=None, algorithm='sha256'):
+    """
+    Find the digest of file_name in a chromium-browser-official .hashes file, whose lines
+    are '<algorithm>  <digest>  <file name>'. Returns None if there is none.
+    """
+    for line in text.splitlines():
+        parts = line.split()
+        if len(parts) >= 2 and parts[0] == algorithm:
+            if file_name is None or len(parts) < 3 or os.path.basename(parts[2]) == file_name:
+                return parts[1].lower()
+    return None
+
+
+class RangeDownloader:
+    """
+    Downloads a URL with concurrent range requests and hands the chunks out in order.
+    At most window chunks are held in memory. A request that breaks off during the download is
+    retried from the last byte received. Servers without range support are read with a single request.
+    """
+
+    def __init__(self, url, jobs=4, chunk_size=_CHUNK_SIZE, window=None, session=None):
+        self.url = url
+        self.jobs = max(1, jobs)
+        self.chunk_size = chunk_size
+        self.window = window or 2 * self.jobs
+        self.session = session or requests.Session()
+        self.size = None
+        self.ranges = False
+        self._chunks = {}
+        self._next = 0
+        self._claimed = 0
+        self._error = None
+        self._cond = threading.Condition()
+
+    def _probe(self):
+        r = self.session.head(self.url, allow_redirects=True, timeout=_TIMEOUT)
+        r.raise_for_status()
+        length = r.headers.get('Content-Length')
+        self.size = int(length) if length is not None else None
+        self.ranges = self.size is not None and r.headers.get('Accept-Ranges', '').lower() == 'bytes'
+
+    def _get(self, start, end):
+        """
+        Bytes start..end (inclusive) of the URL, retrying from where a broken request stopped.
+        """
+        data = bytearray()
+        for attempt in range(_RETRIES):
+            try:
+                headers = {'Range': 'bytes={}-{}'.format(start + len(data), end)}
+                with self.session.get(self.url, headers=headers, stream=True, timeout=_TIMEOUT) as r:
+                    if r.status_code != 206:
+                        raise requests.HTTPError("Expected partial content for {}, got {}".format(
+                            self.url, r.status_code), response=r)
+                    for block in r.iter_content(_READ_SIZE):
+                        data += block
+                if len(data) == end - start + 1:
+                    return bytes(data)
+                raise requests.ConnectionError("Short read of {} bytes {}-{}".format(self.url, start, end))
+            except requests.RequestException as e:
+                if attempt == _RETRIES - 1:
+                    raise
+                logging.warning("Download of %s bytes %d-%d failed (%s), resuming.",
+                                self.url, start + len(data), end, e)
+                time.sleep(2 ** attempt)
+
+    def _worker(self):
+        count = -(-self.size // self.chunk_size)
+        while True:
+            with self._cond:
+                while self._error is None and self._claimed < count and self._claimed >= self._next + self.window:
+                    self._cond.wait()
+                if self._error is not None or self._claimed >= count:
+                    return
+                index = self._claimed
+                self._claimed += 1
+            start = index * self.chunk_size
+            try:
+                data = self._get(start, min(start + self.chunk_size, self.size) - 1)
+            except BaseException as e:
+                with self._cond:
+                    self._error = self._error or e
+                    self._cond.notify_all()
+                return
+            with self._cond:
+                self._chunks[index] = data
+                self._cond.notify_all()
+
+    def _single(self):
+        """
+        Stream the URL with one request, for servers that do not support ranges.
+        """
+        with self.session.get(self.url, stream=True, timeout=_TIMEOUT) as r:
+            r.raise_for_status()
+            for block in r.iter_content(self.chunk_size):
+                yield block
+
+    def __iter__(self):
+        self._probe()
+        if not self.ranges:
+            logging.info("%s does not support range requests, using a single connection.", self.url)
+            yield from self._single()
+            return
+
+        count = -(-self.size // self.chunk_size)
+        threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(min(self.jobs, count))]
+        for t in threads:
+            t.start()
+        try:
+            while self._next < count:
+                with self._cond:
+                    while self._next not in self._chunks and self._error is None:
+                        self._cond.wait()
+                    if self._error is not None:
+                        raise self._error
+                    data = self._chunks.pop(self._next)
+                    self._next += 1
+                    self._cond.notify_all()
+                yield data
+        finally:
+            with self._cond:
+                if self._error is None and self._next < count:
+                    self._error = RuntimeError('download cancelled')
+                self._cond.notify_all()
+            for t in threads:
+                t.join()
+
+
+class _ChunkReader(io.RawIOBase):
+    """
+    File object over the chunks of a RangeDownloader that hashes everything read and logs progress.
+    """
+
+    def __init__(self, downloader, hasher):
+        self.downloader = downloader
+        self._chunks = iter(downloader)
+        self._buffer = memoryview(b'')
+        self.hasher = hasher
+        self.done = 0
+        self._last_report = time.monotonic()
+
+    def readable(self):
+        return True
+
+    def close(self):
+        if hasattr(self._chunks, 'close'):
+            self._chunks.close()
+        super().close()
+
+    def readinto(self, b):
+        while not self._buffer:
+            try:
+                self._buffer = memoryview(next(self._chunks))
+            except StopIteration:
+                return 0
+            self.hasher.update(self._buffer)
+            self.done += len(self._buffer)
+            if time.monotonic() - self._last_report > 10:
+                self._last_report = time.monotonic()
+                if self.downloader.size:
+                    logging.info("Downloaded %.0f%% (%d MiB).", 100 * self.done / self.downloader.size,
+                                 self.done >> 20)
+                else:
+                    logging.info("Downloaded %d MiB.", self.done >> 20)
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+
+def _xz_decompress(reader):
+    """
+    Decompress reader with a multi-threaded xz process if there is one, otherwise with lzma.
+    Returns (file object, cleanup function). Call cleanup(failed=True) to abort.
+    """
+    xz = shutil.which('xz')
+    if xz is None:
+        def close(failed=False):
+            reader.close()
+        return lzma.LZMAFile(io.BufferedReader(reader, _READ_SIZE)), close
+
+    start = time.monotonic()
+    proc = sp.Popen([xz, '-d', '-c', '-T0'], stdin=sp.PIPE, stdout=sp.PIPE)
+    errors = []
+
+    def feed():
+        try:
+            for block in iter(lambda: reader.read(_READ_SIZE), b''):
+                proc.stdin.write(block)
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+
+    def cleanup(failed=False):
+        if failed:
+            proc.kill()
+        feeder.join()
+        proc.stdout.close()
+        sp.traced_wait(proc, start)
+        reader.close()
+        if failed:
+            return
+        if errors:
+            raise errors[0]
+        if proc.returncode != 0:
+            raise sp.CalledProcessError(proc.returncode, 'xz')
+
+    return proc.stdout, cleanup
+
+
+def _strip_member(member):
+    """
+    Drop the top level folder from a member name. Returns None for members outside of it.
+    """
+    name = member.name.lstrip('./')
+    if '/' not in name:
+        return None
+    name = name.split('/', 1)[1]
+    if not name or os.path.isabs(name) or '..' in name.split('/'):
+        return None
+    if member.islnk():
+        target = member.linkname.lstrip('./')
+        if '/' not in target:
+            return None
+        member.linkname = target.split('/', 1)[1]
+    member.name = name
+    return member
+
+
+def _check_member(member, dest):
+    """
+    Raise ValueError if extracting member to dest would write outside of it, e.g. through a
+    symlink extracted before, or hard link to a file outside of it. Symlinks may point out of
+    the tree, chromium ships some, but nothing is written through them.
+    """
+    root = os.path.realpath(dest)
+    path = os.path.join(root, member.name)
+    # A symlink replaces what is at its path, other members are written through it
+    resolved = os.path.realpath(os.path.dirname(path) if member.issym() else path)
+    if resolved != root and not resolved.startswith(root + os.sep):
+        raise ValueError("{} would be extracted outside of {}".format(member.name, dest))
+    if member.islnk() and not os.path.realpath(os.path.join(root, member.linkname)).startswith(root + os.sep):
+        raise ValueError("{} links to {} outside of {}".format(member.name, member.linkname, dest))
+
+
+def _is_extracted(member, path):
+    """
+    Whether member was already extracted to path by an earlier, interrupted run.
+    """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return member.isfile() and st.st_size == member.size and int(st.st_mtime) == member.mtime
+
+
+def download_source(url, dest_dir, hashes_url=None, jobs=4):
+    """
+    Download a source tarball (.tar.xz) and extract it into dest_dir while it downloads, without
+    storing the archive. The top level folder of the archive is stripped. The archive is verified
+    with the sha256 digest from hashes_url (url + '.hashes' by default, pass False to skip).
+    The tree is extracted to dest_dir + '.partial' and only moved to dest_dir once verified.
+    As the archive is verified after extraction, no member may write outside of the partial
+    folder. An interrupted run does not resume the download, the archive is streamed and
+    hashed again from the start; only files it completely extracted are not written again.
+    """
+    session = requests.Session()
+    expected = None
+    if hashes_url is None:
+        hashes_url = url + '.hashes'
+    if hashes_url:
+        r = session.get(hashes_url, timeout=_TIMEOUT)
+        r.raise_for_status()
+        expected = parse_hashes(r.text, os.path.basename(url))
+        if expected is None:
+            raise ValueError("No sha256 digest for {} in {}".format(url, hashes_url))
+
+    partial = dest_dir + '.partial'
+    state_path = os.path.join(partial, _STATE_FILE)
+    state = {}
+    if os.path.exists(state_path):
+        with open(state_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    if state.get('url') != url or state.get('sha256') != expected:
+        shutil.rmtree(partial, ignore_errors=True)
+    os.makedirs(partial, exist_ok=True)
+    with open(state_path, 'w', encoding='utf-8') as f:
+        json.dump({'url': url, 'sha256': expected}, f)
+
+    downloader = RangeDownloader(url, jobs=jobs, session=session)
+    reader = _ChunkReader(downloader, hashlib.sha256())
+    skipped = 0
+    with trace_span('direct_download'):
+        stream, cleanup = _xz_decompress(reader)
+        try:
+            with tarfile.open(fileobj=stream, mode='r|') as tar:
+                # chromium ships symlinks the data filter rejects, _check_member covers older Pythons
+                if hasattr(tarfile, 'tar_filter'):
+                    tar.extraction_filter = tarfile.tar_filter
+                for member in tar:
+                    member = _strip_member(member)
+                    if member is None:
+                        continue
+                    _check_member(member, partial)
+                    if _is_extracted(member, os.path.join(partial, member.name)):
+                        skipped += 1
+                        continue
+                    tar.extract(member, partial)
+            # Consume the rest of the archive the tar reader did not need, so all of it is hashed
+            for _ in iter(lambda: stream.read(_READ_SIZE), b''):
+                pass
+        except BaseException:
+            cleanup(failed=True)
+            raise
+        cleanup()
+
+    digest = reader.hasher.hexdigest()
+    if expected is not None and digest != expected:
+        shutil.rmtree(partial, ignore_errors=True)
+        raise ValueError("sha256 of {} is {}, expected {}".format(url, digest, expected))
+    if skipped:
+        logging.info("%d files were already extracted by a previous run, not writing them again.", skipped)
+
+    os.remove(state_path)
+    shutil.rmtree(dest_dir, ignore_errors=True)
+    os.rename(partial, dest_dir)
+    logging.info("Extracted %s (%d MiB) to %s.", url, reader.done >> 20, dest_dir)
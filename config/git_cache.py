@@ -0,0 +1,265 @@
+import ast
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from urllib.parse import urlparse
+
+from config import tracing as sp
+
+_USAGE_FILE = 'usage.json'
+_WORKSPACES_FILE = 'workspaces.json'
+# Written by gclient sync, maps every checked out DEPS path to its url
+_GCLIENT_ENTRIES = '.gclient_entries'
+_lock = threading.Lock()
+
+
+def url_to_cache_dir(url):
+    """
+    Mirror folder name of a git url. Same scheme as depot_tools' git_cache.py, so that gclient,
+    given the same cache_dir, shares mirrors with the clones made here.
+    """
+    parsed = urlparse(url)
+    norm_url = parsed.netloc.split(':')[0] + parsed.path
+    if norm_url.endswith('.git'):
+        norm_url = norm_url[:-len('.git')]
+    norm_url = norm_url.replace('googlesource.com/a/', 'googlesource.com/')
+    norm_url = norm_url.replace(':', '__')
+    return norm_url.replace('-', '--').replace('/', '-').lower()
+
+
+def _git_dir(repo):
+    """
+    Git folder of a checkout, following a .git file. None if repo is not a checkout.
+    """
+    dot_git = os.path.join(repo, '.git')
+    if os.path.isdir(dot_git):
+        return dot_git
+    if os.path.isfile(dot_git):
+        with open(dot_git, 'r', encoding='utf-8') as f:
+            content = f.read().strip()
+        if content.startswith('gitdir:'):
+            return os.path.join(repo, content[len('gitdir:'):].strip())
+    return None
+
+
+def _alternates(repo):
+    """
+    Object folders a checkout borrows objects from, as real paths.
+    """
+    git_dir = _git_dir(repo)
+    if git_dir is None:
+        return []
+    objects = os.path.join(git_dir, 'objects')
+    try:
+        with open(os.path.join(objects, 'info', 'alternates'), 'r', encoding='utf-8') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return []
+    # Relative entries are relative to the objects folder
+    return [os.path.realpath(os.path.join(objects, line)) for line in lines if line and not line.startswith('#')]
+
+
+def _workspace_repos(workspace):
+    """
+    Checkouts in a workspace: its top level folders and the DEPS gclient checked out.
+    """
+    repos = [os.path.join(workspace, d) for d in os.listdir(workspace)]
+    try:
+        with open(os.path.join(workspace, _GCLIENT_ENTRIES), 'r', encoding='utf-8') as f:
+            entries = ast.literal_eval(f.read().split('=', 1)[1].strip())
+        repos += [os.path.join(workspace, path) for path in entries]
+    except (OSError, ValueError, SyntaxError, IndexError):
+        pass
+    return repos
+
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class GitCache:
+    """
+    Store of bare mirror repositories shared by all workspaces on a host.
+    Clones borrow objects from the mirrors through alternates, and gclient uses the same
+    folder as its cache_dir for DEPS. Workspaces using the store are registered, so that
+    mirrors their checkouts borrow from are never removed.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def mirror_path(self, url):
+        return os.path.join(self.cache_dir, url_to_cache_dir(url))
+
+    def populate(self, url):
+        """
+        Create the mirror of url, or fetch new objects into it. Returns the mirror path.
+        """
+        path = self.mirror_path(url)
+        if os.path.isfile(os.path.join(path, 'config')):
+            logging.info("Updating git mirror %s", path)
+            sp.check_call(['git', 'fetch', '--prune', '--tags', 'origin'], cwd=path)
+        else:
+            logging.info("Creating git mirror %s", path)
+            tmp_path = path + '.tmp'
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            sp.check_call(['git', 'clone', '--mirror', url, tmp_path])
+            os.rename(tmp_path, path)
+        self._touch(os.path.basename(path))
+        return path
+
+    def reference(self, url, update=True):
+        """
+        Mirror to use as --reference for a clone of url. If update is False, an existing
+        mirror is used as is and None is returned when there is none.
+        """
+        self.register_workspace()
+        path = self.mirror_path(url)
+        if update:
+            return self.populate(url)
+        if os.path.isfile(os.path.join(path, 'config')):
+            self._touch(os.path.basename(path))
+            return path
+        return None
+
+    def attach(self, repo_folder, url):
+        """
+        Add the mirror of url to the alternates of an existing clone.
+        """
+        mirror = self.reference(url, update=False)
+        if mirror is None:
+            return
+        git_dir = sp.check_output(['git', 'rev-parse', '--absolute-git-dir'], cwd=repo_folder,
+                                  encoding='utf8').strip()
+        alternates = os.path.join(git_dir, 'objects', 'info', 'alternates')
+        objects = os.path.join(mirror, 'objects')
+        existing = []
+        if os.path.exists(alternates):
+            with open(alternates, 'r', encoding='utf-8') as f:
+                existing = f.read().splitlines()
+        if objects not in existing:
+            os.makedirs(os.path.dirname(alternates), exist_ok=True)
+            with open(alternates, 'a', encoding='utf-8') as f:
+                f.write(objects + '\n')
+
+    def _workspaces(self):
+        path = os.path.join(self.cache_dir, _WORKSPACES_FILE)
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except (OSError, ValueError):
+                pass
+        return []
+
+    def _save_workspaces(self, workspaces):
+        path = os.path.join(self.cache_dir, _WORKSPACES_FILE)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(sorted(workspaces), f, indent=2)
+        os.replace(path + '.tmp', path)
+
+    def register_workspace(self, workspace='.'):
+        """
+        Record that checkouts in workspace may borrow objects from the mirrors.
+        """
+        workspace = os.path.abspath(workspace)
+        with _lock:
+            workspaces = self._workspaces()
+            if workspace not in workspaces:
+                self._save_workspaces(workspaces + [workspace])
+
+    def borrowers(self):
+        """
+        Map of mirror objects folder (real path) -> checkouts borrowing from it, found in the
+        registered workspaces. Workspaces that no longer exist are unregistered.
+        """
+        borrowers = {}
+        with _lock:
+            workspaces = [w for w in self._workspaces() if os.path.isdir(w)]
+            self._save_workspaces(workspaces)
+        for workspace in workspaces:
+            for repo in _workspace_repos(workspace):
+                for objects in _alternates(repo):
+                    borrowers.setdefault(objects, []).append(repo)
+        return borrowers
+
+    def _usage(self):
+        path = os.path.join(self.cache_dir, _USAGE_FILE)
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except (OSError, ValueError):
+                pass
+        return {}
+
+    def _touch(self, name):
+        with _lock:
+            usage = self._usage()
+            usage[name] = time.time()
+            path = os.path.join(self.cache_dir, _USAGE_FILE)
+            with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(usage, f, indent=2, sort_keys=True)
+            os.replace(path + '.tmp', path)
+
+    def mirrors(self):
+        """
+        Names of the mirrors in the cache.
+        """
+        return sorted(d for d in os.listdir(self.cache_dir)
+                      if os.path.isfile(os.path.join(self.cache_dir, d, 'config')))
+
+    def report(self):
+        """
+        Log the size and last use of every mirror. Returns the total size in bytes.
+        """
+        usage = self._usage()
+        total = 0
+        for name in self.mirrors():
+            size = _dir_size(os.path.join(self.cache_dir, name))
+            total += size
+            last_used = usage.get(name)
+            logging.info("%10.2f GiB  %s  %s", size / (1 << 30),
+                         time.strftime('%Y-%m-%d', time.localtime(last_used)) if last_used else 'unknown   ',
+                         name)
+        logging.info("%10.2f GiB  total in %s", total / (1 << 30), self.cache_dir)
+        return total
+
+    @staticmethod
+    def _gc(path):
+        # Objects no ref reaches any more may still be used by a borrowing checkout
+        sp.check_call(['git', '-c', 'gc.pruneExpire=never', 'gc', '--auto', '--quiet'], cwd=path)
+
+    def gc(self, max_age_days=30):
+        """
+        Remove mirrors unused for max_age_days and let git repack the others.
+        Mirrors without a recorded use, like the ones created by gclient, are aged by mtime.
+        Mirrors a checkout of a registered workspace borrows objects from are kept, removing
+        them would corrupt the checkout.
+        """
+        usage = self._usage()
+        borrowers = self.borrowers()
+        deadline = time.time() - max_age_days * 86400
+        for name in self.mirrors():
+            path = os.path.join(self.cache_dir, name)
+            last_used = usage.get(name, os.path.getmtime(path))
+            used_by = borrowers.get(os.path.realpath(os.path.join(path, 'objects')))
+            if last_used < deadline and used_by:
+                logging.info("Keeping unused git mirror %s, %s borrows objects from it.", path, used_by[0])
+                self._gc(path)
+            elif last_used < deadline:
+                logging.info("Removing unused git mirror %s", path)
+                shutil.rmtree(path)
+            else:
+                self._gc(path)
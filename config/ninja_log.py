@@ -0,0 +1,331 @@
+import bisect
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from config.constants import NINJA_HISTORY_FILE
+
+_LINK_SUFFIXES = ('.so', '.aab', '.apk', '.apks')
+# Only flag edges that got at least this much slower, relative and absolute
+_REGRESSION_RATIO = 1.5
+_REGRESSION_MIN_MS = 2000
+# Number of builds kept in history per output directory
+_HISTORY_BUILDS = 20
+_TAIL_BYTES = 64
+_RESTART_SLACK_MS = 1000
+
+
+class NinjaEdge:
+    """
+    One build edge from .ninja_log. Times are in ms relative to the first ninja invocation read.
+    """
+
+    def __init__(self, start, end, cmd_hash, outputs):
+        self.start = start
+        self.end = end
+        self.cmd_hash = cmd_hash
+        self.outputs = outputs
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    @property
+    def output(self):
+        return self.outputs[0]
+
+
+def read_ninja_log(log_path, offset=0, tail=b''):
+    """
+    Read entries appended to .ninja_log after offset. tail holds the bytes before offset seen
+    last time; if they differ, ninja recompacted the log and it is read from the beginning.
+    Returns (edges, new offset, new tail, whether the log was read from the beginning).
+    """
+    with open(log_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        restarted = False
+        if offset > size or offset < len(tail):
+            restarted = True
+        elif tail:
+            f.seek(offset - len(tail))
+            restarted = f.read(len(tail)) != tail
+        if restarted or offset == 0:
+            offset = 0
+            header = f.readline()
+            if not header.startswith(b'# ninja log v'):
+                raise ValueError("{} is not a ninja log".format(log_path))
+            offset = f.tell()
+        f.seek(offset)
+        data = f.read()
+
+    # Only consume complete lines, ninja may be appending
+    data = data[:data.rfind(b'\n') + 1]
+    new_offset = offset + len(data)
+    with open(log_path, 'rb') as f:
+        f.seek(max(0, new_offset - _TAIL_BYTES))
+        new_tail = f.read(new_offset - max(0, new_offset - _TAIL_BYTES))
+
+    edges = {}
+    base = 0
+    last_end = 0
+    prev_end = 0
+    segment = 0
+    for line in data.decode('utf-8', errors='replace').splitlines():
+        fields = line.split('\t')
+        if len(fields) < 5 or line.startswith('#'):
+            continue
+        start, end = int(fields[0]), int(fields[1])
+        # Entries are appended in completion order, a drop means ninja was restarted
+        if end + _RESTART_SLACK_MS < prev_end:
+            segment += 1
+            base = last_end
+        prev_end = end
+        start += base
+        end += base
+        last_end = max(last_end, end)
+        key = (segment, start, end, fields[4])
+        if key in edges:
+            edges[key].outputs.append(fields[3])
+        else:
+            edges[key] = NinjaEdge(start, end, fields[4], [fields[3]])
+    return list(edges.values()), new_offset, new_tail, restarted
+
+
+def _is_link(output):
+    ext = os.path.splitext(output)[1]
+    # Executables are placed at the top of the output directory and have no extension
+    return ext in _LINK_SUFFIXES or ('/' not in output and not ext)
+
+
+def _top_dir(output):
+    parts = output.split('/')
+    # Skip toolchain folders like clang_x64/ and obj/ or gen/
+    while parts and (parts[0] in ('obj', 'gen') or parts[0].endswith(('_x64', '_x86', '_arm', '_arm64'))):
+        parts = parts[1:]
+    if len(parts) <= 1:
+        return '.'
+    if parts[0] == 'third_party' and len(parts) > 2:
+        return '/'.join(parts[:2])
+    return parts[0]
+
+
+def critical_path(edges):
+    """
+    Longest chain of edges where each one starts after the previous one ended. Without the
+    build graph this is an approximation of the critical path. Returns edges in order.
+    """
+    ordered = sorted(edges, key=lambda e: e.end)
+    best = {}
+    prev = {}
+    ends = []
+    # Prefix maximum of best chain length over edges sorted by end time
+    prefix = []
+    for e in ordered:
+        i = bisect.bisect_right(ends, e.start)
+        if i > 0:
+            length, p = prefix[i - 1]
+            best[id(e)] = length + e.duration
+            prev[id(e)] = p
+        else:
+            best[id(e)] = e.duration
+            prev[id(e)] = None
+        ends.append(e.end)
+        if prefix and prefix[-1][0] >= best[id(e)]:
+            prefix.append(prefix[-1])
+        else:
+            prefix.append((best[id(e)], e))
+    if not prefix:
+        return []
+    path = []
+    e = prefix[-1][1]
+    while e is not None:
+        path.append(e)
+        e = prev[id(e)]
+    return path[::-1]
+
+
+def summarize_edges(edges, top=10):
+    """
+    Aggregate timings of edges into a JSON serializable report.
+    """
+    compiles = [e for e in edges if e.output.endswith(('.o', '.obj'))]
+    links = [e for e in edges if _is_link(e.output)]
+    per_dir = {}
+    for e in edges:
+        d = _top_dir(e.output)
+        per_dir[d] = per_dir.get(d, 0) + e.duration
+    path = critical_path(edges)
+
+    def describe(items):
+        return [{'output': e.output, 'ms': e.duration} for e in items]
+
+    return {
+        'edges': len(edges),
+        'wall_ms': max((e.end for e in edges), default=0) - min((e.start for e in edges), default=0),
+        'total_ms': sum(e.duration for e in edges),
+        'critical_path_ms': sum(e.duration for e in path),
+        'critical_path': describe(path),
+        'slowest_compiles': describe(sorted(compiles, key=lambda e: -e.duration)[:top]),
+        'slowest_links': describe(sorted(links, key=lambda e: -e.duration)[:top]),
+        'per_directory_ms': dict(sorted(per_dir.items(), key=lambda kv: -kv[1])),
+    }
+
+
+class NinjaHistory:
+    """
+    Local sqlite database of edge timings, keyed by chromium version and GN args fingerprint.
+    """
+
+    def __init__(self, path=NINJA_HISTORY_FILE):
+        self.db = sqlite3.connect(path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS builds (
+                id INTEGER PRIMARY KEY, time REAL, chromium_version TEXT, args_fingerprint TEXT,
+                output_dir TEXT, wall_ms INTEGER, edges INTEGER);
+            CREATE TABLE IF NOT EXISTS edges (
+                build_id INTEGER, output TEXT, start_ms INTEGER, end_ms INTEGER);
+            CREATE INDEX IF NOT EXISTS edges_output ON edges (output, build_id);
+            CREATE TABLE IF NOT EXISTS log_state (log_path TEXT PRIMARY KEY, offset INTEGER, tail BLOB);
+        """)
+
+    def close(self):
+        self.db.close()
+
+    def log_state(self, log_path):
+        row = self.db.execute('SELECT offset, tail FROM log_state WHERE log_path = ?', (log_path,)).fetchone()
+        return (row[0], row[1]) if row else (0, b'')
+
+    def set_log_state(self, log_path, offset, tail):
+        self.db.execute('INSERT OR REPLACE INTO log_state VALUES (?, ?, ?)', (log_path, offset, tail))
+        self.db.commit()
+
+    def add_build(self, chromium_version, args_fingerprint, output_dir, edges):
+        wall = max((e.end for e in edges), default=0) - min((e.start for e in edges), default=0)
+        cur = self.db.execute(
+            'INSERT INTO builds (time, chromium_version, args_fingerprint, output_dir, wall_ms, edges) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (time.time(), chromium_version, args_fingerprint, output_dir, wall, len(edges)))
+        build_id = cur.lastrowid
+        self.db.executemany('INSERT INTO edges VALUES (?, ?, ?, ?)',
+                            [(build_id, e.output, e.start, e.end) for e in edges])
+        # Keep history bounded
+        old = [r[0] for r in self.db.execute(
+            'SELECT id FROM builds WHERE output_dir = ? ORDER BY id DESC LIMIT -1 OFFSET ?',
+            (output_dir, _HISTORY_BUILDS))]
+        if old:
+            marks = ','.join('?' * len(old))
+            self.db.execute('DELETE FROM edges WHERE build_id IN ({})'.format(marks), old)
+            self.db.execute('DELETE FROM builds WHERE id IN ({})'.format(marks), old)
+        self.db.commit()
+        return build_id
+
+    def build_key(self, build_id):
+        row = self.db.execute('SELECT chromium_version, args_fingerprint FROM builds WHERE id = ?',
+                              (build_id,)).fetchone()
+        return tuple(row) if row else None
+
+    def last_durations(self, build_id, output_dir):
+        """
+        Latest duration of every output of build_id from earlier builds of the same output directory.
+        Returns a dict output -> (duration ms, build id).
+        """
+        rows = self.db.execute("""
+            SELECT e.output, e.end_ms - e.start_ms, e.build_id FROM edges e
+            JOIN (SELECT p.output AS output, MAX(p.build_id) AS bid FROM edges p
+                  JOIN builds b ON b.id = p.build_id
+                  WHERE b.output_dir = ? AND p.build_id < ?
+                  AND p.output IN (SELECT output FROM edges WHERE build_id = ?)
+                  GROUP BY p.output) l
+            ON e.output = l.output AND e.build_id = l.bid
+        """, (output_dir, build_id, build_id))
+        return {output: (ms, bid) for output, ms, bid in rows}
+
+    def latest_durations(self, output_dir):
+        """
+        Latest recorded duration in ms of every output built in an output directory.
+        """
+        rows = self.db.execute("""
+            SELECT e.output, e.end_ms - e.start_ms FROM edges e
+            JOIN (SELECT p.output AS output, MAX(p.build_id) AS bid FROM edges p
+                  JOIN builds b ON b.id = p.build_id
+                  WHERE b.output_dir = ?
+                  GROUP BY p.output) l
+            ON e.output = l.output AND e.build_id = l.bid
+        """, (output_dir,))
+        return dict(rows)
+
+
+def latest_compile_durations(output_dir, history_path=NINJA_HISTORY_FILE):
+    """
+    Durations in ms of the compile edges of the latest recorded build of an output directory.
+    """
+    if not os.path.exists(history_path):
+        return []
+    history = NinjaHistory(history_path)
+    try:
+        rows = history.db.execute("""
+            SELECT e.output, e.end_ms - e.start_ms FROM edges e
+            WHERE e.build_id = (SELECT MAX(id) FROM builds WHERE output_dir = ?)
+        """, (os.path.abspath(output_dir),))
+        return [ms for output, ms in rows if output.endswith(('.o', '.obj'))]
+    finally:
+        history.close()
+
+
+def analyze_ninja_log(output_dir, chromium_version, args_fingerprint, history_path=NINJA_HISTORY_FILE):
+    """
+    Read new .ninja_log entries of an output directory, record them in the history database
+    and write ninja_report.json with the slowest steps and regressions against previous builds.
+    Returns the report, or None if there were no new entries.
+    """
+    log_path = os.path.abspath(os.path.join(output_dir, '.ninja_log'))
+    if not os.path.exists(log_path):
+        logging.warning("No .ninja_log in %s, skipping build analysis.", output_dir)
+        return None
+
+    history = NinjaHistory(history_path)
+    try:
+        offset, tail = history.log_state(log_path)
+        edges, offset, tail, restarted = read_ninja_log(log_path, offset, tail)
+        history.set_log_state(log_path, offset, tail)
+        if not edges:
+            logging.info("No new .ninja_log entries in %s.", output_dir)
+            return None
+
+        output_key = os.path.abspath(output_dir)
+        build_id = history.add_build(chromium_version, args_fingerprint, output_key, edges)
+        report = summarize_edges(edges)
+        report.update({
+            'chromium_version': chromium_version,
+            'args_fingerprint': args_fingerprint,
+            'log_recompacted': restarted,
+        })
+
+        regressions = []
+        previous = history.last_durations(build_id, output_key)
+        for e in edges:
+            if e.output not in previous:
+                continue
+            ms, bid = previous[e.output]
+            if e.duration >= ms * _REGRESSION_RATIO and e.duration - ms >= _REGRESSION_MIN_MS:
+                regressions.append({'output': e.output, 'ms': e.duration, 'previous_ms': ms,
+                                    'previous_key': history.build_key(bid)})
+        report['regressions'] = sorted(regressions, key=lambda r: r['previous_ms'] - r['ms'])
+    finally:
+        history.close()
+
+    with open(os.path.join(output_dir, 'ninja_report.json'), 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+
+    logging.info("Build analysis: %d edges, %.1fs wall, %.1fs on the critical path.",
+                 report['edges'], report['wall_ms'] / 1000, report['critical_path_ms'] / 1000)
+    for item in report['slowest_links'][:3]:
+        logging.info("  slow link: %s %.1fs", item['output'], item['ms'] / 1000)
+    for item in report['slowest_compiles'][:3]:
+        logging.info("  slow compile: %s %.1fs", item['output'], item['ms'] / 1000)
+    for item in report['regressions'][:10]:
+        logging.warning("  regression: %s %.1fs -> %.1fs", item['output'],
+                        item['previous_ms'] / 1000, item['ms'] / 1000)
+    return report
@@ -0,0 +1,244 @@
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tarfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config import tracing as sp
+from config.tracing import trace_span
+
+# Files of each ninja target in the output folder, the first one must exist
+PACKAGE_FILES = {
+    'chrome': ['chrome', 'chrome_crashpad_handler', '*.pak', 'locales/*.pak', 'icudtl.dat',
+               'v8_context_snapshot.bin', 'snapshot_blob.bin', 'lib*.so', 'lib*.so.*',
+               'vk_swiftshader_icd.json', 'MEIPreload/*'],
+    'chrome_sandbox': ['chrome_sandbox'],
+    'chromedriver': ['chromedriver'],
+    'chrome_modern_public_bundle': ['apks/ChromeModernPublic.aab'],
+}
+# Files that only go into the debug artifact
+DEBUG_FILES = {
+    'chrome_modern_public_bundle': ['lib.unstripped/*.so'],
+}
+COMPRESSORS = {
+    'zstd': ('.tar.zst', ['-T0', '-q', '-12']),
+    'xz': ('.tar.xz', ['-T0', '-6']),
+}
+_ELF_MAGIC = b'\x7fELF'
+_LLVM_BIN = os.path.join('third_party', 'llvm-build', 'Release+Asserts', 'bin')
+
+
+def default_compression():
+    """
+    zstd if it is installed, otherwise xz.
+    """
+    return 'zstd' if shutil.which('zstd') else 'xz'
+
+
+def _expand(output_dir, patterns):
+    files = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(os.path.join(output_dir, pattern))):
+            if os.path.isfile(path):
+                files.append(os.path.relpath(path, output_dir))
+    return files
+
+
+def collect_files(output_dir, targets):
+    """
+    Files to package for targets, and files for the debug artifact, as paths relative to output_dir.
+    Raises FileNotFoundError if the main file of a target was not built.
+    """
+    files = []
+    debug_files = []
+    for target in targets:
+        patterns = PACKAGE_FILES[target]
+        if not os.path.isfile(os.path.join(output_dir, patterns[0])):
+            raise FileNotFoundError("{} of target {} not found in {}".format(patterns[0], target, output_dir))
+        files += _expand(output_dir, patterns)
+        debug_files += _expand(output_dir, DEBUG_FILES.get(target, []))
+    return list(dict.fromkeys(files)), list(dict.fromkeys(debug_files))
+
+
+def find_objcopy(source_dir):
+    """
+    llvm-objcopy of the source tree's toolchain, or objcopy on PATH.
+    """
+    bundled = os.path.join(source_dir, _LLVM_BIN, 'llvm-objcopy')
+    if os.path.exists(bundled):
+        return bundled
+    found = shutil.which('llvm-objcopy') or shutil.which('objcopy')
+    if found is None:
+        raise RuntimeError("Neither llvm-objcopy nor objcopy found, cannot strip binaries.")
+    return found
+
+
+def _is_elf(path):
+    with open(path, 'rb') as f:
+        return f.read(4) == _ELF_MAGIC
+
+
+def _sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _describe(path):
+    st = os.stat(path)
+    return {'sha256': _sha256(path), 'size': st.st_size, 'mode': '{:o}'.format(st.st_mode & 0o7777)}
+
+
+def _stage(output_dir, staging, debug_staging, rel, objcopy):
+    """
+    Put one file into the staging folders. With objcopy, ELF files are split into a stripped
+    copy with a debug link and a .debug file. Other files are hard linked (copied across file
+    systems). Returns (rel, description, debug rel or None, debug description or None).
+    """
+    src = os.path.join(output_dir, rel)
+    dst = os.path.join(staging, rel)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    if objcopy is None or not _is_elf(src):
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+        return rel, _describe(dst), None, None
+
+    debug_rel = rel + '.debug'
+    debug = os.path.join(debug_staging, debug_rel)
+    os.makedirs(os.path.dirname(debug), exist_ok=True)
+    sp.check_call([objcopy, '--only-keep-debug', src, debug])
+    # The debug link is looked up by name next to the binary or in the debug folders
+    sp.check_call([objcopy, '--strip-all', '--add-gnu-debuglink=' + debug, src, dst])
+    shutil.copymode(src, dst)
+    return rel, _describe(dst), debug_rel, _describe(debug)
+
+
+def _tar_filter(info):
+    # Artifacts only depend on content and permissions
+    info.uid = info.gid = 0
+    info.uname = info.gname = ''
+    return info
+
+
+def compress_dir(src_dir, artifact, compression):
+    """
+    Write the contents of src_dir as a tarball, compressed by a multi-threaded zstd or xz
+    process the tar stream is piped to. Falls back to single-threaded lzma without xz.
+    """
+    tmp_path = artifact + '.tmp'
+    names = sorted(os.listdir(src_dir))
+    tool = shutil.which(compression)
+    start = time.monotonic()
+    with trace_span('compress', artifact=os.path.basename(artifact)):
+        if tool is None:
+            if compression != 'xz':
+                raise RuntimeError("{} is not installed.".format(compression))
+            with tarfile.open(tmp_path, 'w:xz') as tar:
+                for name in names:
+                    tar.add(os.path.join(src_dir, name), name, filter=_tar_filter)
+        else:
+            with open(tmp_path, 'wb') as out:
+                proc = sp.Popen([tool] + COMPRESSORS[compression][1] + ['-c'], stdin=sp.PIPE, stdout=out)
+                try:
+                    with tarfile.open(fileobj=proc.stdin, mode='w|') as tar:
+                        for name in names:
+                            tar.add(os.path.join(src_dir, name), name, filter=_tar_filter)
+                finally:
+                    proc.stdin.close()
+                    returncode = sp.traced_wait(proc, start)
+                if returncode != 0:
+                    raise sp.CalledProcessError(returncode, tool)
+    os.replace(tmp_path, artifact)
+    logging.info("Wrote %s (%.1f MiB) in %.1fs.", artifact, os.path.getsize(artifact) / (1 << 20),
+                 time.monotonic() - start)
+
+
+def _previous_manifest(dest_dir, name, suffix):
+    """
+    The manifest of the last package of name, or else the newest one in dest_dir whose name
+    ends with suffix.
+    """
+    candidates = [os.path.join(dest_dir, name + '.manifest.json')]
+    if not os.path.exists(candidates[0]):
+        candidates = glob.glob(os.path.join(dest_dir, '*' + suffix + '.manifest.json'))
+    if not candidates:
+        return None
+    with open(max(candidates, key=os.path.getmtime), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def package_output(output_dir, dest_dir, name, targets, source_dir, compression=None, jobs=None,
+                   metadata=None, suffix=''):
+    """
+    Package the outputs of targets in output_dir as dest_dir/<name>.tar.* with the stripped
+    files, <name>.debug.tar.* with the debug info, and <name>.manifest.json with the sha256 of
+    every file and artifact, so an artifact store can keep unchanged files once. Files are
+    staged in parallel, output_dir is not modified. suffix identifies the configuration in
+    names and is used to find the previous manifest. Returns the manifest.
+    """
+    compression = compression or default_compression()
+    extension = COMPRESSORS[compression][0]
+    files, debug_files = collect_files(output_dir, targets)
+    os.makedirs(dest_dir, exist_ok=True)
+    previous = _previous_manifest(dest_dir, name, suffix)
+    staging = os.path.join(dest_dir, '.staging', name)
+    debug_staging = os.path.join(dest_dir, '.staging', name + '.debug')
+    shutil.rmtree(staging, ignore_errors=True)
+    shutil.rmtree(debug_staging, ignore_errors=True)
+    os.makedirs(staging)
+    os.makedirs(debug_staging)
+    objcopy = find_objcopy(source_dir) if any(_is_elf(os.path.join(output_dir, f)) for f in files) else None
+
+    manifest = dict(metadata or {}, name=name, compression=compression, files={}, debug_files={}, artifacts={})
+    start = time.monotonic()
+    try:
+        with trace_span('package_stage'):
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                results = list(executor.map(
+                    lambda rel: _stage(output_dir, staging, debug_staging, rel, objcopy), files))
+                debug_results = list(executor.map(
+                    lambda rel: _stage(output_dir, debug_staging, debug_staging, rel, None), debug_files))
+        for rel, description, debug_rel, debug_description in results:
+            manifest['files'][rel] = description
+            if debug_rel is not None:
+                manifest['debug_files'][debug_rel] = debug_description
+        for rel, description, _, _ in debug_results:
+            manifest['debug_files'][rel] = description
+        logging.info("Staged %d files and %d debug files in %.1fs.", len(manifest['files']),
+                     len(manifest['debug_files']), time.monotonic() - start)
+
+        artifacts = [(staging, name + extension)]
+        if manifest['debug_files']:
+            artifacts.append((debug_staging, name + '.debug' + extension))
+        for src_dir, artifact in artifacts:
+            path = os.path.join(dest_dir, artifact)
+            compress_dir(src_dir, path, compression)
+            manifest['artifacts'][artifact] = {'sha256': _sha256(path), 'size': os.path.getsize(path)}
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+        shutil.rmtree(debug_staging, ignore_errors=True)
+        try:
+            os.rmdir(os.path.dirname(staging))
+        except OSError:
+            # Other configurations are still being packaged
+            pass
+
+    if previous is not None:
+        unchanged = sum(1 for rel, d in manifest['files'].items()
+                        if previous.get('files', {}).get(rel, {}).get('sha256') == d['sha256'])
+        manifest['unchanged_since'] = previous.get('name')
+        logging.info("%d of %d files unchanged since %s.", unchanged, len(manifest['files']), previous.get('name'))
+
+    path = os.path.join(dest_dir, name + '.manifest.json')
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+    return manifest
@@ -0,0 +1,278 @@
+import filecmp
+import json
+import logging
+import os
+import re
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config import tracing as sp
+from config.constants import PATCH_SCRATCH_DIR, PATCH_REPORT_FILE
+from config.tracing import trace_span
+
+_HUNK_RE = re.compile(r'^@@ -\d+(?:,(\d+))? \+\d+(?:,(\d+))? @@')
+# What patch --forward prints for a patch whose changes are already there
+_REVERSED = 'Reversed (or previously applied) patch detected'
+
+
+def parse_series(patches_dir):
+    """
+    Read the series file of a patch directory and return paths to the patches in order.
+    """
+    with open(os.path.join(patches_dir, 'series'), 'r', encoding='utf-8') as f:
+        names = [l.strip() for l in f]
+    return [os.path.join(patches_dir, n) for n in names if n and not n.startswith('#')]
+
+
+def _strip_path(name, strip):
+    name = name.rstrip('\r\n').split('\t')[0].strip()
+    if name == '/dev/null':
+        return None
+    return '/'.join(name.split('/')[strip:])
+
+
+def parse_patch(patch_path, strip=1):
+    """
+    Parse a unified or git diff into a list of [old_path, new_path, hunk_count], one per file.
+    Paths have their first strip components removed; created or deleted files have None
+    as old or new path.
+    """
+    files = []
+    current = None
+    old_left = new_left = 0
+    with open(patch_path, 'r', encoding='utf-8', errors='surrogateescape') as f:
+        for line in f:
+            # Lines inside a hunk can look like headers, skip them by count
+            if old_left > 0 or new_left > 0:
+                if line.startswith('-'):
+                    old_left -= 1
+                elif line.startswith('+'):
+                    new_left -= 1
+                elif not line.startswith('\\'):
+                    old_left -= 1
+                    new_left -= 1
+                continue
+
+            if line.startswith('diff --git '):
+                current = {'old': None, 'new': None, 'hunks': 0, 'headers': False}
+                files.append(current)
+                names = line[len('diff --git '):].rstrip('\n').split(' ')
+                if len(names) == 2:
+                    current['old'] = _strip_path(names[0], strip)
+                    current['new'] = _strip_path(names[1], strip)
+            elif line.startswith('rename from ') or line.startswith('copy from '):
+                current['old'] = line.split(' ', 2)[2].rstrip('\n')
+            elif line.startswith('rename to ') or line.startswith('copy to '):
+                current['new'] = line.split(' ', 2)[2].rstrip('\n')
+            elif line.startswith('--- '):
+                if current is None or current['headers']:
+                    current = {'old': None, 'new': None, 'hunks': 0, 'headers': False}
+                    files.append(current)
+                current['old'] = _strip_path(line[4:], strip)
+            elif line.startswith('+++ ') and current is not None:
+                current['new'] = _strip_path(line[4:], strip)
+                current['headers'] = True
+            elif line.startswith('@@ ') and current is not None:
+                m = _HUNK_RE.match(line)
+                if m is None:
+                    continue
+                old_left = int(m.group(1)) if m.group(1) is not None else 1
+                new_left = int(m.group(2)) if m.group(2) is not None else 1
+                current['hunks'] += 1
+    return [[f['old'], f['new'], f['hunks']] for f in files]
+
+
+def patch_touched_files(patch_path, strip=1):
+    """
+    Return the set of paths a patch creates, modifies, renames or deletes.
+    """
+    touched = set()
+    for old_path, new_path, _ in parse_patch(patch_path, strip):
+        touched.update(p for p in (old_path, new_path) if p is not None)
+    return touched
+
+
+def series_touched_files(patches_dir):
+    """
+    Return the set of paths touched by any patch in a patch series.
+    """
+    touched = set()
+    for patch in parse_series(patches_dir):
+        touched |= patch_touched_files(patch)
+    return touched
+
+
+class PatchError(RuntimeError):
+    """
+    Raised when patches do not apply. conflicts is a list of (patch path, patch output).
+    """
+
+    def __init__(self, conflicts):
+        super().__init__("{} patch(es) do not apply: {}".format(
+            len(conflicts), ', '.join(os.path.basename(p) for p, _ in conflicts)))
+        self.conflicts = conflicts
+
+
+def _components(parsed):
+    """
+    Group patches into connected components of patches touching common files.
+    parsed is a list of (patch path, touched files). Returns lists of indices in series order.
+    """
+    parent = list(range(len(parsed)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    owner = {}
+    for i, (_, touched) in enumerate(parsed):
+        for path in touched:
+            if path in owner:
+                parent[find(i)] = find(owner[path])
+            else:
+                owner[path] = i
+    groups = {}
+    for i in range(len(parsed)):
+        groups.setdefault(find(i), []).append(i)
+    return list(groups.values())
+
+
+def _dry_run(source_tree, scratch, patches):
+    """
+    Apply patches (a list of (path, touched files, hunks)) in order to copies of the files they
+    touch in scratch. Returns (per patch results, None) or (results so far, (patch, output)).
+    --forward keeps patch from asking whether to reverse a patch that looks applied, which
+    is a conflict as well: the tree was already prepared.
+    """
+    touched = set()
+    for _, files, _ in patches:
+        touched |= files
+    for rel in touched:
+        src = os.path.join(source_tree, rel)
+        if os.path.lexists(src):
+            dst = os.path.join(scratch, rel)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            shutil.copy2(src, dst, follow_symlinks=False)
+
+    results = []
+    for patch, files, hunks in patches:
+        start = time.monotonic()
+        result = sp.run(['patch', '-p1', '--ignore-whitespace', '--forward', '--no-backup-if-mismatch',
+                         '--reject-file=-', '-i', os.path.abspath(patch), '-d', scratch],
+                        stdin=sp.DEVNULL, encoding='utf-8', errors='replace', capture_output=True)
+        output = result.stdout + result.stderr
+        if _REVERSED in output:
+            return results, (patch, output + "The patch is already applied, restore a pristine tree "
+                                             "with sync --reset before preparing again.\n")
+        if result.returncode != 0:
+            return results, (patch, output)
+        results.append({'patch': patch, 'ms': int((time.monotonic() - start) * 1000),
+                        'hunks': hunks, 'files': len(files)})
+    return results, None
+
+
+def _commit(source_tree, scratch, touched, backup_dir, done):
+    """
+    Move the patched files of one scratch folder into the source tree. Originals are moved
+    to backup_dir and recorded in done as (path, backup path or None) for a rollback.
+    Files the patches left unchanged are not touched.
+    """
+    for rel in sorted(touched):
+        new = os.path.join(scratch, rel)
+        dst = os.path.join(source_tree, rel)
+        exists = os.path.lexists(dst)
+        if exists and os.path.lexists(new) and not os.path.islink(new) and filecmp.cmp(new, dst, shallow=False):
+            continue
+        backup = None
+        if exists:
+            backup = os.path.join(backup_dir, rel)
+            os.makedirs(os.path.dirname(backup), exist_ok=True)
+            os.rename(dst, backup)
+        done.append((dst, backup))
+        if os.path.lexists(new):
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            os.rename(new, dst)
+
+
+def apply_patches(patches, source_tree, jobs=None, scratch_dir=PATCH_SCRATCH_DIR, strip=1):
+    """
+    Apply patches to source_tree all or nothing. Patches that touch common files form a group,
+    groups are applied in parallel to scratch copies of their files. Only if every patch
+    applies are the results moved into the tree; if that fails, the tree is rolled back.
+    Raises PatchError without changing the tree if any patch does not apply.
+    Returns a list with the time, hunk and file count of every patch, in series order.
+    """
+    if strip != 1:
+        raise ValueError("Only patches with one leading path component are supported")
+    parsed = []
+    for patch in patches:
+        files = parse_patch(patch, strip)
+        parsed.append((patch, set(p for old, new, _ in files for p in (old, new) if p is not None),
+                       sum(h for _, _, h in files)))
+    components = _components([(p, t) for p, t, _ in parsed])
+
+    shutil.rmtree(scratch_dir, ignore_errors=True)
+    os.makedirs(scratch_dir)
+    try:
+        with trace_span('patch_dry_run'):
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                futures = [executor.submit(_dry_run, source_tree, os.path.join(scratch_dir, str(n)),
+                                           [parsed[i] for i in component])
+                           for n, component in enumerate(components)]
+                outcomes = [f.result() for f in futures]
+        conflicts = [conflict for _, conflict in outcomes if conflict is not None]
+        if conflicts:
+            raise PatchError(sorted(conflicts, key=lambda c: patches.index(c[0])))
+
+        done = []
+        backup_dir = os.path.join(scratch_dir, 'backup')
+        with trace_span('patch_commit'):
+            try:
+                for n, component in enumerate(components):
+                    touched = set()
+                    for i in component:
+                        touched |= parsed[i][1]
+                    _commit(source_tree, os.path.join(scratch_dir, str(n)), touched, backup_dir, done)
+            except BaseException:
+                logging.error("Applying patches failed, restoring %d files.", len(done))
+                for dst, backup in reversed(done):
+                    if os.path.lexists(dst):
+                        os.remove(dst)
+                    if backup is not None:
+                        os.rename(backup, dst)
+                raise
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    results = sorted((r for rs, _ in outcomes for r in rs), key=lambda r: patches.index(r['patch']))
+    return results
+
+
+def apply_patch_series(patches_dir, source_tree, jobs=None, report_path=PATCH_REPORT_FILE):
+    """
+    Apply the series of a patch folder with apply_patches, log a summary and record the
+    per patch report under the folder's name in report_path.
+    """
+    start = time.monotonic()
+    results = apply_patches(parse_series(patches_dir), source_tree, jobs)
+    for r in results:
+        r['patch'] = os.path.relpath(r['patch'], patches_dir)
+    logging.info("Applied %d patches (%d hunks) from %s in %.1fs.", len(results),
+                 sum(r['hunks'] for r in results), patches_dir, time.monotonic() - start)
+    for r in sorted(results, key=lambda r: -r['ms'])[:5]:
+        logging.info("  %s: %d hunks in %.1fs", r['patch'], r['hunks'], r['ms'] / 1000)
+
+    report = {}
+    if os.path.exists(report_path):
+        try:
+            with open(report_path, 'r', encoding='utf-8') as f:
+                report = json.load(f)
+        except (OSError, ValueError):
+            report = {}
+    report[patches_dir] = results
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    return results
@@ -0,0 +1,157 @@
+import glob
+import hashlib
+import json
+import logging
+import math
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from config import tracing as sp
+from config.utils import read_list_file
+
+_PAGE_SUFFIXES = ('.html', '.htm', '.xhtml', '.svg')
+# Real time limit of one page, on top of its virtual time budget
+_PAGE_TIMEOUT = 120
+_LLVM_PROFDATA = os.path.join('third_party', 'llvm-build', 'Release+Asserts', 'bin', 'llvm-profdata')
+
+
+def load_workload(path):
+    """
+    Pages of a PGO workload: every HTML file under a folder, or the files named in a list file
+    (relative to the list's folder). Returns absolute paths in a stable order.
+    """
+    if os.path.isdir(path):
+        pages = [os.path.join(folder, name) for folder, _, files in os.walk(path) for name in files
+                 if name.lower().endswith(_PAGE_SUFFIXES)]
+    elif os.path.isfile(path):
+        pages = [os.path.join(os.path.dirname(path), p) for p in read_list_file(path)]
+    else:
+        pages = []
+    pages = sorted(os.path.abspath(p) for p in pages)
+    missing = [p for p in pages if not os.path.isfile(p)]
+    if missing:
+        raise FileNotFoundError("Workload pages do not exist: " + ', '.join(missing[:5]))
+    if not pages:
+        raise RuntimeError("No workload pages in {}, add local HTML pages or benchmarks there.".format(path))
+    return pages
+
+
+def find_llvm_profdata(source_dir):
+    """
+    llvm-profdata matching the clang of the source tree, or one on PATH.
+    """
+    bundled = os.path.join(source_dir, _LLVM_PROFDATA)
+    if os.path.exists(bundled):
+        return bundled
+    found = shutil.which('llvm-profdata')
+    if found is None:
+        raise RuntimeError("llvm-profdata not found, sync with checkout_clang_coverage_tools enabled "
+                           "or put it on PATH.")
+    return found
+
+
+def _run_page(chrome, page, time_budget, env):
+    """
+    Load one page in headless chrome and let its scripts run for time_budget ms of virtual time.
+    Returns the wall time in seconds, or None if chrome failed or timed out.
+    """
+    with tempfile.TemporaryDirectory(prefix='pgo-profile-') as user_data_dir:
+        cmd = [chrome, '--headless=new', '--no-first-run', '--no-default-browser-check',
+               '--disable-background-networking', '--disable-component-update', '--disable-extensions',
+               '--disable-gpu', '--user-data-dir=' + user_data_dir,
+               '--virtual-time-budget=' + str(time_budget), '--dump-dom', 'file://' + page]
+        if os.geteuid() == 0:
+            cmd.append('--no-sandbox')
+        start = time.monotonic()
+        proc = sp.Popen(cmd, env=env, stdout=sp.DEVNULL, stderr=sp.DEVNULL, start_new_session=True)
+        timer = threading.Timer(_PAGE_TIMEOUT + time_budget / 1000, proc.kill)
+        timer.start()
+        try:
+            returncode = sp.traced_wait(proc, start)
+        finally:
+            timer.cancel()
+        elapsed = time.monotonic() - start
+    if returncode != 0:
+        logging.warning("  %s failed with exit code %d.", os.path.basename(page), returncode)
+        return None
+    return elapsed
+
+
+def run_workload(chrome, pages, runs=1, time_budget=5000, env=None):
+    """
+    Load every page runs times, one after another so timings are comparable.
+    Returns a dict page -> list of wall times in seconds of the successful runs.
+    """
+    env = dict(os.environ if env is None else env)
+    timings = {}
+    for page in pages:
+        timings[page] = [t for t in (_run_page(chrome, page, time_budget, env) for _ in range(runs))
+                         if t is not None]
+        if timings[page]:
+            logging.info("  %s: %.2fs", os.path.basename(page), min(timings[page]))
+    return timings
+
+
+def merge_profiles(llvm_profdata, profraw_dir, output_dir):
+    """
+    Merge the .profraw files of a workload run into output_dir/chrome-<hash>.profdata.
+    The name changes with the content, so builds using a new profile see new GN args.
+    """
+    profraws = sorted(glob.glob(os.path.join(profraw_dir, '*.profraw')))
+    if not profraws:
+        raise RuntimeError("The instrumented build wrote no profiles to {}.".format(profraw_dir))
+    merged = os.path.join(output_dir, 'chrome.profdata.tmp')
+    sp.check_call([llvm_profdata, 'merge', '-o', merged] + profraws)
+    h = hashlib.sha256()
+    with open(merged, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    profile = os.path.abspath(os.path.join(output_dir, 'chrome-{}.profdata'.format(h.hexdigest()[:16])))
+    os.replace(merged, profile)
+    logging.info("Merged %d raw profiles into %s.", len(profraws), profile)
+    return profile
+
+
+def _median(values):
+    values = sorted(values)
+    return (values[(len(values) - 1) // 2] + values[len(values) // 2]) / 2
+
+
+def compare_workloads(baseline, optimized):
+    """
+    Per page median times of two builds and the speedup of optimized over baseline.
+    Pages without successful runs in both are left out of the overall geometric mean.
+    """
+    pages = []
+    ratios = []
+    for page in sorted(optimized):
+        entry = {'page': page, 'baseline': None, 'optimized': None, 'speedup': None}
+        if optimized[page]:
+            entry['optimized'] = _median(optimized[page])
+        if baseline and baseline.get(page):
+            entry['baseline'] = _median(baseline[page])
+        if entry['baseline'] and entry['optimized']:
+            entry['speedup'] = entry['baseline'] / entry['optimized']
+            ratios.append(entry['speedup'])
+        pages.append(entry)
+    return {
+        'pages': pages,
+        'speedup': math.exp(sum(math.log(r) for r in ratios) / len(ratios)) if ratios else None,
+    }
+
+
+def write_pgo_report(path, report):
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    os.replace(path + '.tmp', path)
+    for entry in report['pages']:
+        if entry['speedup'] is not None:
+            logging.info("  %s: %.2fs -> %.2fs (%.2fx)", os.path.basename(entry['page']),
+                         entry['baseline'], entry['optimized'], entry['speedup'])
+    if report['speedup'] is not None:
+        logging.info("PGO: %.2fx faster on the workload (geometric mean), report in %s.", report['speedup'], path)
+    else:
+        logging.info("PGO: no baseline to compare with, report in %s.", path)
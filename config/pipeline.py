@@ -0,0 +1,103 @@
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from config.constants import PIPELINE_STATE_FILE
+from config.tracing import trace_span
+
+
+class Pipeline:
+    """
+    Runs named steps as a dependency graph, steps whose dependencies are done run in parallel.
+    Completed steps are saved to a state file so that a failed run resumes where it stopped.
+    The state is only reused if it was written for the same key, and is removed when all steps succeed.
+    """
+
+    def __init__(self, key, state_file=PIPELINE_STATE_FILE, max_workers=4):
+        self.key = key
+        self.state_file = state_file
+        self.max_workers = max_workers
+        self.steps = {}
+        self.completed = []
+        self._lock = threading.Lock()
+        if os.path.exists(state_file):
+            try:
+                with open(state_file, 'r', encoding='utf-8') as f:
+                    state = json.load(f)
+                if state.get('key') == key:
+                    self.completed = state.get('completed', [])
+                else:
+                    logging.info("Pipeline state %s is for a different configuration, starting over.", state_file)
+            except (OSError, ValueError) as e:
+                logging.warning("Ignoring unreadable pipeline state %s: %s", state_file, e)
+
+    def add(self, name, func, deps=()):
+        """
+        Add a step. func is called without arguments.
+        """
+        for dep in deps:
+            if dep not in self.steps:
+                raise ValueError("Step {} depends on unknown step {}".format(name, dep))
+        self.steps[name] = (func, tuple(deps))
+
+    def reset(self):
+        """
+        Forget completed steps.
+        """
+        self.completed = []
+        if os.path.exists(self.state_file):
+            os.remove(self.state_file)
+
+    def run(self):
+        """
+        Run all steps not completed yet. Re-raises the first step failure after running steps finish.
+        """
+        done = set(s for s in self.completed if s in self.steps)
+        for name in done:
+            logging.info("Pipeline: %s already completed, skipping.", name)
+        pending = [s for s in self.steps if s not in done]
+        running = {}
+        error = None
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                if error is None:
+                    for name in [s for s in pending if all(d in done for d in self.steps[s][1])]:
+                        logging.info("Pipeline: starting %s.", name)
+                        running[executor.submit(self._run_step, name)] = name
+                        pending.remove(name)
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                    except BaseException as e:
+                        logging.error("Pipeline: %s failed: %s", name, e)
+                        if error is None:
+                            error = e
+                        continue
+                    done.add(name)
+                    self._mark_completed(name)
+
+        if error is not None:
+            raise error
+        self.reset()
+
+    def _run_step(self, name):
+        start = time.monotonic()
+        with trace_span(name):
+            self.steps[name][0]()
+        logging.info("Pipeline: %s finished in %.1fs.", name, time.monotonic() - start)
+
+    def _mark_completed(self, name):
+        with self._lock:
+            self.completed.append(name)
+            tmp_path = self.state_file + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'key': self.key, 'completed': self.completed}, f, indent=2)
+            os.replace(tmp_path, self.state_file)
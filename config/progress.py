@@ -0,0 +1,223 @@
+import json
+import logging
+import os
+import re
+import socket
+import sys
+import threading
+import time
+
+from config import tracing as sp
+from config.constants import NINJA_HISTORY_FILE
+from config.ninja_log import NinjaHistory
+
+# Finished and total edges, then running edges; the default is '[%f/%t] '
+NINJA_STATUS = '[%f/%t %r] '
+_STATUS_RE = re.compile(r'^\[(\d+)/(\d+) (\d+)\] (.*)$')
+# Progress events per build are limited to this rate, except the last one
+_EVENT_INTERVAL = 0.25
+# Below this much observed work the throughput is not trusted yet
+_MIN_RATE_WORK_MS = 60000
+_DEFAULT_EDGE_MS = 1000
+_sinks = {}
+_sinks_lock = threading.Lock()
+
+
+class ProgressSink:
+    """
+    Writes events as JSON lines to a file, or to a unix socket if the target starts with
+    'unix:'. Writing never fails the build: if the target goes away, events are dropped.
+    """
+
+    def __init__(self, target):
+        self.target = target
+        self._lock = threading.Lock()
+        self._sock = None
+        self._file = None
+        try:
+            if target.startswith('unix:'):
+                self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self._sock.connect(target[len('unix:'):])
+            else:
+                self._file = open(target, 'a', encoding='utf-8')
+        except OSError as e:
+            logging.warning("Cannot write build progress to %s: %s", target, e)
+            self.close()
+
+    def write(self, event):
+        line = json.dumps(event, sort_keys=True) + '\n'
+        with self._lock:
+            try:
+                if self._sock is not None:
+                    self._sock.sendall(line.encode('utf-8'))
+                elif self._file is not None:
+                    self._file.write(line)
+                    self._file.flush()
+            except OSError as e:
+                logging.warning("Stopped writing build progress to %s: %s", self.target, e)
+                self.close()
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def progress_sink(target):
+    """
+    Shared ProgressSink of a target, so that parallel builds write to one file or connection.
+    """
+    with _sinks_lock:
+        if target not in _sinks:
+            _sinks[target] = ProgressSink(target)
+        return _sinks[target]
+
+
+def _edge_output(description):
+    # Descriptions look like 'CXX obj/base/base/file.o', the output is the last word
+    return description.rsplit(' ', 1)[-1]
+
+
+class BuildProgress:
+    """
+    Turns ninja status lines of one build into progress events with an ETA.
+    Every edge is weighted with its duration in the latest recorded build of the same output
+    folder. The remaining work is the number of edges left times the mean weight of recorded
+    edges that did not run yet, which makes links and other slow steps at the end count. It is
+    divided by the work finished per second in this ninja run, or by the number of running
+    edges until enough work finished to measure that.
+    """
+
+    def __init__(self, name, output_dir, sink, history_path=NINJA_HISTORY_FILE):
+        self.name = name
+        self.output_dir = os.path.abspath(output_dir)
+        self.sink = sink
+        self.expected = {}
+        if os.path.exists(history_path):
+            history = NinjaHistory(history_path)
+            try:
+                self.expected = history.latest_durations(self.output_dir)
+            finally:
+                history.close()
+        self.default_ms = (sorted(self.expected.values())[len(self.expected) // 2]
+                           if self.expected else _DEFAULT_EDGE_MS)
+        self._unseen_ms = sum(self.expected.values())
+        self._unseen = len(self.expected)
+        self._seen = set()
+        self.start = time.time()
+        self.finished = 0
+        self.total = 0
+        self.running = 0
+        self._run_start = None
+        self._run_work = 0
+        self._last_event = 0
+
+    def env(self):
+        return {'NINJA_STATUS': NINJA_STATUS}
+
+    def _event(self, name, **fields):
+        if self.sink is not None:
+            self.sink.write(dict(fields, event=name, build=self.name, time=round(time.time(), 3)))
+
+    def begin(self):
+        """
+        Start of a ninja run. Ninja counts edges per run, so a restarted build starts over.
+        """
+        self._run_start = None
+        self._run_work = 0
+        self._event('start', output_dir=self.output_dir, history_edges=len(self.expected))
+
+    def eta(self, now=None):
+        """
+        Predicted seconds until the build finishes, or None before the first status line.
+        """
+        if self._run_start is None:
+            return None
+        remaining = self.total - self.finished
+        if remaining <= 0:
+            return 0.0
+        mean_ms = self._unseen_ms / self._unseen if self._unseen else self.default_ms
+        work = remaining * mean_ms
+        elapsed_ms = ((now or time.monotonic()) - self._run_start) * 1000
+        if self._run_work >= _MIN_RATE_WORK_MS and elapsed_ms > 0:
+            rate = self._run_work / elapsed_ms
+        else:
+            rate = max(1, self.running)
+        return work / rate / 1000
+
+    def feed(self, line):
+        """
+        Parse one line of ninja output. Returns True if it was a status line.
+        """
+        match = _STATUS_RE.match(line.rstrip('\n'))
+        if match is None:
+            return False
+        finished, total, running = int(match.group(1)), int(match.group(2)), int(match.group(3))
+        now = time.monotonic()
+        if self._run_start is None:
+            self._run_start = now
+        self.finished, self.total, self.running = finished, total, running
+
+        output = _edge_output(match.group(4))
+        if output not in self._seen:
+            self._seen.add(output)
+            if output in self.expected:
+                self._unseen -= 1
+                self._unseen_ms -= self.expected[output]
+        self._run_work += self.expected.get(output, self.default_ms)
+
+        if now - self._last_event >= _EVENT_INTERVAL or finished == total:
+            self._last_event = now
+            eta = self.eta(now)
+            self._event('progress', finished=finished, total=total, running=running, edge=match.group(4),
+                        elapsed=round(time.time() - self.start, 1), eta=round(eta, 1),
+                        eta_time=round(time.time() + eta, 1))
+        return True
+
+    def follow(self, stream, echo=None):
+        """
+        Feed lines from a ninja output stream until it closes, echoing them to echo (stdout).
+        """
+        echo = echo or sys.stdout
+        for raw in iter(stream.readline, b''):
+            line = raw.decode('utf-8', errors='replace')
+            echo.write(line)
+            echo.flush()
+            self.feed(line)
+
+    def end(self, returncode):
+        self._event('end', returncode=returncode, finished=self.finished, total=self.total,
+                    elapsed=round(time.time() - self.start, 1))
+
+
+def start_with_progress(cmd, progress, **kwargs):
+    """
+    Start cmd with its output piped through progress. Returns (Popen, reader thread).
+    """
+    progress.begin()
+    proc = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.STDOUT, **kwargs)
+    reader = threading.Thread(target=progress.follow, args=(proc.stdout,), daemon=True)
+    reader.start()
+    return proc, reader
+
+
+def run_with_progress(cmd, progress, **kwargs):
+    """
+    check_call for ninja that reports progress. Raises CalledProcessError on failure.
+    """
+    start = time.monotonic()
+    proc, reader = start_with_progress(cmd, progress, **kwargs)
+    try:
+        returncode = sp.traced_wait(proc, start, kwargs.get('cwd'))
+    except BaseException:
+        proc.kill()
+        raise
+    finally:
+        reader.join()
+        proc.stdout.close()
+    progress.end(returncode)
+    if returncode != 0:
+        raise sp.CalledProcessError(returncode, cmd)
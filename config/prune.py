@@ -0,0 +1,143 @@
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config.constants import PRUNE_INDEX_FILE
+from config.tracing import trace_span
+
+
+class PruneReport:
+    """
+    Outcome of a pruning run. unexpected holds entries that are folders or could not be removed.
+    """
+
+    def __init__(self):
+        self.removed = []
+        self.missing = []
+        self.unexpected = []
+        self.skipped = 0
+        self._lock = threading.Lock()
+
+    @property
+    def ok(self):
+        return not self.missing and not self.unexpected
+
+    def add(self, removed, missing, unexpected):
+        with self._lock:
+            self.removed += removed
+            self.missing += missing
+            self.unexpected += unexpected
+
+    def to_dict(self):
+        return {
+            'removed': sorted(self.removed),
+            'missing': sorted(self.missing),
+            'unexpected': sorted(self.unexpected),
+            'skipped': self.skipped,
+        }
+
+    def log(self, name='pruning'):
+        logging.info("%s: %d removed, %d already pruned, %d missing, %d unexpected.", name,
+                     len(self.removed), self.skipped, len(self.missing), len(self.unexpected))
+        for path in sorted(self.missing)[:10]:
+            logging.warning("  missing: %s", path)
+        for path in sorted(self.unexpected)[:10]:
+            logging.warning("  unexpected: %s", path)
+
+
+class PruneIndex:
+    """
+    Paths already pruned from a source tree, valid for one source revision. The index is
+    cleared when the tree is synced, restored or snapshotted, and an indexed path is only
+    skipped while it does not exist, so files a reset or checkout brings back are pruned.
+    """
+
+    def __init__(self, head, path=PRUNE_INDEX_FILE):
+        self.head = head
+        self.path = path
+        self.pruned = set()
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                if data.get('head') == head and head is not None:
+                    self.pruned = set(data.get('pruned', []))
+            except (OSError, ValueError) as e:
+                logging.warning("Ignoring unreadable prune index %s: %s", path, e)
+
+    def clear(self):
+        self.pruned = set()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def add(self, paths):
+        self.pruned.update(paths)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'head': self.head, 'pruned': sorted(self.pruned)}, f)
+        os.replace(tmp_path, self.path)
+
+
+def _prune_dir(source_tree, directory, names):
+    """
+    Remove names from one folder, listing it once and unlinking relative to its descriptor.
+    Returns (removed, missing, unexpected) relative paths.
+    """
+    removed, missing, unexpected = [], [], []
+    path = os.path.join(source_tree, directory)
+    try:
+        with os.scandir(path) as it:
+            entries = {e.name: e for e in it if e.name in names}
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    except (FileNotFoundError, NotADirectoryError):
+        return removed, [os.path.join(directory, n) for n in names], unexpected
+    try:
+        for name in names:
+            rel = os.path.join(directory, name)
+            entry = entries.get(name)
+            if entry is None:
+                missing.append(rel)
+            elif entry.is_dir(follow_symlinks=False):
+                unexpected.append(rel)
+            else:
+                try:
+                    os.unlink(name, dir_fd=fd)
+                    removed.append(rel)
+                except OSError as e:
+                    logging.debug("Cannot prune %s: %s", rel, e)
+                    unexpected.append(rel)
+    finally:
+        os.close(fd)
+    return removed, missing, unexpected
+
+
+def prune_binaries(source_tree, entries, jobs=None, index=None):
+    """
+    Delete the files in entries (paths relative to source_tree) with a thread pool, one task
+    per folder. Entries already in index that do not exist are skipped, and removed or missing
+    ones are added. Returns a PruneReport.
+    """
+    report = PruneReport()
+    groups = {}
+    for entry in dict.fromkeys(entries):
+        if index is not None and entry in index.pruned and not os.path.lexists(os.path.join(source_tree, entry)):
+            report.skipped += 1
+            continue
+        if os.path.isabs(entry) or '..' in entry.split('/'):
+            report.unexpected.append(entry)
+            continue
+        directory, name = os.path.split(entry)
+        groups.setdefault(directory, []).append(name)
+
+    start = time.monotonic()
+    with trace_span('prune'):
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            for result in executor.map(lambda item: _prune_dir(source_tree, *item), groups.items()):
+                report.add(*result)
+    if index is not None:
+        index.add(report.removed + report.missing)
+    logging.debug("Pruned %d folders in %.1fs.", len(groups), time.monotonic() - start)
+    return report
@@ -0,0 +1,330 @@
+import json
+import logging
+import math
+import os
+import signal
+import threading
+import time
+
+from config import tracing as sp
+from config.constants import SCHEDULER_PROFILE_FILE
+from config.progress import start_with_progress
+
+GiB = 1 << 30
+
+# Estimates used until a build of the configuration has been observed
+_DEFAULT_COMPILE_MEM = 1 * GiB
+_DEFAULT_LINK_MEM = {True: 4 * GiB, False: 12 * GiB}
+# Fraction of memory the build may plan for, the rest is left to the system and page cache
+_MEMORY_BUDGET = 0.9
+# Restart ninja with fewer jobs when available memory stays below this
+_LOW_MEMORY_FRACTION = 0.05
+_LOW_MEMORY_MIN = 2 * GiB
+_SAMPLE_INTERVAL = 2
+_LINKERS = ('ld.lld', 'lld', 'ld', 'ld.gold', 'ld.bfd')
+# Builds of several configurations update the profile at once
+_lock = threading.Lock()
+# Of ninja processes running at once, only one backs off per low memory episode
+_BACKOFF_GRACE = 30
+_last_backoff = [float('-inf')]
+
+
+def _read(path):
+    try:
+        with open(path, 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _cgroup_dirs(controller):
+    """
+    Candidate cgroup folders of this process for a controller, innermost first.
+    """
+    dirs = []
+    cgroup = _read('/proc/self/cgroup') or ''
+    for line in cgroup.splitlines():
+        hierarchy, controllers, path = line.split(':', 2)
+        if hierarchy == '0' and controllers == '':
+            dirs.append(os.path.join('/sys/fs/cgroup', path.lstrip('/')))
+        elif controller in controllers.split(','):
+            for mount in (controller, controllers):
+                dirs.append(os.path.join('/sys/fs/cgroup', mount, path.lstrip('/')))
+    # Inside a container the process' own cgroup is usually mounted at the root
+    dirs += ['/sys/fs/cgroup', os.path.join('/sys/fs/cgroup', controller)]
+    return dirs
+
+
+def cgroup_cpu_limit():
+    """
+    CPU quota of the cgroup (v2 cpu.max or v1 cfs quota), or None if unlimited.
+    """
+    for d in _cgroup_dirs('cpu'):
+        cpu_max = _read(os.path.join(d, 'cpu.max'))
+        if cpu_max:
+            quota, _, period = cpu_max.partition(' ')
+            if quota != 'max':
+                return int(quota) / int(period or 100000)
+            return None
+        quota = _read(os.path.join(d, 'cpu.cfs_quota_us'))
+        if quota:
+            period = _read(os.path.join(d, 'cpu.cfs_period_us')) or '100000'
+            return int(quota) / int(period) if int(quota) > 0 else None
+    return None
+
+
+def cgroup_memory():
+    """
+    Memory limit and current usage of the cgroup in bytes, (None, None) if unlimited.
+    """
+    for d in _cgroup_dirs('memory'):
+        limit = _read(os.path.join(d, 'memory.max'))
+        usage_file = 'memory.current'
+        if limit is None:
+            limit = _read(os.path.join(d, 'memory.limit_in_bytes'))
+            usage_file = 'memory.usage_in_bytes'
+        if limit is None:
+            continue
+        # v1 reports a huge number when there is no limit
+        if limit == 'max' or int(limit) >= 1 << 60:
+            return None, None
+        usage = _read(os.path.join(d, usage_file))
+        return int(limit), int(usage) if usage else 0
+    return None, None
+
+
+def _meminfo():
+    info = {}
+    for line in (_read('/proc/meminfo') or '').splitlines():
+        name, _, value = line.partition(':')
+        parts = value.split()
+        if parts:
+            info[name] = int(parts[0]) * 1024
+    return info
+
+
+def available_cpus():
+    """
+    Number of CPUs this process can use, honoring affinity and cgroup quota.
+    """
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    quota = cgroup_cpu_limit()
+    if quota is not None:
+        cpus = min(cpus, max(1, math.ceil(quota)))
+    return cpus
+
+
+def total_memory():
+    """
+    Memory the build can use in total, honoring the cgroup limit.
+    """
+    total = _meminfo().get('MemTotal', 0)
+    limit, _ = cgroup_memory()
+    return min(total, limit) if limit is not None else total
+
+
+def available_memory():
+    """
+    Memory available right now, honoring the cgroup limit.
+    """
+    available = _meminfo().get('MemAvailable', 0)
+    limit, usage = cgroup_memory()
+    if limit is not None:
+        available = min(available, limit - usage)
+    return max(0, available)
+
+
+class ResourceProfile:
+    """
+    Learned per-process peak memory of compile and link jobs for an output folder, and the
+    concurrent_links planned with them for the next build.
+    """
+
+    def __init__(self, name, debug, path=SCHEDULER_PROFILE_FILE):
+        self.name = name
+        self.path = path
+        self.compile_mem = _DEFAULT_COMPILE_MEM
+        self.link_mem = _DEFAULT_LINK_MEM[debug]
+        self.concurrent_links = None
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    entry = json.load(f).get(name, {})
+                self.compile_mem = entry.get('compile_mem', self.compile_mem)
+                self.link_mem = entry.get('link_mem', self.link_mem)
+                self.concurrent_links = entry.get('concurrent_links')
+            except (OSError, ValueError) as e:
+                logging.warning("Ignoring unreadable scheduler profile %s: %s", path, e)
+
+    def update(self, compile_peak, link_peak):
+        """
+        Blend observed peaks into the estimates. Estimates grow at once and shrink slowly.
+        """
+        if compile_peak:
+            self.compile_mem = int(max(compile_peak, 0.8 * self.compile_mem + 0.2 * compile_peak))
+        if link_peak:
+            self.link_mem = int(max(link_peak, 0.8 * self.link_mem + 0.2 * link_peak))
+        self.concurrent_links = plan_concurrent_links(self)
+        with _lock:
+            data = {}
+            if os.path.exists(self.path):
+                try:
+                    with open(self.path, 'r', encoding='utf-8') as f:
+                        data = json.load(f)
+                except (OSError, ValueError):
+                    data = {}
+            data[self.name] = {'compile_mem': self.compile_mem, 'link_mem': self.link_mem,
+                               'concurrent_links': self.concurrent_links, 'updated': time.time()}
+            with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(data, f, indent=2, sort_keys=True)
+            os.replace(self.path + '.tmp', self.path)
+
+
+def _link_step(links):
+    """
+    Round down to 1, 2, 3, 4, 6, 8, 12, 16, ... so small changes of the estimates keep the value.
+    """
+    step = 1
+    while step * 2 <= links:
+        step *= 2
+    return step * 3 // 2 if step >= 2 and links >= step * 3 // 2 else step
+
+
+def plan_concurrent_links(profile):
+    """
+    Number of links that fit in memory at once, based on total memory. The value planned before
+    is kept while it still fits and at least half as many links as fit now, a new one is
+    rounded to a coarse step. So args.gn, and with it the build stamp, does not change with
+    every learned peak.
+    """
+    fit = max(1, min(available_cpus(), int(total_memory() * _MEMORY_BUDGET // profile.link_mem)))
+    if profile.concurrent_links and profile.concurrent_links <= fit < 2 * profile.concurrent_links:
+        return profile.concurrent_links
+    return _link_step(fit)
+
+
+def plan_jobs(profile, share=1.0):
+    """
+    Number of parallel ninja jobs that fit in the CPUs and currently available memory.
+    With several ninja processes at once, each gets share of the memory. The CPUs are not
+    split, ninja -l keeps the combined load in check.
+    """
+    cpus = available_cpus()
+    memory = available_memory() * share
+    jobs = max(1, min(cpus, int(memory * _MEMORY_BUDGET // profile.compile_mem)))
+    logging.info("Scheduler: %d CPUs, %.1f GiB available, %.1f GiB per compile -> -j %d.",
+                 cpus, memory / GiB, profile.compile_mem / GiB, jobs)
+    return jobs
+
+
+def _process_table():
+    """
+    Map pid -> (ppid, command name, rss in bytes) for all processes.
+    """
+    page = os.sysconf('SC_PAGE_SIZE')
+    table = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        stat = _read(os.path.join('/proc', entry, 'stat'))
+        if not stat:
+            continue
+        # comm can contain spaces, it is enclosed in the last parentheses
+        comm = stat[stat.index('(') + 1:stat.rindex(')')]
+        fields = stat[stat.rindex(')') + 2:].split()
+        table[int(entry)] = (int(fields[1]), comm, int(fields[21]) * page)
+    return table
+
+
+class BuildMonitor(threading.Thread):
+    """
+    Samples memory of the process tree under a pid. Records the peak RSS of compile and link
+    processes, and sets low_memory when available memory stays under the low watermark.
+    When several builds are monitored, only the first to notice interrupts its ninja, the
+    others wait _BACKOFF_GRACE seconds for memory to be freed.
+    """
+
+    def __init__(self, root_pid):
+        super().__init__(daemon=True)
+        self.root_pid = root_pid
+        self.compile_peak = 0
+        self.link_peak = 0
+        self.low_memory = False
+        self.low_watermark = max(_LOW_MEMORY_MIN, int(total_memory() * _LOW_MEMORY_FRACTION))
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def run(self):
+        low_samples = 0
+        while not self._stop_event.wait(_SAMPLE_INTERVAL):
+            table = _process_table()
+            children = {}
+            for pid, (ppid, _, _) in table.items():
+                children.setdefault(ppid, []).append(pid)
+            stack = list(children.get(self.root_pid, []))
+            while stack:
+                pid = stack.pop()
+                stack += children.get(pid, [])
+                _, comm, rss = table[pid]
+                if comm in _LINKERS:
+                    self.link_peak = max(self.link_peak, rss)
+                elif comm.startswith('clang'):
+                    self.compile_peak = max(self.compile_peak, rss)
+
+            low_samples = low_samples + 1 if available_memory() < self.low_watermark else 0
+            if low_samples >= 2 and not self.low_memory:
+                with _lock:
+                    if time.monotonic() - _last_backoff[0] < _BACKOFF_GRACE:
+                        low_samples = 0
+                        continue
+                    _last_backoff[0] = time.monotonic()
+                self.low_memory = True
+                logging.warning("Scheduler: available memory below %.1f GiB.", self.low_watermark / GiB)
+                try:
+                    os.killpg(self.root_pid, signal.SIGINT)
+                except ProcessLookupError:
+                    pass
+
+
+def run_ninja_adaptive(make_cmd, jobs, profile, progress=None, **kwargs):
+    """
+    Run ninja with make_cmd(jobs) under a memory monitor. When memory runs low, ninja is
+    interrupted and restarted with half the jobs, it picks up where it stopped.
+    Learned memory peaks are saved to the profile. If progress (a BuildProgress) is given,
+    ninja output goes through it. Raises CalledProcessError on failure.
+    """
+    while True:
+        cmd = make_cmd(jobs)
+        start = time.monotonic()
+        reader = None
+        if progress is not None:
+            proc, reader = start_with_progress(cmd, progress, start_new_session=True, **kwargs)
+        else:
+            proc = sp.Popen(cmd, start_new_session=True, **kwargs)
+        monitor = BuildMonitor(proc.pid)
+        monitor.start()
+        try:
+            returncode = sp.traced_wait(proc, start, kwargs.get('cwd'))
+        except BaseException:
+            os.killpg(proc.pid, signal.SIGINT)
+            proc.wait()
+            raise
+        finally:
+            monitor.stop()
+            profile.update(monitor.compile_peak, monitor.link_peak)
+            if reader is not None:
+                reader.join()
+                proc.stdout.close()
+        if progress is not None:
+            progress.end(returncode)
+
+        if monitor.low_memory and jobs > 1:
+            jobs = max(1, jobs // 2)
+            logging.warning("Scheduler: restarting ninja with -j %d.", jobs)
+            continue
+        if returncode != 0:
+            raise sp.CalledProcessError(returncode, cmd)
+        return
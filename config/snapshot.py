@@ -0,0 +1,264 @@
+import fcntl
+import json
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config import tracing as sp
+from config.constants import SNAPSHOT_DIR
+from config.tracing import trace_span
+
+# ioctl to share the extents of one file with another on btrfs and XFS
+_FICLONE = 0x40049409
+_MANIFEST = '.snapshot.json'
+_TMP_SUFFIX = '.snapshot.tmp'
+# Files only GN output folders have, some third party sources ship a build.ninja
+_BUILD_FILES = ('args.gn', 'build.ninja.d')
+
+
+def reflink(src, dst):
+    """
+    Copy-on-write copy of a file. Raises OSError if the file system does not support it.
+    """
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+    shutil.copymode(src, dst)
+
+
+def _walk(root, excludes, descend=None, rel=''):
+    """
+    Yield (relative path, DirEntry) of everything under root, parents before children.
+    Folders named .git and relative paths in excludes are skipped. A folder is only entered
+    if descend(relative path) is true, which is checked after the folder was yielded.
+    """
+    with os.scandir(os.path.join(root, rel)) as it:
+        entries = list(it)
+    for entry in entries:
+        path = os.path.join(rel, entry.name)
+        if entry.name == '.git' or path in excludes:
+            continue
+        yield path, entry
+        if entry.is_dir(follow_symlinks=False) and (descend is None or descend(path)):
+            yield from _walk(root, excludes, descend, path)
+
+
+def _has_build_files(path):
+    return any(os.path.exists(os.path.join(path, name)) for name in _BUILD_FILES)
+
+
+def is_build_dir(path):
+    """
+    Whether path is a GN output folder or an output base holding some, e.g. out or out/Release.
+    """
+    if _has_build_files(path):
+        return True
+    try:
+        with os.scandir(path) as it:
+            return any(e.is_dir(follow_symlinks=False) and _has_build_files(e.path) for e in it)
+    except OSError:
+        return False
+
+
+def git_tree_dirty(source_dir):
+    """
+    Whether git reports changed or deleted tracked files in source_dir.
+    False if source_dir is not a git checkout, e.g. one from a release tarball.
+    """
+    result = sp.run(['git', 'status', '--porcelain', '--untracked-files=no', '--ignore-submodules=all'],
+                    cwd=source_dir, encoding='utf-8', capture_output=True)
+    return result.returncode == 0 and bool(result.stdout.strip())
+
+
+def _stat_key(st):
+    return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+
+class SourceSnapshot:
+    """
+    Pristine copy of a source tree that can be restored quickly before patching again.
+    Files are reflinked where the file system supports it, otherwise hard linked. A hard linked
+    file shares its content with the tree, so tools must replace files instead of writing them
+    in place; domain substitution and patch do so. Restoring refuses a hard linked snapshot
+    that was changed through the tree.
+    Restoring only touches files that were changed, added or removed since the snapshot, and
+    gives restored files a new mtime so that ninja rebuilds what depends on them.
+    Build output folders are neither snapshotted nor removed by a restore, and neither are
+    top level folders created after the snapshot.
+    """
+
+    def __init__(self, source_dir, snapshot_dir=SNAPSHOT_DIR, excludes=()):
+        self.source_dir = source_dir
+        self.snapshot_dir = snapshot_dir
+        self.excludes = set(os.path.normpath(e) for e in excludes)
+        self.manifest_path = os.path.join(snapshot_dir, _MANIFEST)
+        self.head = None
+        self.mode = None
+        self.files = {}
+        self.dirs = set()
+        if os.path.exists(self.manifest_path):
+            try:
+                with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                self.head = data['head']
+                self.mode = data['mode']
+                self.files = data['files']
+                self.dirs = set(data['dirs'])
+            except (OSError, ValueError, KeyError) as e:
+                logging.warning("Ignoring unreadable source snapshot %s: %s", self.manifest_path, e)
+                self.mode = None
+
+    def exists(self):
+        return self.mode is not None
+
+    def _save(self):
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'head': self.head, 'mode': self.mode, 'files': self.files, 'dirs': sorted(self.dirs)}, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _excludes(self):
+        # Output folders of any output base, not only the excluded ones
+        with os.scandir(self.source_dir) as it:
+            builds = set(e.name for e in it if e.is_dir(follow_symlinks=False) and is_build_dir(e.path))
+        return self.excludes | builds
+
+    def _copy(self, src, dst):
+        if os.path.islink(src):
+            os.symlink(os.readlink(src), dst)
+        elif self.mode == 'reflink':
+            reflink(src, dst)
+        else:
+            os.link(src, dst)
+
+    def delete(self):
+        """
+        Remove the snapshot, e.g. because the source tree was synced.
+        """
+        if os.path.exists(self.snapshot_dir):
+            logging.info("Removing source snapshot %s.", self.snapshot_dir)
+            shutil.rmtree(self.snapshot_dir)
+        self.mode = None
+        self.files = {}
+        self.dirs = set()
+
+    def take(self, head, jobs=None):
+        """
+        Snapshot the source tree, which must be pristine. head identifies the source revision.
+        Raises RuntimeError if git reports changed tracked files.
+        """
+        if git_tree_dirty(self.source_dir):
+            raise RuntimeError("{} has local changes and cannot be snapshotted as pristine, "
+                               "run sync --reset first.".format(self.source_dir))
+        self.delete()
+        start = time.monotonic()
+        with trace_span('snapshot_take'):
+            os.makedirs(self.snapshot_dir)
+            files = []
+            for rel, entry in _walk(self.source_dir, self._excludes()):
+                if entry.is_dir(follow_symlinks=False):
+                    os.mkdir(os.path.join(self.snapshot_dir, rel))
+                    self.dirs.add(rel)
+                else:
+                    files.append(rel)
+
+            # Use reflinks if the first regular file can be cloned
+            self.mode = 'hardlink'
+            for rel in files:
+                src = os.path.join(self.source_dir, rel)
+                if os.path.islink(src):
+                    continue
+                probe = os.path.join(self.snapshot_dir, rel)
+                try:
+                    reflink(src, probe)
+                    self.mode = 'reflink'
+                except OSError:
+                    pass
+                finally:
+                    if os.path.exists(probe):
+                        os.remove(probe)
+                break
+
+            def copy(rel):
+                self._copy(os.path.join(self.source_dir, rel), os.path.join(self.snapshot_dir, rel))
+                return rel, _stat_key(os.lstat(os.path.join(self.source_dir, rel)))
+
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                self.files = dict(executor.map(copy, files, chunksize=256))
+            self.head = head
+            self._save()
+        logging.info("Snapshot of %d files taken with %ss in %.1fs.",
+                     len(self.files), self.mode, time.monotonic() - start)
+
+    def restore(self, jobs=None):
+        """
+        Bring the source tree back to the snapshot. Returns the number of files restored and removed.
+        Raises RuntimeError and removes the snapshot if a hard linked file was written in place.
+        """
+        start = time.monotonic()
+        restore = set(self.files)
+        stale = []
+        shared = []
+        with trace_span('snapshot_restore'):
+            for rel, entry in _walk(self.source_dir, self._excludes(), descend=self.dirs.__contains__):
+                path = os.path.join(self.source_dir, rel)
+                if entry.is_dir(follow_symlinks=False):
+                    if rel not in self.dirs:
+                        if os.sep not in rel or is_build_dir(path):
+                            logging.debug("Keeping %s, it is not in the source snapshot.", rel)
+                            continue
+                        stale.append(rel)
+                    continue
+                if rel not in self.files:
+                    stale.append(rel)
+                    continue
+                st = entry.stat(follow_symlinks=False)
+                if _stat_key(st) == self.files[rel]:
+                    restore.discard(rel)
+                elif self.mode == 'hardlink' and st.st_nlink > 1 and st.st_ino == self.files[rel][0]:
+                    # Written in place, the snapshot has the same changes
+                    shared.append(rel)
+
+            if shared:
+                self.delete()
+                raise RuntimeError("{} files were changed in place and the hard linked source snapshot with them, "
+                                   "e.g. {}. The snapshot was removed, run sync --reset to get a pristine tree."
+                                   .format(len(shared), shared[0]))
+
+            for rel in stale:
+                path = os.path.join(self.source_dir, rel)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            removed = len(stale)
+
+            for rel in sorted(self.dirs):
+                path = os.path.join(self.source_dir, rel)
+                if os.path.islink(path) or (os.path.exists(path) and not os.path.isdir(path)):
+                    os.remove(path)
+                    removed += 1
+                os.makedirs(path, exist_ok=True)
+
+            now = time.time()
+
+            def copy(rel):
+                dst = os.path.join(self.source_dir, rel)
+                if os.path.isdir(dst) and not os.path.islink(dst):
+                    shutil.rmtree(dst)
+                tmp_path = dst + _TMP_SUFFIX
+                if os.path.lexists(tmp_path):
+                    os.remove(tmp_path)
+                self._copy(os.path.join(self.snapshot_dir, rel), tmp_path)
+                os.replace(tmp_path, dst)
+                if not os.path.islink(dst):
+                    os.utime(dst, (now, now))
+                return rel, _stat_key(os.lstat(dst))
+
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                self.files.update(executor.map(copy, sorted(restore), chunksize=64))
+            self._save()
+        logging.info("Restored %d and removed %d files from the source snapshot in %.1fs.",
+                     len(restore), removed, time.monotonic() - start)
+        return len(restore), removed
@@ -0,0 +1,139 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from config.constants import STAMP_FILE
+
+# Stages of several configurations can finish concurrently
+_lock = threading.Lock()
+
+
+def hash_file(path):
+    """
+    Return sha256 of a file's content, or None if the file does not exist.
+    """
+    if not os.path.isfile(path):
+        return None
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def hash_files(paths):
+    """
+    Fingerprint a sequence of files by name and content.
+    """
+    return fingerprint([(p, hash_file(p)) for p in paths])
+
+
+def fingerprint(value):
+    """
+    Stable sha256 of a JSON serializable value.
+    """
+    data = json.dumps(value, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class StampManifest:
+    """
+    Keeps fingerprints of stage inputs so stages with unchanged inputs can be skipped.
+    Every stage entry records whether it ran on its last invocation and why.
+    """
+
+    def __init__(self, path=STAMP_FILE):
+        self.path = path
+        self.stages = {}
+        self._load()
+
+    def _load(self):
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self.stages = json.load(f).get('stages', {})
+            except (OSError, ValueError) as e:
+                logging.warning("Ignoring unreadable stamp manifest %s: %s", self.path, e)
+
+    def check(self, stage, inputs):
+        """
+        Compare inputs (a dict of name -> fingerprint) with the ones recorded for stage.
+        Returns a tuple (fresh, reason).
+        """
+        if inputs is None:
+            return False, 'inputs not available'
+        entry = self.stages.get(stage)
+        if entry is None:
+            return False, 'no previous stamp'
+        if not entry.get('complete'):
+            return False, 'previous run did not complete'
+        recorded = entry.get('inputs', {})
+        changed = sorted(k for k in set(recorded) | set(inputs) if recorded.get(k) != inputs.get(k))
+        if changed:
+            return False, 'inputs changed: ' + ', '.join(changed)
+        return True, 'inputs unchanged'
+
+    def begin(self, stage, reason):
+        """
+        Mark stage as running. The stamp is only valid after complete().
+        """
+        logging.info("Running stage %s (%s).", stage, reason)
+        with _lock:
+            self._load()
+            self.stages[stage] = {
+                'ran': True,
+                'reason': reason,
+                'complete': False,
+                'started': time.time(),
+            }
+            self.save()
+
+    def complete(self, stage, inputs):
+        """
+        Record the inputs of a finished stage.
+        """
+        with _lock:
+            self._load()
+            entry = self.stages.setdefault(stage, {'ran': True, 'reason': ''})
+            entry.update({
+                'inputs': inputs,
+                'complete': True,
+                'finished': time.time(),
+            })
+            self.save()
+
+    def skip(self, stage, reason):
+        """
+        Record that a stage was skipped.
+        """
+        logging.info("Skipping stage %s (%s).", stage, reason)
+        with _lock:
+            self._load()
+            entry = self.stages.setdefault(stage, {})
+            entry.update({
+                'ran': False,
+                'reason': reason,
+                'checked': time.time(),
+            })
+            self.save()
+
+    def invalidate(self, *stages):
+        """
+        Drop stamps of the given stages, or of all stages if none is given.
+        Use a trailing ':' to drop every stage with that prefix.
+        """
+        with _lock:
+            self._load()
+            for name in list(self.stages):
+                if not stages or any(name == s or (s.endswith(':') and name.startswith(s)) for s in stages):
+                    del self.stages[name]
+            self.save()
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'stages': self.stages}, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,132 @@
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config import tracing as sp
+
+_GITLINK_MODE = b'160000'
+
+
+class Submodule:
+    """
+    A gitlink of a repository. recorded is the commit in the index, head the checked out one
+    (None if the submodule is not initialized). state is the flag of git submodule status:
+    ' ' up to date, '-' not initialized, '+' at another commit, 'U' merge conflict.
+    """
+
+    def __init__(self, path, recorded):
+        self.path = path
+        self.recorded = recorded
+        self.head = None
+        self.state = '-'
+        # Nested submodules that are not at their recorded commit
+        self.nested = []
+
+    @property
+    def needs_update(self):
+        return self.state != ' ' or bool(self.nested)
+
+    def __repr__(self):
+        return 'Submodule({!r}, {!r}, state={!r})'.format(self.path, self.recorded, self.state)
+
+
+def list_gitlinks(repo='.'):
+    """
+    Map of submodule path -> recorded commit, in index order, from one git ls-files call.
+    """
+    output = sp.check_output(['git', 'ls-files', '-z', '--stage'], cwd=repo)
+    gitlinks = {}
+    for item in output.split(b'\0'):
+        # '<mode> <object> <stage>\t<path>'
+        meta, sep, path = item.partition(b'\t')
+        if not sep:
+            continue
+        mode, sha, _ = meta.split(b' ')
+        if mode == _GITLINK_MODE:
+            gitlinks[path.decode('utf-8', 'surrogateescape')] = sha.decode()
+    return gitlinks
+
+
+def _parse_status(output):
+    """
+    Yield (state, commit, path) from git submodule status output.
+    """
+    for line in output.splitlines():
+        if not line:
+            continue
+        sha, _, path = line[1:].partition(' ')
+        # The path is followed by the output of git describe in parentheses, if there is one
+        if path.endswith(')') and ' (' in path:
+            path = path[:path.rindex(' (')]
+        yield line[0], sha, path
+
+
+def submodule_status(repo='.'):
+    """
+    State of every submodule of repo, nested ones included, from one git ls-files and one
+    git submodule status call. Returns a list of top level Submodules.
+    """
+    submodules = {path: Submodule(path, sha) for path, sha in list_gitlinks(repo).items()}
+    output = sp.check_output(['git', 'submodule', 'status', '--recursive'], cwd=repo, encoding='utf-8')
+    for state, sha, path in _parse_status(output):
+        if path in submodules:
+            submodule = submodules[path]
+            submodule.state = state
+            submodule.head = None if state == '-' else sha
+            continue
+        if state == ' ':
+            continue
+        parent = path
+        while '/' in parent and parent not in submodules:
+            parent = parent.rsplit('/', 1)[0]
+        if parent in submodules:
+            submodules[parent].nested.append(path)
+    return list(submodules.values())
+
+
+def _update(repo, submodule, hard_reset):
+    path = os.path.join(repo, submodule.path)
+    if hard_reset and submodule.head is not None:
+        sp.check_call(['git', 'reset', '-q', '--hard'], cwd=path)
+    cmd = ['git', 'submodule', 'update', '--recursive']
+    if hard_reset:
+        cmd.append('--force')
+    sp.check_call(cmd + ['--', submodule.path], cwd=repo)
+    return submodule
+
+
+def sync_submodules(repo='.', jobs=None, hard_reset=False):
+    """
+    Bring every submodule of repo to its recorded commit. Only submodules that are not
+    initialized, or whose checkout or a nested one differs from the recorded commit, are
+    touched; they are updated on a pool of jobs workers. With hard_reset, local changes in
+    those submodules are discarded first. Returns the updated Submodules.
+    """
+    start = time.monotonic()
+    submodules = submodule_status(repo)
+    pending = [s for s in submodules if s.needs_update]
+    logging.info("Submodules: %d of %d need an update.", len(pending), len(submodules))
+    if not pending:
+        return []
+
+    # init writes the superproject config, do it once for all before the parallel updates
+    uninitialized = [s.path for s in pending if s.state == '-']
+    if uninitialized:
+        sp.check_call(['git', 'submodule', 'init', '--'] + uninitialized, cwd=repo)
+
+    errors = []
+    updated = []
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(_update, repo, s, hard_reset) for s in pending]
+        for submodule, future in zip(pending, futures):
+            try:
+                updated.append(future.result())
+                logging.debug("Submodule %s updated to %s.", submodule.path, submodule.recorded)
+            except sp.CalledProcessError as e:
+                logging.error("Updating submodule %s failed: %s", submodule.path, e)
+                errors.append(e)
+    if errors:
+        raise errors[0]
+    logging.info("Submodules: %d updated in %.1fs.", len(updated), time.monotonic() - start)
+    return updated
@@ -0,0 +1,140 @@
+import logging
+import os
+import threading
+import time
+
+from config.ccache import version_family
+from config.constants import THINLTO_CACHE_DIR
+from config.trash import move_to_trash
+
+# Folder chromium's build passes to lld with --thinlto-cache-dir, relative to the output folder
+OUTPUT_CACHE_LINK = 'thinlto-cache'
+_ENTRY_PREFIX = 'llvmcache-'
+_lock = threading.Lock()
+
+
+def _last_use(st):
+    # lld touches entries it reuses, atime catches reads on file systems that record them
+    return max(st.st_atime, st.st_mtime)
+
+
+class ThinLTOCache:
+    """
+    ThinLTO cache directories under root, one per chromium version family and output folder
+    (e.g. 95/Release_linux_x64), so point releases reuse the backend codegen of unchanged
+    modules. Chromium's build passes <out>/thinlto-cache to lld with a pruning policy of its
+    own, so no GN arg is needed; that path is a symlink to the managed directory.
+    lld prunes the cache in use by that policy. Other caches, of other configurations and
+    milestones, are only touched by prune(): after a build, their entries unused for
+    max_age_days are removed, then their least recently used entries until all caches
+    together fit in max_size.
+    """
+
+    def __init__(self, version, config_name, root=THINLTO_CACHE_DIR, max_size=40 << 30, max_age_days=14):
+        self.root = os.path.abspath(os.path.expanduser(root))
+        self.family = version_family(version)
+        self.path = os.path.join(self.root, self.family, config_name)
+        self.max_size = max_size
+        self.max_age = max_age_days * 86400
+
+    def link(self, output_dir):
+        """
+        Point output_dir/thinlto-cache at the managed directory. A cache the build created
+        there itself becomes the managed one if that is empty, otherwise it goes to the trash.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        link = os.path.join(output_dir, OUTPUT_CACHE_LINK)
+        if os.path.islink(link):
+            if os.readlink(link) == self.path:
+                return
+            os.remove(link)
+        elif os.path.isdir(link) and not os.listdir(self.path):
+            try:
+                os.rmdir(self.path)
+                os.rename(link, self.path)
+            except OSError:
+                os.makedirs(self.path, exist_ok=True)
+                move_to_trash(link)
+        elif os.path.lexists(link):
+            move_to_trash(link)
+        os.symlink(self.path, link)
+
+    def _entries(self, path):
+        """
+        Yield (path, stat) of every cache entry under path.
+        """
+        for folder, _, files in os.walk(path):
+            for name in files:
+                if name.startswith(_ENTRY_PREFIX):
+                    entry = os.path.join(folder, name)
+                    try:
+                        yield entry, os.stat(entry)
+                    except FileNotFoundError:
+                        pass
+
+    def begin(self):
+        """
+        Mark the start of a build. Returns what report() compares against.
+        """
+        return time.time(), set(os.path.basename(p) for p, _ in self._entries(self.path))
+
+    def report(self, before):
+        """
+        Log entries reused (hits) and created (misses) since begin(), and the cache size.
+        Hits are only seen where lld or the file system updates the entry's times.
+        Returns the report as a dict.
+        """
+        start, names = before
+        hits = misses = size = count = 0
+        for path, st in self._entries(self.path):
+            count += 1
+            size += st.st_blocks * 512
+            if os.path.basename(path) not in names:
+                misses += 1
+            elif _last_use(st) >= start:
+                hits += 1
+        report = {'family': self.family, 'path': self.path, 'entries': count, 'size': size,
+                  'hits': hits, 'misses': misses,
+                  'hit_rate': hits / (hits + misses) if hits + misses else 0.0}
+        logging.info("ThinLTO cache: %d hits, %d misses (%.0f%% hit rate), %d entries, %.1f GiB in %s.",
+                     hits, misses, 100 * report['hit_rate'], count, size / (1 << 30), self.path)
+        return report
+
+    def prune(self):
+        """
+        Remove expired entries of the caches not in use, then their least recently used ones
+        until the total size, the cache in use included, is under max_size. The cache in use
+        is left to lld's cache policy, so the two do not compete.
+        Returns the number of entries removed.
+        """
+        with _lock:
+            now = time.time()
+            entries = []
+            removed = freed = 0
+            active = sum(st.st_blocks * 512 for _, st in self._entries(self.path))
+            for path, st in self._entries(self.root):
+                if path.startswith(self.path + os.sep):
+                    continue
+                if now - _last_use(st) > self.max_age:
+                    os.remove(path)
+                    removed += 1
+                    freed += st.st_blocks * 512
+                else:
+                    entries.append((_last_use(st), st.st_blocks * 512, path))
+            total = active + sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_size:
+                    break
+                os.remove(path)
+                total -= size
+                freed += size
+                removed += 1
+            # Drop caches of other families that are empty now, builds of this one may still run
+            for folder, _, _ in os.walk(self.root, topdown=False):
+                family = os.path.relpath(folder, self.root).split(os.sep)[0]
+                if folder != self.root and family != self.family and not os.listdir(folder):
+                    os.rmdir(folder)
+        if removed:
+            logging.info("ThinLTO cache: removed %d entries (%.1f GiB) to stay under %.1f GiB and %d days.",
+                         removed, freed / (1 << 30), self.max_size / (1 << 30), self.max_age // 86400)
+        return removed
@@ -0,0 +1,191 @@
+"""
+Instrumented drop-in for the parts of subprocess used by this project.
+Every call records command, cwd, timing, exit code, peak RSS and block I/O. When tracing is
+enabled the records are written as Chrome trace-event JSON, which can be opened in Perfetto
+or chrome://tracing.
+"""
+import atexit
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+from subprocess import CalledProcessError, CompletedProcess, PIPE, DEVNULL, STDOUT, Popen  # noqa: F401
+
+__all__ = ['enable_tracing', 'write_trace', 'trace_span', 'traced_wait']
+
+_lock = threading.Lock()
+_events = None
+_trace_path = None
+_start = time.monotonic()
+_thread_ids = {}
+
+
+def enable_tracing(path):
+    """
+    Start collecting trace events, they are written to path on exit.
+    """
+    global _events, _trace_path
+    with _lock:
+        if _events is None:
+            _events = []
+            atexit.register(write_trace)
+        _trace_path = path
+
+
+def write_trace():
+    """
+    Write collected trace events in Chrome trace-event format.
+    """
+    if _events is None or _trace_path is None:
+        return
+    with _lock:
+        events = list(_events)
+        threads = dict(_thread_ids)
+    pid = os.getpid()
+    metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+                for tid, name in threads.values()]
+    tmp_path = _trace_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'traceEvents': metadata + events, 'displayTimeUnit': 'ms'}, f)
+    os.replace(tmp_path, _trace_path)
+    logging.info("Trace written to %s", _trace_path)
+
+
+def _tid():
+    ident = threading.get_ident()
+    with _lock:
+        if ident not in _thread_ids:
+            _thread_ids[ident] = (len(_thread_ids) + 1, threading.current_thread().name)
+        return _thread_ids[ident][0]
+
+
+def _add_event(name, category, start, end, args):
+    if _events is None:
+        return
+    event = {
+        'name': name,
+        'cat': category,
+        'ph': 'X',
+        'ts': int((start - _start) * 1e6),
+        'dur': int((end - start) * 1e6),
+        'pid': os.getpid(),
+        'tid': _tid(),
+        'args': args,
+    }
+    with _lock:
+        _events.append(event)
+
+
+@contextlib.contextmanager
+def trace_span(name, **args):
+    """
+    Record the duration of an in-process block. Yields args, which the block can add to.
+    """
+    start = time.monotonic()
+    try:
+        yield args
+    finally:
+        _add_event(name, 'step', start, time.monotonic(), args)
+
+
+def _command_name(args):
+    if isinstance(args, (str, bytes)):
+        return str(args).split(' ')[0]
+    cmd = [str(a) for a in args]
+    name = os.path.basename(cmd[0])
+    # git, gclient etc. are more useful with their sub-command
+    if len(cmd) > 1 and not cmd[1].startswith('-'):
+        name += ' ' + os.path.basename(cmd[1])
+    return name
+
+
+def traced_wait(proc, start, cwd=None):
+    """
+    Wait for a Popen object with wait4 to collect resource usage of the child and its
+    descendants, then record it. Returns the exit code.
+    """
+    rusage = None
+    while proc.returncode is None:
+        try:
+            _, status, rusage = os.wait4(proc.pid, 0)
+        except InterruptedError:
+            continue
+        except ChildProcessError:
+            proc.wait()
+            break
+        proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    end = time.monotonic()
+
+    args = proc.args
+    info = {
+        'cmd': args if isinstance(args, (str, bytes)) else ' '.join(str(a) for a in args),
+        'cwd': os.path.abspath(cwd or os.getcwd()),
+        'exit_code': proc.returncode,
+        'child_pid': proc.pid,
+    }
+    if rusage is not None:
+        info.update({
+            'peak_rss_kb': rusage.ru_maxrss,
+            'read_bytes': rusage.ru_inblock * 512,
+            'write_bytes': rusage.ru_oublock * 512,
+            'user_time': rusage.ru_utime,
+            'system_time': rusage.ru_stime,
+        })
+    _add_event(_command_name(args), 'subprocess', start, end, info)
+    logging.debug("%s exited with %s after %.1fs", info['cmd'], proc.returncode, end - start)
+    return proc.returncode
+
+
+def _communicate(proc):
+    """
+    Read captured output without reaping the child, so traced_wait can collect its rusage.
+    """
+    result = {}
+
+    def read(name, stream):
+        result[name] = stream.read()
+
+    readers = []
+    for name in ('stdout', 'stderr'):
+        stream = getattr(proc, name)
+        if stream is not None:
+            t = threading.Thread(target=read, args=(name, stream), daemon=True)
+            t.start()
+            readers.append(t)
+    for t in readers:
+        t.join()
+    return result.get('stdout'), result.get('stderr')
+
+
+def run(args, check=False, capture_output=False, **kwargs):
+    if capture_output:
+        kwargs['stdout'] = PIPE
+        kwargs['stderr'] = PIPE
+    start = time.monotonic()
+    with Popen(args, **kwargs) as proc:
+        try:
+            stdout, stderr = _communicate(proc)
+            returncode = traced_wait(proc, start, kwargs.get('cwd'))
+        except BaseException:
+            proc.kill()
+            raise
+    if check and returncode:
+        raise CalledProcessError(returncode, args, output=stdout, stderr=stderr)
+    return CompletedProcess(args, returncode, stdout, stderr)
+
+
+def call(args, **kwargs):
+    return run(args, **kwargs).returncode
+
+
+def check_call(args, **kwargs):
+    run(args, check=True, **kwargs)
+    return 0
+
+
+def check_output(args, **kwargs):
+    kwargs.setdefault('stdout', PIPE)
+    return run(args, check=True, **kwargs).stdout
@@ -0,0 +1,154 @@
+import argparse
+import errno
+import fcntl
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config import tracing as sp
+from config.constants import TRASH_DIR
+from config.tracing import trace_span
+
+_LOCK_FILE = '.lock'
+_PROGRESS_INTERVAL = 10
+
+
+def move_to_trash(path, trash_dir=TRASH_DIR):
+    """
+    Move path out of the way by renaming it into trash_dir, which is instant.
+    If trash_dir is on another file system, the trash folder next to path is used instead.
+    Returns the trash folder the path was moved to.
+    """
+    name = '{}-{}'.format(os.path.basename(os.path.normpath(path)), time.strftime('%Y%m%d-%H%M%S'))
+    for folder in (trash_dir, os.path.join(os.path.dirname(os.path.abspath(path)), TRASH_DIR)):
+        os.makedirs(folder, exist_ok=True)
+        target = os.path.join(folder, name)
+        suffix = 0
+        while os.path.lexists(target):
+            suffix += 1
+            target = os.path.join(folder, '{}.{}'.format(name, suffix))
+        try:
+            os.rename(path, target)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            continue
+        logging.info("Moved %s to %s.", path, target)
+        return folder
+    raise OSError(errno.EXDEV, "No trash folder on the file system of", path)
+
+
+class _Remover:
+    """
+    Deletes folder trees with a thread pool: every folder is a task that unlinks its files
+    and queues its subfolders. Symlinks are removed, never followed.
+    """
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.files = 0
+        self.folders = []
+        self.errors = []
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def _scan(self, executor, path):
+        files = 0
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        self._submit(executor, entry.path)
+                    else:
+                        try:
+                            os.unlink(entry.path)
+                            files += 1
+                        except FileNotFoundError:
+                            pass
+        except OSError as e:
+            self.errors.append(e)
+        with self._lock:
+            self.files += files
+            self.folders.append(path)
+            self._pending -= 1
+            if self._pending == 0:
+                self._done.set()
+
+    def _submit(self, executor, path):
+        with self._lock:
+            self._pending += 1
+        executor.submit(self._scan, executor, path)
+
+    def remove(self, roots, progress=False):
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            self._done.clear()
+            for root in roots:
+                self._submit(executor, root)
+            while roots and not self._done.wait(_PROGRESS_INTERVAL):
+                if progress:
+                    logging.info("Cleaning: %d files removed in %.0fs.", self.files, time.monotonic() - start)
+        # Children were scanned after their parents, remove folders deepest first
+        for path in sorted(self.folders, key=lambda p: -p.count(os.sep)):
+            try:
+                os.rmdir(path)
+            except OSError as e:
+                self.errors.append(e)
+
+
+def empty_trash(trash_dir=TRASH_DIR, jobs=None, progress=False):
+    """
+    Delete everything in trash_dir. Only one process empties a trash folder at a time, if another
+    one is running this waits for it. Returns the number of files removed.
+    """
+    if not os.path.isdir(trash_dir):
+        return 0
+    jobs = jobs or 4 * (os.cpu_count() or 1)
+    removed = 0
+    with open(os.path.join(trash_dir, _LOCK_FILE), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        while True:
+            entries = [os.path.join(trash_dir, e) for e in os.listdir(trash_dir) if e != _LOCK_FILE]
+            if not entries:
+                break
+            remover = _Remover(jobs)
+            for path in entries:
+                if os.path.islink(path) or not os.path.isdir(path):
+                    os.unlink(path)
+                    remover.files += 1
+            remover.remove([p for p in entries if os.path.lexists(p)], progress=progress)
+            removed += remover.files
+            if remover.errors:
+                logging.warning("Could not remove everything in %s: %s", trash_dir, remover.errors[0])
+                break
+    if progress:
+        logging.info("Trash %s emptied, %d files removed.", trash_dir, removed)
+    return removed
+
+
+def empty_trash_in_background(trash_dir=TRASH_DIR, jobs=None):
+    """
+    Start a detached process that empties trash_dir, it keeps running after this process exits.
+    It is never waited for, so the trace only has its start with the pid to find it by.
+    """
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    cmd = [sys.executable, '-m', 'config.trash', os.path.abspath(trash_dir)]
+    if jobs:
+        cmd += ['--jobs', str(jobs)]
+    with trace_span('empty_trash_background', trash_dir=trash_dir) as args:
+        proc = sp.Popen(cmd, cwd=package_root, start_new_session=True,
+                        stdin=sp.DEVNULL, stdout=sp.DEVNULL, stderr=sp.DEVNULL)
+        args['pid'] = proc.pid
+    logging.info("Emptying %s in the background (pid %d).", trash_dir, proc.pid)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Empty a trash folder')
+    parser.add_argument('trash_dir')
+    parser.add_argument('--jobs', type=int)
+    args = parser.parse_args()
+    empty_trash(args.trash_dir, args.jobs)
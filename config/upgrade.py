@@ -0,0 +1,382 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from config import tracing as sp
+from config.constants import PREPARED_DIR
+from config.patches import parse_patch, parse_series
+from config.utils import read_list_file
+
+_STATE_FILE = 'state.json'
+# Lists in the order prepare uses them, with the patch series that runs in between
+STEPS = ('pruning', 'patches', 'domsub', 'pruning_2', 'patches_2', 'domsub_2')
+
+
+def _sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class PreparedInputs:
+    """
+    The lists, domain regex and patch series a source tree is prepared with. The inputs of the
+    last prepare are kept in PREPARED_DIR, with patches stored by content hash, so that upgrade
+    can work out which files a new release affects. lists maps 'pruning', 'domsub', 'pruning_2'
+    and 'domsub_2' to entries, series maps 'patches' and 'patches_2' to (name, sha256) pairs.
+    """
+
+    def __init__(self, state, path=PREPARED_DIR, sources=None):
+        self.state = state
+        self.path = path
+        # Patches not stored yet, by hash
+        self._sources = sources or {}
+
+    @property
+    def chromium_version(self):
+        return self.state['chromium_version']
+
+    @property
+    def target_os(self):
+        return self.state['target_os']
+
+    @property
+    def lists(self):
+        return self.state['lists']
+
+    @property
+    def series(self):
+        return self.state['series']
+
+    @property
+    def regex(self):
+        return self.state['regex']
+
+    def patch_path(self, sha):
+        return self._sources.get(sha) or os.path.join(self.path, 'patches', sha + '.patch')
+
+    def touched_files(self):
+        """
+        Map of patch hash -> paths the patch touches, for all patches of all series.
+        """
+        return {sha: patch_files(self.patch_path(sha))
+                for entries in self.series.values() for _, sha in entries}
+
+    def domsub_files(self):
+        return set(p for name in ('domsub', 'domsub_2') for p in self.lists.get(name, []))
+
+    @classmethod
+    def load(cls, path=PREPARED_DIR):
+        """
+        Inputs of the last prepare, or None if they were not recorded.
+        """
+        state_file = os.path.join(path, _STATE_FILE)
+        if not os.path.exists(state_file):
+            return None
+        with open(state_file, 'r', encoding='utf-8') as f:
+            return cls(json.load(f), path)
+
+    @classmethod
+    def collect(cls, chromium_version, target_os, regex_path, list_files, patch_dirs, path=PREPARED_DIR):
+        """
+        Inputs as found in the checkouts. list_files maps list names to filtered list files,
+        patch_dirs maps series names to patch folders.
+        """
+        series = {}
+        sources = {}
+        for name, patches_dir in patch_dirs.items():
+            series[name] = []
+            for patch in parse_series(patches_dir):
+                sha = _sha256(patch)
+                sources[sha] = patch
+                series[name].append((os.path.relpath(patch, patches_dir), sha))
+        state = {
+            'chromium_version': chromium_version,
+            'target_os': target_os,
+            'regex': _sha256(regex_path),
+            'lists': {name: read_list_file(f) for name, f in list_files.items()},
+            'series': series,
+        }
+        return cls(state, path, sources)
+
+    def save(self):
+        """
+        Record these inputs as the ones of the last prepare.
+        """
+        patches_dir = os.path.join(self.path, 'patches')
+        os.makedirs(patches_dir, exist_ok=True)
+        keep = set()
+        for entries in self.series.values():
+            for _, sha in entries:
+                keep.add(sha + '.patch')
+                stored = os.path.join(patches_dir, sha + '.patch')
+                if not os.path.exists(stored):
+                    shutil.copyfile(self._sources[sha], stored + '.tmp')
+                    os.replace(stored + '.tmp', stored)
+        # Patches of older records are no longer needed
+        for name in os.listdir(patches_dir):
+            if name not in keep:
+                os.remove(os.path.join(patches_dir, name))
+        self._sources = {}
+        tmp_path = os.path.join(self.path, _STATE_FILE + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, os.path.join(self.path, _STATE_FILE))
+
+
+def patch_files(patch_path):
+    """
+    Paths a patch touches.
+    """
+    return set(p for old, new, _ in parse_patch(patch_path) for p in (old, new) if p is not None)
+
+
+def file_steps(lists, series, touched):
+    """
+    For every file named by a list or patch, what prepare does to it: a tuple with, per step,
+    whether the file is in the list or the hashes of the patches touching it in order.
+    touched maps a patch hash to the files it touches.
+    """
+    steps = {}
+    for i, step in enumerate(STEPS):
+        if step in series:
+            for _, sha in series[step]:
+                for path in touched[sha]:
+                    steps.setdefault(path, [[] for _ in STEPS])[i].append(sha)
+        else:
+            for path in lists.get(step, []):
+                steps.setdefault(path, [[] for _ in STEPS])[i] = True
+    return {path: json.dumps(s) for path, s in steps.items()}
+
+
+def affected_files(changed, old_steps, new_steps, domsub_files, regex_changed, touched):
+    """
+    Files that have to be restored from the new release and prepared again: files changed
+    upstream, files prepare treats differently, every domain substitution file if the regex
+    changed, and all files of any patch touching one of those, until nothing is added.
+    touched maps patch hashes of both releases to their files.
+    """
+    affected = set(changed)
+    for path in set(old_steps) | set(new_steps):
+        if old_steps.get(path) != new_steps.get(path):
+            affected.add(path)
+    if regex_changed:
+        affected |= domsub_files
+    by_file = {}
+    for sha, files in touched.items():
+        for path in files:
+            by_file.setdefault(path, set()).add(sha)
+    pending = list(affected)
+    while pending:
+        path = pending.pop()
+        for sha in by_file.get(path, ()):
+            for other in touched[sha]:
+                if other not in affected:
+                    affected.add(other)
+                    pending.append(other)
+    return affected
+
+
+def gclient_revinfo(env):
+    """
+    Map of dependency path -> (url, revision) from the DEPS files in the work tree,
+    without network access.
+    """
+    output = sp.check_output(['gclient', 'revinfo'], env=env, encoding='utf-8')
+    deps = {}
+    for line in output.splitlines():
+        path, sep, spec = line.partition(': ')
+        if not sep:
+            continue
+        url, _, rev = spec.strip().rpartition('@')
+        deps[path.strip()] = (url, rev) if url else (rev, None)
+    return deps
+
+
+def changed_deps(old_deps, new_deps, source_dir):
+    """
+    Git dependencies under source_dir whose revision differs, as a map of folder relative to
+    source_dir -> (old revision, new revision). Raises RuntimeError for changes upgrade cannot
+    follow: added or removed dependencies, and changed ones that are not git checkouts (CIPD).
+    """
+    prefix = source_dir + '/'
+    added = sorted(set(new_deps) - set(old_deps))
+    removed = sorted(set(old_deps) - set(new_deps))
+    if added or removed:
+        raise RuntimeError("Dependencies were added ({}) or removed ({}), run sync and prepare instead."
+                           .format(', '.join(added) or 'none', ', '.join(removed) or 'none'))
+    changed = {}
+    for path, (url, rev) in sorted(new_deps.items()):
+        if path == source_dir or old_deps[path] == (url, rev):
+            continue
+        if not path.startswith(prefix) or not os.path.isdir(os.path.join(path, '.git')):
+            raise RuntimeError("Dependency {} changed and is not a git checkout, run sync and prepare instead."
+                               .format(path))
+        if old_deps[path][0] != url:
+            raise RuntimeError("Dependency {} moved from {} to {}, run sync and prepare instead."
+                               .format(path, old_deps[path][0], url))
+        changed[path[len(prefix):]] = (old_deps[path][1], rev)
+    return changed
+
+
+def git_deps(deps, source_dir):
+    """
+    Folders relative to source_dir of the dependencies that are git checkouts.
+    """
+    prefix = source_dir + '/'
+    return [p[len(prefix):] for p in deps if p.startswith(prefix) and os.path.isdir(os.path.join(p, '.git'))]
+
+
+def git_rev(repo, rev):
+    return sp.check_output(['git', 'rev-parse', rev + '^{commit}'], cwd=repo, encoding='utf-8').strip()
+
+
+def git_ensure_rev(repo, rev, tag=False, shallow=False):
+    """
+    Fetch rev (a commit or, if tag is set, a tag name) unless it is available locally.
+    Returns the commit hash.
+    """
+    if sp.run(['git', 'rev-parse', '--verify', '-q', rev + '^{commit}'], cwd=repo,
+              stdout=sp.DEVNULL).returncode != 0:
+        cmd = ['git', 'fetch', '--no-tags'] + (['--depth=1'] if shallow else []) + ['origin']
+        sp.check_call(cmd + (['tag', rev] if tag else [rev]), cwd=repo)
+    return git_rev(repo, rev)
+
+
+def git_changed_files(repo, old, new):
+    """
+    Paths that differ between two commits, renames are reported as delete and add.
+    """
+    output = sp.check_output(['git', 'diff', '--name-only', '--no-renames', '-z', old, new], cwd=repo)
+    return set(p.decode('utf-8', 'surrogateescape') for p in output.split(b'\0') if p)
+
+
+def git_tree(repo, rev):
+    """
+    Map of path -> (mode, blob hash) of all files in a commit.
+    """
+    output = sp.check_output(['git', 'ls-tree', '-r', '-z', '--full-tree', rev], cwd=repo)
+    tree = {}
+    for item in output.split(b'\0'):
+        if not item:
+            continue
+        meta, _, path = item.partition(b'\t')
+        mode, kind, sha = meta.decode().split(' ')
+        if kind == 'blob':
+            tree[path.decode('utf-8', 'surrogateescape')] = (mode, sha)
+    return tree
+
+
+def git_restore_files(repo, rev, paths, tree):
+    """
+    Make paths in the work tree of repo match commit rev: files in tree (git_tree of rev) are
+    checked out, the others removed.
+    """
+    present = sorted(p for p in paths if p in tree)
+    if present:
+        with tempfile.NamedTemporaryFile(suffix='.pathspec') as f:
+            f.write('\0'.join(present).encode('utf-8', 'surrogateescape'))
+            f.flush()
+            sp.check_call(['git', '--literal-pathspecs', 'checkout', rev, '--pathspec-from-file=' + f.name,
+                           '--pathspec-file-nul'], cwd=repo)
+    for path in paths:
+        if path not in tree:
+            full = os.path.join(repo, path)
+            if os.path.lexists(full) and not os.path.isdir(full):
+                os.remove(full)
+
+
+def git_move_head(repo, rev):
+    """
+    Point HEAD (detached) and the index at rev without touching the work tree.
+    """
+    sp.check_call(['git', 'update-ref', '--no-deref', 'HEAD', rev], cwd=repo)
+    sp.check_call(['git', 'reset', '-q'], cwd=repo)
+
+
+def git_export_files(repo, paths, dest, tree):
+    """
+    Write the content paths have in tree (git_tree of a commit of repo) under dest.
+    Paths not in tree are skipped. Returns the paths written.
+    """
+    wanted = [(p, tree[p]) for p in sorted(paths) if p in tree]
+    if not wanted:
+        return []
+    start = time.monotonic()
+    proc = sp.Popen(['git', 'cat-file', '--batch'], cwd=repo, stdin=sp.PIPE, stdout=sp.PIPE)
+    try:
+        for path, (mode, sha) in wanted:
+            proc.stdin.write(sha.encode() + b'\n')
+            proc.stdin.flush()
+            header = proc.stdout.readline().split()
+            data = proc.stdout.read(int(header[2]))
+            proc.stdout.read(1)
+            target = os.path.join(dest, path)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if mode == '120000':
+                os.symlink(data.decode('utf-8', 'surrogateescape'), target)
+                continue
+            with open(target, 'wb') as f:
+                f.write(data)
+            if mode == '100755':
+                os.chmod(target, 0o755)
+    finally:
+        proc.stdin.close()
+        proc.stdout.close()
+        sp.traced_wait(proc, start, repo)
+    return [p for p, _ in wanted]
+
+
+def git_dirty_files(repo):
+    """
+    Paths of repo whose work tree differs from the index, including untracked files.
+    """
+    output = sp.check_output(['git', 'status', '--porcelain', '-z', '--untracked-files=all',
+                              '--ignore-submodules=all'], cwd=repo)
+    paths = set()
+    items = output.split(b'\0')
+    i = 0
+    while i < len(items):
+        item = items[i]
+        i += 1
+        if not item:
+            continue
+        paths.add(item[3:].decode('utf-8', 'surrogateescape'))
+        # Renames and copies are followed by the source path
+        if item[:1] in (b'R', b'C'):
+            paths.add(items[i].decode('utf-8', 'surrogateescape'))
+            i += 1
+    return paths
+
+
+def same_file(a, b):
+    """
+    Whether two paths are both missing, the same symlink or regular files with the same content and mode.
+    """
+    if not os.path.lexists(a) or not os.path.lexists(b):
+        return os.path.lexists(a) == os.path.lexists(b)
+    if os.path.islink(a) or os.path.islink(b):
+        return os.path.islink(a) and os.path.islink(b) and os.readlink(a) == os.readlink(b)
+    if (os.stat(a).st_mode & 0o111 != 0) != (os.stat(b).st_mode & 0o111 != 0):
+        return False
+    return _sha256(a) == _sha256(b)
+
+
+def split_by_repo(paths, repos):
+    """
+    Group paths relative to the source tree by the innermost repo (relative folder, '' for the
+    source tree itself) that contains them. Returns repo -> set of paths relative to that repo.
+    """
+    ordered = sorted(repos, key=len, reverse=True)
+    groups = {}
+    for path in paths:
+        for repo in ordered:
+            if not repo or path.startswith(repo + '/'):
+                groups.setdefault(repo, set()).add(path[len(repo) + 1:] if repo else path)
+                break
+    return groups
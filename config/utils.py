@@ -1,30 +1,56 @@
+import filecmp
+import fnmatch
 import logging
 import multiprocessing as mp
 import shutil
-import subprocess as sp
 import os
 import re
 import sys
 import warnings
 from dataclasses import dataclass
 
-from config.constants import OUTPUT_BASE_DIR
+from config import tracing as sp
+from config.constants import ARCH, OS, OUTPUT_BASE_DIR
+from config.scheduler import available_cpus
 
 
 @dataclass
 class Config:
     """Class keeps configurations."""
+    auto_jobs: bool
+    cache_max_age: int
     cc_wrapper: str
+    ccache_dir: str
+    ccache_size: int
+    compression: str
     debug: bool
     direct_download: bool
+    exclude_files: list
+    force: bool
+    fused_prepare: bool
+    git_cache_dir: str
     gn_args: dict
     install_build_deps: bool
+    matrix: list
     num_jobs: int
     output_base_dir: str
+    pgo_page_time: int
+    pgo_phase: int
+    pgo_profile: str
+    pgo_runs: int
+    pgo_workload: str
+    progress: str
     reset: bool
     shallow: bool
+    source_url: str
+    stale: bool
     target_os: str
     target_cpu: str
+    thinlto_cache_dir: str
+    thinlto_cache_max_age: int
+    thinlto_cache_size: int
+    verify: bool
+    wait: bool
 
     def __init__(self, args):
         # Parse GN args from cmdline, ignore errors
@@ -37,17 +63,70 @@ class Config:
                     continue
                 gn_args[kv[0]] = kv[1]
 
+        self.cache_max_age = args.cache_max_age
         self.cc_wrapper = args.cc_wrapper
+        self.ccache_dir = args.ccache_dir
+        self.ccache_size = args.ccache_size
+        self.compression = args.compression
         self.debug = args.debug
         self.direct_download = args.direct_download
+        self.exclude_files = args.exclude_list
+        self.force = args.force
+        self.fused_prepare = args.fused_prepare
+        self.git_cache_dir = args.git_cache
         self.gn_args = gn_args
         self.install_build_deps = args.install_build_deps
-        self.num_jobs = mp.cpu_count()
+        self.matrix = args.matrix or []
+        if args.jobs == 'auto':
+            self.auto_jobs = True
+            self.num_jobs = available_cpus()
+        else:
+            self.auto_jobs = False
+            self.num_jobs = int(args.jobs) if args.jobs else mp.cpu_count()
         self.output_base_dir = OUTPUT_BASE_DIR if not args.output_dir else args.output_dir
+        self.pgo_page_time = args.pgo_page_time
+        # Set to 1 for the instrumented build of the pgo command
+        self.pgo_phase = 0
+        self.pgo_profile = args.pgo_profile
+        self.pgo_runs = args.pgo_runs
+        self.pgo_workload = args.pgo_workload
+        self.progress = args.progress
         self.reset = args.reset
         self.shallow = args.shallow
+        self.source_url = args.source_url
+        self.stale = args.stale
         self.target_os = args.os
         self.target_cpu = args.arch
+        self.thinlto_cache_dir = args.thinlto_cache_dir
+        self.thinlto_cache_max_age = args.thinlto_cache_max_age
+        self.thinlto_cache_size = args.thinlto_cache_size
+        self.verify = args.verify
+        self.wait = args.wait
+
+
+def parse_matrix(value):
+    """
+    Parse a build matrix of the form os:arch[:debug],... into (target_os, target_cpu, debug) tuples.
+    """
+    matrix = []
+    for item in value.split(','):
+        parts = item.strip().split(':')
+        if len(parts) not in (2, 3) or parts[0] not in OS or parts[1] not in ARCH \
+                or (len(parts) == 3 and parts[2] not in ('debug', 'release')):
+            raise ValueError("Invalid matrix entry: " + item)
+        matrix.append((parts[0], parts[1], len(parts) == 3 and parts[2] == 'debug'))
+    return matrix
+
+
+def parse_size(value):
+    """
+    Parse a size like 50G, 512M or a plain number of bytes.
+    """
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    value = value.strip().upper().rstrip('B').rstrip('I')
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
 
 
 def create_logger(level=logging.INFO, stream=sys.stdout, filename=None):
@@ -74,96 +153,322 @@ def parse_gn_flags(gn_lines):
     gn_args = {}
 
     for line in gn_lines:
+        if not line.strip() or line.strip().startswith('#'):
+            continue
         name, var = line.strip().partition("=")[::2]
         gn_args[name.strip()] = var.strip()
 
     return gn_args
 
 
-def filter_list_file(base_dir, list_file, excludes=(), excludes_pattern=None):
+def normalize_gn_args(gn_args):
+    """
+    Canonical form of GN args for comparison: sorted, whitespace stripped.
+    """
+    return sorted((k.strip(), v.strip()) for k, v in gn_args.items() if k.strip())
+
+
+class PathMatcher:
+    """
+    Match relative paths against many patterns at once. A pattern ending with '/' matches everything
+    below that folder (looked up in a prefix trie), a pattern with *, ? or [ is a glob, anything
+    else must match exactly. Regexes are matched from the start of the path, like re.match.
+    """
+
+    def __init__(self, patterns=(), regexes=()):
+        self.exact = set()
+        self.trie = {}
+        globs = []
+        for pattern in patterns:
+            pattern = pattern.strip()
+            if not pattern or pattern.startswith('#'):
+                continue
+            if pattern.endswith('/'):
+                node = self.trie
+                for part in pattern.strip('/').split('/'):
+                    node = node.setdefault(part, {})
+                node[None] = True
+            elif any(c in pattern for c in '*?['):
+                globs.append(fnmatch.translate(pattern))
+            else:
+                self.exact.add(pattern)
+        if isinstance(regexes, str):
+            regexes = [regexes]
+        self.glob = re.compile('|'.join(globs)) if globs else None
+        self.regex = re.compile('|'.join('(?:{})'.format(r) for r in regexes)) if regexes else None
+
+    def _under_prefix(self, path):
+        node = self.trie
+        for part in path.split('/'):
+            node = node.get(part)
+            if node is None:
+                return False
+            if None in node:
+                return True
+        return False
+
+    def matches(self, path):
+        return path in self.exact or (self.trie and self._under_prefix(path)) \
+            or (self.glob is not None and self.glob.match(path) is not None) \
+            or (self.regex is not None and self.regex.match(path) is not None)
+
+
+def read_patterns(pattern_files):
+    """
+    Read patterns from exclusion files, skipping empty lines and # comments.
+    """
+    patterns = []
+    for path in pattern_files:
+        with open(path, 'r', encoding='utf-8') as f:
+            patterns += [l.strip() for l in f if l.strip() and not l.startswith('#')]
+    return patterns
+
+
+def filter_list_file(base_dir, list_file, excludes=(), excludes_pattern=None, exclude_files=(), output=None):
     """
     Filter list files (pruning.list, domain_substitution.list, series).
+    list_file can be one name or a sequence of names in base_dir, which are merged without
+    duplicates. Entries are dropped if they match excludes or the patterns in exclude_files
+    (see PathMatcher), or the excludes_pattern regex (or sequence of regexes).
+    The output is only replaced if it changed, so its mtime stays as is otherwise.
+    Returns the path of the filtered list.
     """
-    output_lines = []
-    excludes = [e.strip() for e in excludes]
-    with open(os.path.join(base_dir, list_file), 'r', encoding='utf-8') as f:
-        lines = f.readlines()
+    list_files = [list_file] if isinstance(list_file, str) else list(list_file)
+    matcher = PathMatcher(list(excludes) + read_patterns(exclude_files), excludes_pattern or ())
+    if output is None:
+        output = os.path.join(base_dir, '+'.join(list_files) + '.filtered')
 
-    for l in lines:
-        if l.strip() in excludes or (
-                excludes_pattern is not None and re.match(excludes_pattern, l)):
-            continue
+    seen = set()
+    tmp_path = output + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as out:
+        for name in list_files:
+            with open(os.path.join(base_dir, name), 'r', encoding='utf-8') as f:
+                for l in f:
+                    entry = l.strip()
+                    if not entry or entry in seen or matcher.matches(entry):
+                        continue
+                    seen.add(entry)
+                    out.write(entry + '\n')
+
+    if os.path.exists(output) and filecmp.cmp(tmp_path, output, shallow=False):
+        os.remove(tmp_path)
+    else:
+        os.replace(tmp_path, output)
+    return output
+
+
+def read_list_file(list_file):
+    """
+    Read non-empty entries of a list file.
+    """
+    with open(list_file, 'r', encoding='utf-8') as f:
+        return [l.strip() for l in f if l.strip()]
+
+
+def write_list_file(list_file, entries):
+    """
+    Write entries to a list file, one per line.
+    """
+    with open(list_file, 'w', encoding='utf-8') as f:
+        f.writelines(e + '\n' for e in entries)
+    return list_file
+
+
+class GitRepoState:
+    """
+    Local state of a git checkout, read without network access.
+    refs maps a ref name to its commit, tags are peeled.
+    """
+
+    def __init__(self, git_dir, head, shallow, refs, symrefs):
+        self.git_dir = git_dir
+        self.head = head
+        self.shallow = shallow
+        self.refs = refs
+        self.symrefs = symrefs
+
+    def default_branch(self, remote_name='origin'):
+        """
+        Default branch as last seen from remote_name, or None if git does not know it locally.
+        """
+        target = self.symrefs.get('refs/remotes/{}/HEAD'.format(remote_name))
+        prefix = 'refs/remotes/{}/'.format(remote_name)
+        if target and target.startswith(prefix):
+            return target[len(prefix):]
+        return None
+
+    def resolve(self, name):
+        """
+        Commit of a tag, branch or commit hash, or None if it is not available locally.
+        """
+        for ref in ('refs/tags/' + name, 'refs/heads/' + name, name):
+            if ref in self.refs:
+                return self.refs[ref]
+        if re.fullmatch(r'[0-9a-f]{40}', name):
+            return name
+        return None
+
+    def is_tag(self, name):
+        return 'refs/tags/' + name in self.refs
+
+
+# Repo states probed during this run, keyed by absolute path
+_repo_states = {}
 
-        output_lines.append(l.strip() + '\n')
 
-    new_list_file = os.path.join(base_dir, list_file + '.filtered')
-    with open(new_list_file, 'w', encoding='utf-8') as f:
-        f.writelines(output_lines)
+def _git_dir(repo_folder):
+    """
+    Resolve the git directory of a checkout, following a .git file of worktrees and submodules.
+    """
+    git_dir = os.path.join(repo_folder, '.git')
+    if os.path.isfile(git_dir):
+        with open(git_dir, 'r', encoding='utf-8') as f:
+            line = f.readline().strip()
+        if not line.startswith('gitdir:'):
+            return None
+        git_dir = os.path.join(repo_folder, line[len('gitdir:'):].strip())
+    if not os.path.isfile(os.path.join(git_dir, 'HEAD')):
+        return None
+    return os.path.abspath(git_dir)
+
+
+def git_repo_state(repo_folder, refresh=False):
+    """
+    Probe a checkout with a single local git call and cache the result for this run.
+    Returns a GitRepoState, or None if the folder is not a git checkout.
+    """
+    key = os.path.abspath(repo_folder)
+    if not refresh and key in _repo_states:
+        return _repo_states[key]
 
-    return new_list_file
+    state = None
+    git_dir = _git_dir(repo_folder) if os.path.isdir(repo_folder) else None
+    if git_dir is not None:
+        result = sp.run(['git', '--git-dir', git_dir, 'for-each-ref',
+                         '--format=%(objectname) %(*objectname) %(refname) %(symref)'],
+                        encoding='utf8', capture_output=True)
+        if result.returncode != 0:
+            warnings.warn("{}\n{} is not a valid git repository".format(result.stderr.strip(), repo_folder))
+        else:
+            refs = {}
+            symrefs = {}
+            for line in result.stdout.splitlines():
+                obj, peeled, ref, symref = (line.split(' ') + [''])[:4]
+                refs[ref] = peeled or obj
+                if symref:
+                    symrefs[ref] = symref
+            # HEAD is a symbolic ref to a branch or a detached commit
+            with open(os.path.join(git_dir, 'HEAD'), 'r', encoding='utf-8') as f:
+                head = f.read().strip()
+            if head.startswith('ref:'):
+                head = refs.get(head[len('ref:'):].strip())
+            shallow = os.path.exists(os.path.join(git_dir, 'shallow'))
+            state = GitRepoState(git_dir, head, shallow, refs, symrefs)
+    _repo_states[key] = state
+    return state
+
+
+def git_forget_state(repo_folder):
+    """
+    Drop the cached state of a checkout after changing it.
+    """
+    _repo_states.pop(os.path.abspath(repo_folder), None)
 
 
 def git_get_default_branch(repo_folder, remote_name='origin'):
     """
-    Get the default branch name.
+    Get the default branch name. Uses the local remote HEAD and only asks the remote
+    if it is not known.
     """
-    if not git_is_valid_repo(repo_folder):
+    state = git_repo_state(repo_folder)
+    if state is None or state.shallow:
         return
 
-    remote_info = sp.check_output(['git', 'remote', 'show', remote_name], cwd=repo_folder,
-                                  encoding='utf8').strip()
-    branch_name = re.search(r'HEAD branch:\s*(.*)', remote_info).group(1)
+    branch_name = state.default_branch(remote_name)
+    if branch_name is None:
+        remote_info = sp.check_output(['git', 'remote', 'show', remote_name], cwd=repo_folder,
+                                      encoding='utf8').strip()
+        branch_name = re.search(r'HEAD branch:\s*(.*)', remote_info).group(1)
 
     return branch_name
 
 
-def git_maybe_checkout(remote, repo_folder, branch=None, reset=False):
+def git_maybe_checkout(remote, repo_folder, branch=None, reset=False, cache=None):
     """
     Check if dir is a git working directory. If it exists and is a valid git repository,
     pull and update HEAD. Otherwise do a clean clone.
-    branch can be tag.
+    branch can be tag. Nothing is fetched if the tag or commit is already checked out,
+    and an update that fails to fetch falls back to the local refs.
+    If cache (a GitCache) is given, its mirror of remote is updated first and the clone
+    borrows objects from it.
     TODO: check origin matches
     """
     remote_name = 'origin'
     valid = git_is_valid_repo(repo_folder)
-    default_branch = git_get_default_branch(repo_folder, remote_name)
+    state = git_repo_state(repo_folder)
 
     if not valid:
         shutil.rmtree(repo_folder, ignore_errors=True)
         clone_cmd = ['git', 'clone', remote]
+        if cache is not None:
+            clone_cmd += ['--reference-if-able', cache.reference(remote)]
         if branch is not None:
             clone_cmd += ['-b', branch]
         clone_cmd += [repo_folder]
         sp.check_call(clone_cmd)
+    elif branch is not None and (state.is_tag(branch) or branch == state.head) \
+            and state.resolve(branch) == state.head:
+        # Tags and commits do not move, there is nothing to fetch
+        logging.info("%s is already at %s.", repo_folder, branch)
     else:
-        sp.check_call(['git', 'pull', remote_name, default_branch], cwd=repo_folder)
-        sp.check_call(['git', 'checkout', branch], cwd=repo_folder)
+        if cache is not None:
+            cache.populate(remote)
+            cache.attach(repo_folder, remote)
+        if branch is None:
+            pull = sp.run(['git', 'pull', remote_name, git_get_default_branch(repo_folder, remote_name)],
+                          cwd=repo_folder)
+            if pull.returncode != 0:
+                logging.warning("Updating %s failed, using the local checkout.", repo_folder)
+        else:
+            fetch = sp.run(['git', 'fetch', '--tags', remote_name], cwd=repo_folder)
+            if fetch.returncode != 0:
+                if state.resolve(branch) is None:
+                    raise RuntimeError("Cannot fetch {} and {} is not available locally.".format(remote, branch))
+                logging.warning("Fetching %s failed, using local %s.", remote, branch)
+            sp.check_call(['git', 'checkout', branch], cwd=repo_folder)
+            if not state.is_tag(branch) and 'refs/remotes/{}/{}'.format(remote_name, branch) in \
+                    git_repo_state(repo_folder, refresh=True).refs:
+                sp.check_call(['git', 'merge', '--ff-only', '{}/{}'.format(remote_name, branch)], cwd=repo_folder)
 
     if reset:
         sp.check_call(['git', 'clean', '-fxd'], cwd=repo_folder)
         sp.check_call(['git', 'reset', '--hard'], cwd=repo_folder)
+    git_forget_state(repo_folder)
 
 
 def git_is_valid_repo(repo_folder):
     """
-    Test whether a folder is a valid git repository.
+    Test whether a folder is a valid, non shallow git repository.
     """
-    valid = True
-    if not os.path.exists(repo_folder) or not os.path.isdir(repo_folder):
-        valid = False
-    else:
-        try:
-            sp.check_call(['git', 'rev-parse', '--is-inside-work-tree'], cwd=repo_folder)
-            valid = not git_is_shallow(repo_folder)
-        except sp.CalledProcessError as e:
-            warnings.warn("{}\n{} is not a valid git repository".format(e, repo_folder))
-            valid = False
-    return valid
+    state = git_repo_state(repo_folder)
+    return state is not None and not state.shallow
 
 
 def git_is_shallow(repo_folder):
     """
     Check whether a git folder is a shallow copy
     """
-    shallow = sp.check_output(['git', 'rev-parse', '--is-shallow-repository'], cwd=repo_folder, encoding='utf8').strip()
-    return shallow == 'true'
+    state = git_repo_state(repo_folder)
+    return state is not None and state.shallow
+
+
+def git_head(repo_folder):
+    """
+    Get the commit hash of HEAD, or None if the folder is not a git repository.
+    """
+    if not os.path.isdir(repo_folder):
+        return None
+    result = sp.run(['git', 'rev-parse', 'HEAD'], cwd=repo_folder, encoding='utf8', capture_output=True)
+    if result.returncode != 0:
+        return None
+    return result.stdout.strip()
@@ -0,0 +1,142 @@
+import hashlib
+import io
+import os
+import tarfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from config.download import RangeDownloader, download_source
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """
+    Serves server.files, with range requests unless server.ranges is false.
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def _body(self):
+        data = self.server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return None
+        self.server.requests.append((self.command, self.headers.get('Range')))
+        start, end = 0, len(data) - 1
+        spec = self.headers.get('Range')
+        if spec and self.server.ranges:
+            first, _, last = spec[len('bytes='):].partition('-')
+            start, end = int(first), min(int(last), end)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, len(data)))
+        else:
+            self.send_response(200)
+        if self.server.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        return data[start:end + 1]
+
+    def do_HEAD(self):
+        self._body()
+
+    def do_GET(self):
+        body = self._body()
+        if body is not None:
+            self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    httpd.files = {}
+    httpd.requests = []
+    httpd.ranges = True
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    httpd.url = 'http://127.0.0.1:{}'.format(httpd.server_address[1])
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _tarball(members):
+    """
+    .tar.xz of (TarInfo, bytes or None) members.
+    """
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:xz') as tar:
+        for info, data in members:
+            if data is not None:
+                info.size = len(data)
+            tar.addfile(info, io.BytesIO(data) if data is not None else None)
+    return buf.getvalue()
+
+
+def _file(name, data):
+    info = tarfile.TarInfo(name)
+    info.mode = 0o644
+    return info, data
+
+
+def _symlink(name, target):
+    info = tarfile.TarInfo(name)
+    info.type = tarfile.SYMTYPE
+    info.linkname = target
+    return info, None
+
+
+def _publish(server, name, data, digest=None):
+    server.files['/' + name] = data
+    digest = digest or hashlib.sha256(data).hexdigest()
+    server.files['/' + name + '.hashes'] = 'md5  0  {0}\nsha256  {1}  {0}\n'.format(name, digest).encode()
+    return server.url + '/' + name
+
+
+def test_range_downloader_reassembles_chunks(server):
+    data = os.urandom(100000)
+    server.files['/blob'] = data
+    downloader = RangeDownloader(server.url + '/blob', jobs=4, chunk_size=8192)
+    assert b''.join(downloader) == data
+    assert sum(1 for method, spec in server.requests if method == 'GET' and spec) == 13
+
+
+def test_range_downloader_without_ranges(server):
+    server.ranges = False
+    data = os.urandom(50000)
+    server.files['/blob'] = data
+    assert b''.join(RangeDownloader(server.url + '/blob', jobs=4, chunk_size=8192)) == data
+
+
+def test_download_source(server, tmp_path):
+    archive = _tarball([_file('chromium-1.0/BUILD.gn', b'gn'), _file('chromium-1.0/chrome/app.cc', b'app'),
+                        _symlink('chromium-1.0/chrome/link.cc', 'app.cc')])
+    url = _publish(server, 'chromium-1.0.tar.xz', archive)
+    dest = str(tmp_path / 'src')
+    download_source(url, dest, jobs=2)
+    with open(os.path.join(dest, 'chrome', 'link.cc'), 'rb') as f:
+        assert f.read() == b'app'
+    assert sorted(os.listdir(dest)) == ['BUILD.gn', 'chrome']
+    assert not os.path.exists(dest + '.partial')
+
+
+def test_download_source_rejects_wrong_digest(server, tmp_path):
+    archive = _tarball([_file('chromium-1.0/BUILD.gn', b'gn')])
+    url = _publish(server, 'chromium-1.0.tar.xz', archive, digest='0' * 64)
+    dest = str(tmp_path / 'src')
+    with pytest.raises(ValueError):
+        download_source(url, dest)
+    assert not os.path.exists(dest)
+
+
+def test_download_source_does_not_write_through_symlinks(server, tmp_path):
+    outside = tmp_path / 'outside'
+    outside.mkdir()
+    archive = _tarball([_symlink('chromium-1.0/escape', str(outside)),
+                        _file('chromium-1.0/escape/pwned', b'pwned')])
+    url = _publish(server, 'chromium-1.0.tar.xz', archive)
+    with pytest.raises((ValueError, tarfile.TarError)):
+        download_source(url, str(tmp_path / 'src'))
+    assert not os.listdir(str(outside))
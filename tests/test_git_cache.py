@@ -0,0 +1,44 @@
+import json
+import os
+import shutil
+import subprocess
+
+from config.git_cache import GitCache
+
+
+def _git(*args, cwd=None):
+    subprocess.check_call(['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com'] + list(args),
+                          cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def _age_mirrors(cache):
+    with open(os.path.join(cache.cache_dir, 'usage.json'), 'w', encoding='utf-8') as f:
+        json.dump({name: 0 for name in cache.mirrors()}, f)
+
+
+def test_gc_keeps_borrowed_mirrors(tmp_path, monkeypatch):
+    upstream = str(tmp_path / 'upstream')
+    os.makedirs(upstream)
+    _git('init', '-q', cwd=upstream)
+    with open(os.path.join(upstream, 'README'), 'w', encoding='utf-8') as f:
+        f.write('readme')
+    _git('add', 'README', cwd=upstream)
+    _git('commit', '-q', '-m', 'initial', cwd=upstream)
+
+    workspace = tmp_path / 'workspace'
+    workspace.mkdir()
+    monkeypatch.chdir(str(workspace))
+    cache = GitCache(str(tmp_path / 'cache'))
+    reference = cache.reference(upstream)
+    _git('clone', '-q', '--reference-if-able', reference, upstream, 'src')
+    _age_mirrors(cache)
+
+    cache.gc(max_age_days=1)
+    assert cache.mirrors() == [os.path.basename(reference)]
+    _git('fsck', cwd=str(workspace / 'src'))
+
+    # Once the workspace is gone, the mirror can go too
+    monkeypatch.chdir(str(tmp_path))
+    shutil.rmtree(str(workspace))
+    cache.gc(max_age_days=1)
+    assert cache.mirrors() == []
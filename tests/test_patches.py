@@ -0,0 +1,41 @@
+import os
+
+import pytest
+
+from config.patches import PatchError, apply_patches
+
+_PATCH = '''--- a/chrome/app.cc
++++ b/chrome/app.cc
+@@ -1,2 +1,2 @@
+ one
+-two
++TWO
+'''
+
+
+def _write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+
+def _read(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def test_applying_twice_is_a_conflict(tmp_path):
+    src = str(tmp_path / 'src')
+    _write(os.path.join(src, 'chrome', 'app.cc'), 'one\ntwo\n')
+    patch = str(tmp_path / 'patches' / 'app.patch')
+    _write(patch, _PATCH)
+    scratch = str(tmp_path / 'scratch')
+
+    results = apply_patches([patch], src, scratch_dir=scratch)
+    assert [r['hunks'] for r in results] == [1]
+    assert _read(os.path.join(src, 'chrome', 'app.cc')) == 'one\nTWO\n'
+
+    with pytest.raises(PatchError) as e:
+        apply_patches([patch], src, scratch_dir=scratch)
+    assert 'already applied' in e.value.conflicts[0][1]
+    assert _read(os.path.join(src, 'chrome', 'app.cc')) == 'one\nTWO\n'
@@ -0,0 +1,34 @@
+import os
+
+from config.prune import PruneIndex, prune_binaries
+
+
+def _touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b'\0')
+
+
+def test_index_skips_pruned_files(tmp_path):
+    src = str(tmp_path / 'src')
+    _touch(os.path.join(src, 'a', 'blob.bin'))
+    index = PruneIndex('head', str(tmp_path / 'index.json'))
+    report = prune_binaries(src, ['a/blob.bin', 'a/gone.bin'], index=index)
+    assert report.removed == ['a/blob.bin']
+    assert report.missing == ['a/gone.bin']
+
+    report = prune_binaries(src, ['a/blob.bin', 'a/gone.bin'], index=PruneIndex('head', str(tmp_path / 'index.json')))
+    assert report.skipped == 2
+    assert not report.removed
+
+
+def test_index_prunes_files_that_came_back(tmp_path):
+    src = str(tmp_path / 'src')
+    _touch(os.path.join(src, 'a', 'blob.bin'))
+    prune_binaries(src, ['a/blob.bin'], index=PruneIndex('head', str(tmp_path / 'index.json')))
+
+    # e.g. a reset at the same revision
+    _touch(os.path.join(src, 'a', 'blob.bin'))
+    report = prune_binaries(src, ['a/blob.bin'], index=PruneIndex('head', str(tmp_path / 'index.json')))
+    assert report.removed == ['a/blob.bin']
+    assert not os.path.exists(os.path.join(src, 'a', 'blob.bin'))
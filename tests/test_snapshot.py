@@ -0,0 +1,100 @@
+import os
+import subprocess
+
+import pytest
+
+from config.snapshot import SourceSnapshot
+
+
+def _write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+
+def _read(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+@pytest.fixture
+def tree(tmp_path):
+    src = tmp_path / 'src'
+    _write(str(src / 'chrome' / 'app.cc'), 'app')
+    _write(str(src / 'third_party' / 'lib' / 'lib.cc'), 'lib')
+    return src
+
+
+def test_restore_reverts_changes(tree, tmp_path):
+    snapshot = SourceSnapshot(str(tree), str(tmp_path / 'snapshot'), excludes=['out'])
+    snapshot.take('head')
+    os.remove(str(tree / 'chrome' / 'app.cc'))
+    _write(str(tree / 'chrome' / 'app.cc'), 'patched')
+    os.remove(str(tree / 'third_party' / 'lib' / 'lib.cc'))
+    _write(str(tree / 'chrome' / 'new' / 'added.cc'), 'added')
+
+    SourceSnapshot(str(tree), str(tmp_path / 'snapshot'), excludes=['out']).restore()
+    assert _read(str(tree / 'chrome' / 'app.cc')) == 'app'
+    assert _read(str(tree / 'third_party' / 'lib' / 'lib.cc')) == 'lib'
+    assert not os.path.exists(str(tree / 'chrome' / 'new'))
+
+
+def test_restore_keeps_build_folders(tree, tmp_path):
+    # Output folders of other output bases, created before or after the snapshot
+    _write(str(tree / 'out_old' / 'Release' / 'args.gn'), 'is_debug=false')
+    _write(str(tree / 'out_old' / 'Release' / 'obj.o'), 'old')
+    snapshot = SourceSnapshot(str(tree), str(tmp_path / 'snapshot'), excludes=['out'])
+    snapshot.take('head')
+    assert not any(rel.startswith('out_old') for rel in snapshot.files)
+
+    _write(str(tree / 'out2' / 'Release' / 'args.gn'), 'is_debug=false')
+    _write(str(tree / 'out2' / 'Release' / 'obj.o'), 'obj')
+    _write(str(tree / 'out' / 'Release' / 'obj.o'), 'obj')
+    _write(str(tree / 'scratch' / 'notes.txt'), 'notes')
+    _write(str(tree / 'chrome' / 'out' / 'Debug' / 'build.ninja.d'), 'build.ninja: ../../BUILD.gn')
+
+    SourceSnapshot(str(tree), str(tmp_path / 'snapshot'), excludes=['out']).restore()
+    assert _read(str(tree / 'out2' / 'Release' / 'obj.o')) == 'obj'
+    assert _read(str(tree / 'out_old' / 'Release' / 'obj.o')) == 'old'
+    assert _read(str(tree / 'out' / 'Release' / 'obj.o')) == 'obj'
+    assert _read(str(tree / 'scratch' / 'notes.txt')) == 'notes'
+    assert os.path.exists(str(tree / 'chrome' / 'out' / 'Debug' / 'build.ninja.d'))
+
+
+def test_take_refuses_changed_git_tree(tree, tmp_path):
+    git = ['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com']
+    subprocess.check_call(git + ['init', '-q'], cwd=str(tree))
+    subprocess.check_call(git + ['add', '-A'], cwd=str(tree))
+    subprocess.check_call(git + ['commit', '-q', '-m', 'initial'], cwd=str(tree))
+    os.remove(str(tree / 'third_party' / 'lib' / 'lib.cc'))
+
+    snapshot = SourceSnapshot(str(tree), str(tmp_path / 'snapshot'))
+    with pytest.raises(RuntimeError):
+        snapshot.take('head')
+    assert not snapshot.exists()
+
+    subprocess.check_call(['git', 'checkout', '-q', '--', '.'], cwd=str(tree))
+    snapshot.take('head')
+    assert 'third_party/lib/lib.cc' in snapshot.files
+
+
+def test_restore_refuses_hardlinks_written_in_place(tree, tmp_path, monkeypatch):
+    def no_reflink(src, dst):
+        raise OSError('no reflinks')
+    monkeypatch.setattr('config.snapshot.reflink', no_reflink)
+    snapshot = SourceSnapshot(str(tree), str(tmp_path / 'snapshot'))
+    snapshot.take('head')
+    assert snapshot.mode == 'hardlink'
+
+    # Replaced files are fine, files written in place changed the snapshot too
+    os.remove(str(tree / 'third_party' / 'lib' / 'lib.cc'))
+    _write(str(tree / 'third_party' / 'lib' / 'lib.cc'), 'patched')
+    SourceSnapshot(str(tree), str(tmp_path / 'snapshot')).restore()
+    assert _read(str(tree / 'third_party' / 'lib' / 'lib.cc')) == 'lib'
+
+    _write(str(tree / 'chrome' / 'app.cc'), 'patched in place')
+    snapshot = SourceSnapshot(str(tree), str(tmp_path / 'snapshot'))
+    with pytest.raises(RuntimeError):
+        snapshot.restore()
+    assert not snapshot.exists()
+    assert not os.path.exists(str(tmp_path / 'snapshot'))